@@ -0,0 +1,6 @@
+import os
+
+# Django 3.1 checks its version through distutils; the setuptools copy drags in pkg_resources and roughly doubles
+# startup, so prefer the standard library one. Set here because manage.py, wsgi.py and asgi.py all import this
+# package before Django.
+os.environ.setdefault('SETUPTOOLS_USE_DISTUTILS', 'stdlib')
@@ -1,7 +1,8 @@
 """
 ASGI config for backend project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+It exposes the ASGI callable as a module-level variable named ``application``. Event streams for venue screens
+are only available here, not through WSGI.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -14,3 +15,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+# Imported once Django is set up; serves the per-business event streams and passes everything else to Django
+from checkin.events import EventStreamApplication  # noqa: E402
+
+application = EventStreamApplication(application)
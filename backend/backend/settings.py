@@ -47,7 +47,7 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication'
+        'checkin.authentication.JWTAuthentication'
     ]
 }
 
@@ -56,6 +56,45 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=14),
 }
 
+# Tokens issued before a deactivation or password change are rejected. Each worker keeps a Bloom filter of
+# recently revoked users and only queries the database for users in it; the filter is rebuilt when a worker
+# starts and every REFRESH_INTERVAL seconds to pick up revocations made by other workers.
+TOKEN_REVOCATION = {
+    'CAPACITY': 10000,
+    'ERROR_RATE': 0.001,
+    'REFRESH_INTERVAL': 60,
+}
+
+# Venue QR codes hold check-in tokens signed with SECRET_KEY. A token stays valid for between one and two
+# lifetimes so a code printed near the end of a window still works.
+CHECKIN_TOKEN_LIFETIME = timedelta(hours=24)
+
+# Cache holding the token buckets used by checkin.throttling; point it at a shared cache such as memcached
+# when running several worker processes so limits apply across all of them.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+THROTTLE_CACHE = 'default'
+
+# Customer and business profiles served by the detail views and the checkin/<kind>/batch/?ids= lookups are cached
+# per id for TIMEOUT seconds and dropped when saved. With several worker processes CACHE must be shared too,
+# or other workers can serve a stale profile until it expires. A batch lookup takes at most MAX_IDS ids.
+PROFILE_CACHE = {
+    'CACHE': 'default',
+    'TIMEOUT': 60,
+    'MAX_IDS': 100,
+}
+
+# Businesses look customers up by email or phone prefix at checkin/customer/search/?q=. Prefixes shorter than
+# MIN_PREFIX return nothing and at most MAX_RESULTS customers come back; the route's throttles are in checkin.urls.
+CUSTOMER_SEARCH = {
+    'MIN_PREFIX': 3,
+    'MAX_RESULTS': 10,
+}
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -66,8 +105,65 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'checkin.middleware.ReplicaPinMiddleware',
+    'checkin.middleware.ProfilingMiddleware',
+    'checkin.middleware.QueryAttributionMiddleware',
 ]
 
+# Staff can profile a single request by sending the X-Profile header or the _profile query parameter. With the
+# value "text" the response is replaced by the report; otherwise the stats are saved to DIRECTORY under the id
+# returned in the X-Profile-Id response header.
+REQUEST_PROFILING = {
+    'HEADER': 'X-Profile',
+    'QUERY_PARAM': '_profile',
+    'DIRECTORY': str(os.path.join(BASE_DIR, "profiles")),
+    # Functions listed in the text report
+    'TOP': 30,
+}
+
+# Queries taking at least THRESHOLD seconds are logged and totalled per normalized SQL, with the view, the
+# call site in checkin and the query plan. Staff can read the totals at checkin/slow_queries/. None disables.
+SLOW_QUERY_LOG = {
+    'THRESHOLD': 0.1,
+    'MAX_FINGERPRINTS': 500,
+    'EXPLAIN': True,
+}
+
+# Reads of other people's contact and visit data are audited. Events are buffered in each worker and written by a
+# background thread in batches of BATCH_SIZE, at least every FLUSH_INTERVAL seconds and when the worker exits.
+# BACKEND is 'database' for the AuditEvent table or 'file' to append JSON lines to FILE_PATH.
+AUDIT_LOG = {
+    'BACKEND': 'database',
+    'FILE_PATH': str(os.path.join(BASE_DIR, "audit", "access.jsonl")),
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 5.0,
+    # Events held while the backend is failing; the oldest are dropped beyond this
+    'MAX_BUFFER': 100000,
+    'BACKGROUND': True,
+}
+
+# "python manage.py export_snapshot", run nightly, appends the visits added since its last run to gzipped CSV
+# files under DIRECTORY partitioned by the visit's date, and writes every business under the run's date. Rows are
+# streamed CHUNK_SIZE at a time; at most MAX_OPEN_FILES partitions are written to at once.
+SNAPSHOT_EXPORT = {
+    'DIRECTORY': str(os.path.join(BASE_DIR, "exports")),
+    'CHUNK_SIZE': 2000,
+    'MAX_OPEN_FILES': 32,
+}
+
+# Venue screens follow checkin/business/<id>/events/ as server-sent events when served through backend.asgi.
+# Each worker polls the visit tables every POLL_INTERVAL seconds while anyone is subscribed. A screen that falls
+# QUEUE_SIZE events behind loses the oldest and gets a "lagged" event. Occupancy counts visitors checked in
+# within OCCUPANCY_WINDOW and is recounted at least every OCCUPANCY_INTERVAL seconds.
+EVENT_STREAM = {
+    'POLL_INTERVAL': 1.0,
+    'BATCH_SIZE': 1000,
+    'QUEUE_SIZE': 100,
+    'HEARTBEAT': 15.0,
+    'OCCUPANCY_WINDOW': timedelta(hours=1),
+    'OCCUPANCY_INTERVAL': 60.0,
+}
+
 CORS_ORIGIN_ALLOW_ALL = True #change this to CORS_ORIGIN_WHITELIST = ('http://localhost:8080','http://127.0.0.1:9000')
 
 ROOT_URLCONF = 'backend.urls'
@@ -94,13 +190,88 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# Every SQLite connection is tuned with SQLITE_PRAGMAS when it opens and kept for CONN_MAX_AGE seconds.
+# WAL lets readers run alongside the single writer; "python manage.py bench_sqlite_writers" compares this
+# against stock settings.
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    # Safe with WAL: a power loss can drop the last commits but never corrupts the database
+    'synchronous': 'NORMAL',
+    # Milliseconds a writer waits for the lock before failing with "database is locked"
+    'busy_timeout': 5000,
+    # Negative sizes are in KiB
+    'cache_size': -20000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+
+
+def sqlite_database(name, **extra):
+    return dict({
+        'ENGINE': 'checkin.backends.sqlite3',
+        'NAME': name,
+        'CONN_MAX_AGE': 600,
+        'PRAGMAS': SQLITE_PRAGMAS,
+        'IMMEDIATE_TRANSACTIONS': True,
+    }, **extra)
+
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': str(os.path.join(BASE_DIR, "db.sqlite3"))
-    }
+    'default': sqlite_database(str(os.path.join(BASE_DIR, "db.sqlite3")))
+}
+
+# Read replicas
+# CHECKIN_REPLICA_DATABASES lists comma separated SQLite files kept in sync with the primary, e.g. by
+# litestream or periodic snapshots. List views read from them unless the user wrote within STICKY_SECONDS
+# or the replica misses writes committed on the primary more than MAX_LAG_SECONDS ago.
+
+REPLICA_DATABASES = [name for name in os.environ.get('CHECKIN_REPLICA_DATABASES', '').split(',') if name]
+
+for i, name in enumerate(REPLICA_DATABASES, 1):
+    DATABASES['replica%d' % i] = sqlite_database(name, TEST={'MIRROR': 'default'})
+
+DATABASE_REPLICATION = {
+    'REPLICAS': ['replica%d' % i for i in range(1, len(REPLICA_DATABASES) + 1)],
+    'STICKY_SECONDS': 10,
+    # Keep above LAG_CHECK_INTERVAL, as the primary's heartbeat is only stamped once per check
+    'MAX_LAG_SECONDS': 30,
+    # Seconds between lag checks of each replica
+    'LAG_CHECK_INTERVAL': 5,
+}
+
+# Visit shards
+# CHECKIN_VISIT_SHARD_DATABASES lists comma separated SQLite files that hold Visit and UnregisteredVisit rows
+# alongside default, each business's visits on one shard with the visit summaries counted from them. Run
+# "python manage.py rebalance_visit_shards" after changing the list.
+
+VISIT_SHARD_DATABASES = [name for name in os.environ.get('CHECKIN_VISIT_SHARD_DATABASES', '').split(',') if name]
+
+for i, name in enumerate(VISIT_SHARD_DATABASES, 1):
+    DATABASES['visits%d' % i] = sqlite_database(name)
+
+VISIT_SHARDS = ['default'] + ['visits%d' % i for i in range(1, len(VISIT_SHARD_DATABASES) + 1)]
+
+# A check-in by the same customer at the same business within WINDOW of an earlier one is merged into it rather
+# than stored again; a WINDOW of 0 or None turns this off. The latest check-in per pair is kept in CACHE for one
+# window, which must be shared between worker processes to save them the database lookup.
+DUPLICATE_CHECKINS = {
+    'WINDOW': timedelta(minutes=int(os.environ.get('CHECKIN_DUPLICATE_WINDOW_MINUTES', '10'))),
+    'CACHE': 'default',
+}
+
+# Customers who checked in at the same business within WINDOW of each other are joined in a contact graph, kept
+# up to date by a job per new visit. Tracing walks at most MAX_DEPTH hops and stops widening after MAX_CONTACTS
+# customers; BATCH_SIZE bounds the ids in each query.
+CONTACT_GRAPH = {
+    'WINDOW': timedelta(hours=1),
+    'MAX_DEPTH': 3,
+    'MAX_CONTACTS': 10000,
+    'BATCH_SIZE': 500,
 }
 
+DATABASE_ROUTERS = ['checkin.routers.ShardRouter', 'checkin.routers.ReplicaRouter']
+
 # User substitution
 # https://docs.djangoproject.com/en/1.11/topics/auth/customizing/#auth-custom-user
 
@@ -125,6 +296,17 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Staff create accounts in bulk with "python manage.py import_accounts" or by posting CSV, JSON lines or a JSON
+# list to checkin/<business|customer>/import_accounts/. Rows are inserted CHUNK_SIZE at a time. The command hashes
+# passwords with HASH_WORKERS processes (None for one per CPU, 0 to hash in its own process); the endpoint always
+# hashes in the web worker's own process. Responses list the first MAX_ERRORS rejected rows.
+
+ACCOUNT_IMPORT = {
+    'CHUNK_SIZE': 500,
+    'HASH_WORKERS': None,
+    'MAX_ERRORS': 1000,
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.1/topics/i18n/
@@ -143,3 +325,48 @@ USE_L10N = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Exposure notifications
+# Email goes through EMAIL_BACKEND; the file backend and FileSMSTransport keep everything local until real
+# gateways are configured.
+
+EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
+EMAIL_FILE_PATH = str(os.path.join(BASE_DIR, "sent_notifications", "email"))
+DEFAULT_FROM_EMAIL = 'noreply@checqin.ca'
+
+NOTIFICATIONS = {
+    'TRANSPORTS': {
+        'E': 'checkin.notifications.EmailTransport',
+        'P': 'checkin.notifications.FileSMSTransport',
+    },
+    'SMS_FILE_PATH': str(os.path.join(BASE_DIR, "sent_notifications", "sms.jsonl")),
+    'WORKERS': 4,
+    'BATCH_SIZE': 100,
+    # Messages per second for each channel
+    'RATE_LIMITS': {'E': 50, 'P': 10},
+    'MAX_ATTEMPTS': 5,
+    # Seconds before the first retry, doubled on each further attempt
+    'RETRY_BACKOFF': 30,
+    # Seconds a worker may hold a claimed batch before another worker can take it over
+    'CLAIM_TIMEOUT': 300,
+}
+
+
+# Background jobs
+# Workers are started with "python manage.py run_jobs"; EAGER runs jobs inline at enqueue time instead.
+
+JOB_QUEUE = {
+    'MODULES': ['checkin.tasks'],
+    'EAGER': False,
+    'WORKERS': 2,
+    'USE_PROCESSES': False,
+    'BATCH_SIZE': 10,
+    # Seconds an idle worker waits before polling again
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 5,
+    # Seconds before the first retry, doubled on each further attempt
+    'RETRY_BACKOFF': 10,
+    # Seconds a claimed job stays hidden from other workers before it is retried
+    'LEASE_TIMEOUT': 300,
+}
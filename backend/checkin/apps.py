@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class CheckinConfig(AppConfig):
     name = 'checkin'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from .slowqueries import install
+        connection_created.connect(install, dispatch_uid='checkin.slowqueries')
+        # Connects the receivers that drop cached profiles when they change
+        from . import profiles  # noqa: F401
@@ -0,0 +1,143 @@
+"""Record reads of other people's contact and visit data without making requests wait for the write.
+
+Events are buffered in memory and written in batches by a background thread, as soon as BATCH_SIZE events are
+waiting and otherwise every FLUSH_INTERVAL seconds, and once more when the process exits.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.utils import timezone
+
+from .models import AuditEvent
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'database',
+    'FILE_PATH': 'audit/access.jsonl',
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 5.0,
+    'MAX_BUFFER': 100000,
+    'BACKGROUND': True,
+}
+
+
+def audit_setting(name):
+    return getattr(settings, 'AUDIT_LOG', {}).get(name, DEFAULTS[name])
+
+
+def write_database(events):
+    AuditEvent.objects.bulk_create(events, batch_size=audit_setting('BATCH_SIZE'))
+
+
+def write_file(events):
+    path = audit_setting('FILE_PATH')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    lines = ''.join(json.dumps({
+        'actor': event.actor_id, 'action': event.action, 'subjects': event.subjects, 'detail': event.detail,
+        'created_date': event.created_date}, cls=DjangoJSONEncoder) + '\n' for event in events)
+    # One O_APPEND write per batch, so batches from several workers never interleave
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    try:
+        os.write(fd, lines.encode())
+    finally:
+        os.close(fd)
+
+
+BACKENDS = {
+    'database': write_database,
+    'file': write_file,
+}
+
+
+class AuditLog:
+    """Per process buffer of audit events with a flusher thread started on first use in each process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.buffer = deque()
+        self.dropped = 0
+        # The process whose events are buffered, and the one running the flusher thread
+        self.pid = None
+        self.flusher = None
+
+    def record(self, action, actor=None, subjects=(), **detail):
+        event = AuditEvent(actor_id=getattr(actor, 'pk', actor), action=action,
+                           subjects=[str(getattr(subject, 'pk', subject)) for subject in subjects],
+                           detail=detail, created_date=timezone.now())
+        if audit_setting('BACKGROUND'):
+            self.start()
+        with self.lock:
+            if self.pid != os.getpid():
+                # Events buffered by the parent before a fork are the parent's to write
+                self.buffer, self.pid = deque(), os.getpid()
+            if len(self.buffer) >= audit_setting('MAX_BUFFER'):
+                # The writer can't keep up; losing the oldest events beats holding up requests
+                self.buffer.popleft()
+                self.dropped += 1
+            self.buffer.append(event)
+            pending = len(self.buffer)
+        if pending >= audit_setting('BATCH_SIZE'):
+            self.wake.set()
+
+    def start(self):
+        if self.flusher == os.getpid():
+            return
+        with self.lock:
+            if self.flusher == os.getpid():
+                return
+            self.flusher = os.getpid()
+            threading.Thread(target=self.run, name='audit-flusher', daemon=True).start()
+
+    def run(self):
+        while True:
+            self.wake.wait(audit_setting('FLUSH_INTERVAL'))
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing audit events failed; they will be retried')
+            finally:
+                connection.close()
+
+    def flush(self):
+        """Write every buffered event; failed batches go back to the front of the buffer."""
+        with self.flush_lock:
+            with self.lock:
+                events, self.buffer = list(self.buffer), deque()
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                logger.error('Dropped %d audit events because the buffer was full', dropped)
+            if not events:
+                return 0
+            try:
+                BACKENDS[audit_setting('BACKEND')](events)
+            except Exception:
+                with self.lock:
+                    self.buffer.extendleft(reversed(events))
+                raise
+            return len(events)
+
+
+audit_log = AuditLog()
+
+
+@atexit.register
+def flush_at_exit():
+    # A forked child's inherited events are the parent's; the recording process writes its own, flusher or not
+    if audit_log.pid != os.getpid() or not audit_log.buffer:
+        return
+    try:
+        audit_log.flush()
+    except Exception:
+        logger.exception('Writing audit events at exit failed')
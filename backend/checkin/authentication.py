@@ -0,0 +1,16 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt import authentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .revocation import issued_at, revocations
+
+
+class JWTAuthentication(authentication.JWTAuthentication):
+    """Reject access tokens issued before the user's last deactivation or password change."""
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if revocations.is_revoked(token[api_settings.USER_ID_CLAIM], issued_at(token)):
+            raise InvalidToken(_('Token has been revoked'))
+        return token
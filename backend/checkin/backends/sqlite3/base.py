@@ -0,0 +1,35 @@
+"""SQLite backend that tunes each new connection with the PRAGMAS from its DATABASES entry.
+
+Set 'IMMEDIATE_TRANSACTIONS' to take the write lock when an atomic block begins. Two deferred
+transactions that both read and then write otherwise fail with "database is locked" instead of
+waiting out the busy timeout.
+"""
+
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+PRAGMA_NAME = re.compile(r'^[a-z_]+$')
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+
+def apply_pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        if not PRAGMA_NAME.match(name) or not PRAGMA_VALUE.match(str(value)):
+            raise ImproperlyConfigured('Invalid SQLite pragma %s = %r' % (name, value))
+        conn.execute('PRAGMA %s = %s' % (name, value))
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        apply_pragmas(conn, self.settings_dict.get('PRAGMAS', {}))
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.settings_dict.get('IMMEDIATE_TRANSACTIONS'):
+            self.cursor().execute('BEGIN IMMEDIATE')
+        else:
+            super()._start_transaction_under_autocommit()
@@ -0,0 +1,119 @@
+"""The co-visit contact graph: customers who checked in at the same business within WINDOW of each other.
+
+Edges are added by a job queued for each new visit, so contacts of contacts are a breadth-first walk over the
+Contact index, one query per hop, rather than a chain of visit queries per case. Walk-in visits without an
+account have no customer to connect and are left out.
+"""
+
+import uuid
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Greatest
+
+from .audit import audit_log
+from .models import AuditEvent, Contact, Visit
+
+DEFAULTS = {
+    'WINDOW': timedelta(hours=1),
+    'MAX_DEPTH': 3,
+    'MAX_CONTACTS': 10000,
+    'BATCH_SIZE': 500,
+}
+
+
+def contact_setting(name):
+    return getattr(settings, 'CONTACT_GRAPH', {}).get(name, DEFAULTS[name])
+
+
+def chunked(ids, size):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def add_visit(visit):
+    """Connect the visit's customer to everyone else at its business within the window. Returns how many."""
+    window = contact_setting('WINDOW')
+    others = list(Visit.objects.for_business(visit.business_id)
+                  .filter(dateTime__range=(visit.dateTime - window, visit.dateTime + window))
+                  .exclude(customer_id=visit.customer_id).order_by().values_list('customer_id', flat=True).distinct())
+    with transaction.atomic():
+        for chunk in chunked(others, contact_setting('BATCH_SIZE')):
+            # Move existing edges forward, then insert the rest; the unique index drops those already there
+            Contact.objects.filter(customer_id=visit.customer_id, contact_id__in=chunk) \
+                .update(last_contact=Greatest('last_contact', visit.dateTime))
+            Contact.objects.filter(customer_id__in=chunk, contact_id=visit.customer_id) \
+                .update(last_contact=Greatest('last_contact', visit.dateTime))
+            Contact.objects.bulk_create(
+                [edge for other in chunk for edge in (
+                    Contact(customer_id=visit.customer_id, contact_id=other, last_contact=visit.dateTime),
+                    Contact(customer_id=other, contact_id=visit.customer_id, last_contact=visit.dateTime))],
+                ignore_conflicts=True)
+    return len(others)
+
+
+def rebuild(batch_size=None):
+    """Recompute every edge from the stored visits, streaming each shard once in (business, dateTime) order.
+
+    Adding a visit's edges takes the default database's write lock, so none are lost while the rebuild holds
+    it. Returns how many edges were written, counting each direction.
+    """
+    window = contact_setting('WINDOW')
+    latest = {}
+    with transaction.atomic():
+        for alias in settings.VISIT_SHARDS:
+            rows = Visit.objects.using(alias).order_by('business_id', 'dateTime') \
+                .values_list('business_id', 'customer_id', 'dateTime')
+            business_id, recent = None, deque()
+            for row_business_id, customer_id, date_time in rows.iterator():
+                if row_business_id != business_id:
+                    business_id, recent = row_business_id, deque()
+                while recent and recent[0][1] < date_time - window:
+                    recent.popleft()
+                for other, other_time in recent:
+                    if other != customer_id:
+                        latest[(customer_id, other) if customer_id < other else (other, customer_id)] = date_time
+                recent.append((customer_id, date_time))
+        Contact.objects.all().delete()
+        Contact.objects.bulk_create(
+            (Contact(customer_id=customer_id, contact_id=contact_id, last_contact=last_contact)
+             for (first, second), last_contact in latest.items()
+             for customer_id, contact_id in ((first, second), (second, first))),
+            batch_size=batch_size or contact_setting('BATCH_SIZE'))
+    return len(latest) * 2
+
+
+def purge(before):
+    """Drop edges whose last contact is older than before, as purged visits can no longer back them."""
+    deleted, _ = Contact.objects.filter(last_contact__lt=before).delete()
+    return deleted
+
+
+def trace(customer_ids, depth, since=None, actor=None):
+    """Customers within depth hops of the given ones, mapped to their hop count, which is 0 for the starting
+    customers. Only edges with a contact since the given time are followed.
+
+    Each hop costs one query per BATCH_SIZE customers on its frontier. Depth is capped at MAX_DEPTH, and no
+    further hop is taken once MAX_CONTACTS customers have been found.
+    """
+    hops = {uuid.UUID(str(customer_id)): 0 for customer_id in customer_ids}
+    frontier = list(hops)
+    for hop in range(1, min(depth, contact_setting('MAX_DEPTH')) + 1):
+        if not frontier or len(hops) >= contact_setting('MAX_CONTACTS'):
+            break
+        reached = []
+        for chunk in chunked(frontier, contact_setting('BATCH_SIZE')):
+            edges = Contact.objects.filter(customer_id__in=chunk)
+            if since is not None:
+                edges = edges.filter(last_contact__gte=since)
+            for contact_id in edges.values_list('contact_id', flat=True):
+                if contact_id not in hops:
+                    hops[contact_id] = hop
+                    reached.append(contact_id)
+        frontier = reached
+    audit_log.record(AuditEvent.TRACE, actor, [customer_id for customer_id, hop in hops.items() if hop],
+                     sources=[str(customer_id) for customer_id, hop in hops.items() if not hop], depth=depth,
+                     since=None if since is None else str(since))
+    return hops
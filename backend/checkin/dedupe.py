@@ -0,0 +1,35 @@
+"""Each customer's latest check-in per business, kept in the cache for one dedupe window.
+
+A second scan, or a staff entry for a visit the customer already recorded, is merged into the first visit when
+it falls within WINDOW of it. The cache answers that without touching the database; Visit.objects.record falls
+back to an indexed query when the entry is missing, e.g. after a restart or on another worker.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULTS = {
+    'WINDOW': timedelta(minutes=10),
+    'CACHE': 'default',
+}
+
+
+def dedupe_setting(name):
+    return getattr(settings, 'DUPLICATE_CHECKINS', {}).get(name, DEFAULTS[name])
+
+
+def cache_key(customer_id, business_id):
+    return 'recent_checkin:%s:%s' % (customer_id, business_id)
+
+
+def recent(customer_id, business_id):
+    """The cached (shard alias, visit id, dateTime, numVisitors) of the customer's latest check-in, or None."""
+    return caches[dedupe_setting('CACHE')].get(cache_key(customer_id, business_id))
+
+
+def remember(visit, alias):
+    caches[dedupe_setting('CACHE')].set(cache_key(visit.customer_id, visit.business_id),
+                                        (alias, visit.pk, visit.dateTime, visit.numVisitors),
+                                        int(dedupe_setting('WINDOW').total_seconds()) or None)
@@ -0,0 +1,312 @@
+"""Server-sent event streams of each business's check-ins and occupancy, served straight from the ASGI app.
+
+Every worker process runs one change feed that tails the visit tables of each shard and publishes new rows
+to an in-process hub. The hub hands each event to the subscribers of its business through a bounded queue;
+a subscriber that can't keep up loses its oldest events and is told to resync, so one slow screen never
+holds up the others or grows memory without bound.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import uuid
+from datetime import timedelta
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max, Q, Sum
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import visitor_log
+from .audit import audit_log
+from .authentication import JWTAuthentication
+from .models import AuditEvent, Business, ShardMove, UnregisteredVisit, Visit
+from .sharding import shard_for_business
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'POLL_INTERVAL': 1.0,
+    'BATCH_SIZE': 1000,
+    'QUEUE_SIZE': 100,
+    'HEARTBEAT': 15.0,
+    'OCCUPANCY_WINDOW': timedelta(hours=1),
+    'OCCUPANCY_INTERVAL': 60.0,
+}
+
+STREAM_PATH = re.compile(r'^/checkin/business/(?P<business>[^/]+)/events/$')
+
+
+def event_setting(name):
+    return getattr(settings, 'EVENT_STREAM', {}).get(name, DEFAULTS[name])
+
+
+def format_event(name, data, event_id=None):
+    lines = ['event: ' + name]
+    if event_id is not None:
+        lines.append('id: ' + event_id)
+    lines.append('data: ' + json.dumps(data, cls=DjangoJSONEncoder))
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+class Subscription:
+    """One connected screen. Events past QUEUE_SIZE push out the oldest ones."""
+
+    def __init__(self, business_id):
+        self.business_id = business_id
+        self.queue = asyncio.Queue(event_setting('QUEUE_SIZE'))
+        self.dropped = 0
+
+    def offer(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+
+class EventHub:
+    """Subscribers by business; only used from the event loop thread, so it needs no locks."""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.occupancy = {}
+
+    def subscribe(self, business_id):
+        subscription = Subscription(business_id)
+        self.subscribers.setdefault(business_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscribers = self.subscribers.get(subscription.business_id, set())
+        subscribers.discard(subscription)
+        if not subscribers:
+            self.subscribers.pop(subscription.business_id, None)
+            self.occupancy.pop(subscription.business_id, None)
+
+    def publish(self, business_id, event, source=None):
+        """Queue event for the business's subscribers; source is the (kind, id) of the visit it reports."""
+        for subscription in self.subscribers.get(business_id, ()):
+            subscription.offer((source, event))
+
+    def publish_occupancy(self, business_id, visitors):
+        """Send the occupancy only when it changed since the last one sent."""
+        if business_id in self.subscribers and self.occupancy.get(business_id) != visitors:
+            self.occupancy[business_id] = visitors
+            self.publish(business_id, format_event('occupancy', {'visitors': visitors}))
+
+
+def occupancy(business_ids):
+    """Visitors checked in within OCCUPANCY_WINDOW at each business, two grouped queries per shard."""
+    since = timezone.now() - event_setting('OCCUPANCY_WINDOW')
+    by_shard = {}
+    for business_id in business_ids:
+        by_shard.setdefault(shard_for_business(business_id), []).append(business_id)
+    totals = dict.fromkeys(business_ids, 0)
+    for alias, ids in by_shard.items():
+        for model in (Visit, UnregisteredVisit):
+            rows = model.objects.using(alias).filter(business_id__in=ids, dateTime__gte=since) \
+                .values('business_id').annotate(visitors=Sum('numVisitors')).values_list('business_id', 'visitors')
+            for business_id, visitors in rows:
+                totals[str(business_id)] += visitors
+    return totals
+
+
+class ChangeFeed:
+    """Tail both visit tables of every shard by id and turn new rows into events for subscribed businesses."""
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.last_ids = None
+        self.occupancy_refreshed = 0.0
+
+    def start_positions(self):
+        return {alias: [model.objects.using(alias).aggregate(last=Max('pk'))['last'] or 0
+                        for kind, model in visitor_log.SOURCES] for alias in settings.VISIT_SHARDS}
+
+    def poll(self, subscribed):
+        """New rows since the last poll as (business_id, (kind, id), event) triples, for subscribed businesses only."""
+        events = []
+        copies = ShardMove.objects.copies()
+        for alias, last_ids in self.last_ids.items():
+            rows = []
+            for kind, model in visitor_log.SOURCES:
+                # Visits that rebalancing copied onto the shard were streamed when they were first stored
+                batch = list(model.objects.using(alias).filter(pk__gt=last_ids[kind])
+                             .exclude(copies.get((model._meta.model_name, alias), Q(pk__in=[])))
+                             .order_by('pk')[:event_setting('BATCH_SIZE')])
+                rows.extend((kind, row) for row in batch)
+            wanted = [(kind, row) for kind, row in rows if str(row.business_id) in subscribed]
+            represented = visitor_log.represent([{'key': (None, kind, row.pk), 'row': row} for kind, row in wanted])
+            visits = iter(represented)
+            for kind, row in rows:
+                # The event id is a visitor log tail cursor, so a reconnecting screen can resume from it
+                last_ids[kind] = row.pk
+                if str(row.business_id) in subscribed:
+                    events.append((str(row.business_id), (kind, row.pk),
+                                   format_event('checkin', next(visits), visitor_log.encode_tail(tuple(last_ids)))))
+        return events
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(event_setting('POLL_INTERVAL'))
+            if not self.hub.subscribers:
+                # Nobody is listening, so skip the backlog rather than reading it when someone connects
+                self.last_ids = None
+                continue
+            try:
+                if self.last_ids is None:
+                    self.last_ids = await sync_to_async(self.start_positions)()
+                    self.occupancy_refreshed = loop.time()
+                    continue
+                subscribed = set(self.hub.subscribers)
+                events = await sync_to_async(self.poll)(subscribed)
+                for business_id, source, event in events:
+                    self.hub.publish(business_id, event, source)
+                changed = {business_id for business_id, _, _ in events}
+                # Visits also age out of the occupancy window, so every business is recounted now and then
+                if loop.time() - self.occupancy_refreshed >= event_setting('OCCUPANCY_INTERVAL'):
+                    self.occupancy_refreshed, changed = loop.time(), subscribed
+                totals = await sync_to_async(occupancy)(changed) if changed else {}
+            except Exception:
+                logger.exception('Polling for visit events failed')
+                continue
+            for business_id, visitors in totals.items():
+                self.hub.publish_occupancy(business_id, visitors)
+
+
+def authenticate(raw_token, business_id):
+    """The business's user for a valid access token belonging to it, otherwise None."""
+    authentication = JWTAuthentication()
+    try:
+        user = authentication.get_user(authentication.get_validated_token(raw_token))
+    except AuthenticationFailed:
+        return None
+    if str(user.pk) != business_id or not Business.objects.filter(pk=user.pk).exists():
+        return None
+    audit_log.record(AuditEvent.VISITOR_LOG, user, (), stream=True)
+    return user
+
+
+def catch_up(business_id, since):
+    """One batch of the events missed since the tail cursor since, the cursor after them and whether more remain.
+
+    Rows go out in id order per source, like the change feed's, so each event's id is a cursor covering every
+    event before it and a screen that drops again part way through resumes without repeats.
+    """
+    limit = event_setting('BATCH_SIZE')
+    results, _ = visitor_log.tail(business_id, since, limit)
+    results.sort(key=lambda entry: entry['key'][1:])
+    last_ids = list(since)
+    events = []
+    for entry, visit in zip(results, visitor_log.represent(results)):
+        kind, pk = entry['key'][1:]
+        last_ids[kind] = pk
+        events.append(format_event('checkin', visit, visitor_log.encode_tail(tuple(last_ids))))
+    # Each source returns at most limit rows, so a shorter batch means both are exhausted
+    return events, tuple(last_ids), len(results) >= limit
+
+
+class EventStreamApplication:
+    """ASGI app that answers GET /checkin/business/<id>/events/ itself and passes every other request on.
+
+    Browsers' EventSource can't set headers, so the access token may also be given as ?token=.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.hub = EventHub()
+        self.feed = None
+        self.feed_task = None
+        self.feed_loop = None
+
+    async def __call__(self, scope, receive, send):
+        match = STREAM_PATH.match(scope['path']) if scope['type'] == 'http' else None
+        if match is None:
+            return await self.application(scope, receive, send)
+        try:
+            business_id = str(uuid.UUID(match.group('business')))
+        except ValueError:
+            return await self.respond(send, 404)
+        return await self.stream(business_id, scope, receive, send)
+
+    def start_feed(self):
+        # One feed per event loop: each worker process, and each loop a test runs the app in
+        loop = asyncio.get_event_loop()
+        if self.feed_loop is not loop or self.feed_task.done():
+            self.feed_loop, self.feed = loop, ChangeFeed(self.hub)
+            self.feed_task = loop.create_task(self.feed.run())
+
+    async def respond(self, send, status, body=b''):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def stream(self, business_id, scope, receive, send):
+        headers = dict(scope['headers'])
+        raw_token = parse_qs(scope['query_string'].decode()).get('token', [''])[0]
+        authorization = headers.get(b'authorization', b'').decode().split()
+        if len(authorization) == 2 and authorization[0] == 'Bearer':
+            raw_token = authorization[1]
+        if scope['method'] != 'GET':
+            return await self.respond(send, 405)
+        if not raw_token or await sync_to_async(authenticate)(raw_token, business_id) is None:
+            return await self.respond(send, 403, b'{"detail": "Not allowed to follow this business."}')
+
+        try:
+            since = visitor_log.decode_tail(headers.get(b'last-event-id', b'').decode())
+        except ValueError:
+            since = None
+
+        # Subscribe before catching up, so check-ins polled meanwhile are queued rather than missed
+        self.start_feed()
+        subscription = self.hub.subscribe(business_id)
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no')]})
+            more = since is not None
+            while more:
+                missed, since, more = await sync_to_async(catch_up)(business_id, since)
+                for chunk in missed:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            visitors = (await sync_to_async(occupancy)([business_id]))[business_id]
+            self.hub.occupancy[business_id] = visitors
+            await send({'type': 'http.response.body', 'body': format_event('occupancy', {'visitors': visitors}),
+                        'more_body': True})
+            await self.relay(subscription, disconnected, send, since)
+        finally:
+            self.hub.unsubscribe(subscription)
+            disconnected.cancel()
+
+    async def relay(self, subscription, disconnected, send, caught_up=None):
+        """Pass queued events on, skipping check-ins already sent while catching up to the tail cursor caught_up."""
+        while True:
+            received = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait({received, disconnected}, timeout=event_setting('HEARTBEAT'),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                received.cancel()
+                return
+            if received not in done:
+                received.cancel()
+                # Comments keep proxies from closing an idle stream and reveal dead connections
+                await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                continue
+            source, chunk = received.result()
+            if source is not None and caught_up is not None and source[1] <= caught_up[source[0]]:
+                continue
+            if subscription.dropped:
+                chunk = format_event('lagged', {'dropped': subscription.dropped}) + chunk
+                subscription.dropped = 0
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
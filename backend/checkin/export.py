@@ -0,0 +1,156 @@
+"""Snapshots of visits and businesses as date-partitioned gzipped CSV, so reports run off the serving database.
+
+Each run streams only the visits added since the last run, found by the highest id exported per table and
+shard, and writes them as new part files under <DIRECTORY>/<table>/date=<day of the visit>/; earlier files are
+never rewritten. Businesses are few and change in place, so every run writes all of them under the run's date.
+Walk-ins' names and phone numbers stay behind: analysts get ids, not contact details.
+
+Part files are written under a temporary name and renamed once the whole run has succeeded, then the watermarks
+are saved. A crash between the two repeats the run's rows next time, which the (shard, id) columns identify.
+"""
+
+import csv
+import gzip
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .audit import audit_log
+from .models import AuditEvent, Business, ShardMove, UnregisteredVisit, Visit
+from .routers import replica_reads
+
+DEFAULTS = {
+    'DIRECTORY': 'exports',
+    'CHUNK_SIZE': 2000,
+    'MAX_OPEN_FILES': 32,
+}
+
+VISIT_FIELDS = ['id', 'dateTime', 'customer_id', 'business_id', 'numVisitors']
+BUSINESS_FIELDS = ['user_id', 'name', 'city', 'province', 'postal_code', 'capacity']
+
+SHARDED_TABLES = OrderedDict([
+    ('visit', Visit),
+    ('unregistered_visit', UnregisteredVisit),
+])
+
+TEMPORARY_SUFFIX = '.tmp'
+
+
+def export_setting(name):
+    return getattr(settings, 'SNAPSHOT_EXPORT', {}).get(name, DEFAULTS[name])
+
+
+class PartitionWriter:
+    """One table's part files for a run, one per date partition, with at most MAX_OPEN_FILES open at a time."""
+
+    def __init__(self, directory, table, run, header):
+        self.directory = Path(directory, table)
+        self.run = run
+        self.header = header
+        self.open = OrderedDict()
+        self.paths = []
+
+    def write(self, day, row):
+        writer = self.open.get(day)
+        if writer is None:
+            writer = self.open[day] = self.start(day)
+        else:
+            self.open.move_to_end(day)
+        writer[1].writerow(row)
+
+    def start(self, day):
+        if len(self.open) >= export_setting('MAX_OPEN_FILES'):
+            self.open.popitem(last=False)[1][0].close()
+        partition = self.directory / ('date=%s' % day.isoformat())
+        partition.mkdir(parents=True, exist_ok=True)
+        # A partition closed to make room gets another part file if more of its rows turn up
+        path = partition / ('part-%s-%d.csv.gz%s' % (self.run, len(self.paths), TEMPORARY_SUFFIX))
+        self.paths.append(path)
+        file = gzip.open(path, 'wt', newline='')
+        writer = csv.writer(file)
+        writer.writerow(self.header)
+        return file, writer
+
+    def close(self):
+        for file, writer in self.open.values():
+            file.close()
+        self.open.clear()
+
+
+class SnapshotExport:
+    """One run of the export into DIRECTORY. Call run() to write the new rows and advance the watermarks."""
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory or export_setting('DIRECTORY'))
+        self.manifest = self.directory / 'watermarks.json'
+
+    def watermarks(self):
+        if not self.manifest.exists():
+            return {}
+        return json.loads(self.manifest.read_text())
+
+    def run(self, actor=None):
+        """Export everything new since the last run. Returns the number of rows written per table."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for leftover in self.directory.glob('**/*' + TEMPORARY_SUFFIX):
+            # Part files of a run that failed; their rows are still past the watermark
+            leftover.unlink()
+        watermarks = self.watermarks()
+        started = timezone.now()
+        run = started.strftime('%Y%m%dT%H%M%S%f')
+        writers, counts = [], {}
+        token = replica_reads.set(True)
+        try:
+            for table, model in SHARDED_TABLES.items():
+                writer = PartitionWriter(self.directory, table, run, ['shard'] + VISIT_FIELDS)
+                writers.append(writer)
+                counts[table] = self.export_sharded(table, model, writer, watermarks)
+            writer = PartitionWriter(self.directory, 'business', run, BUSINESS_FIELDS)
+            writers.append(writer)
+            counts['business'] = self.export_businesses(writer, started.date())
+        finally:
+            replica_reads.reset(token)
+            for writer in writers:
+                writer.close()
+        for writer in writers:
+            for path in writer.paths:
+                os.replace(path, str(path)[:-len(TEMPORARY_SUFFIX)])
+        saving = self.manifest.with_name(self.manifest.name + TEMPORARY_SUFFIX)
+        saving.write_text(json.dumps(watermarks, indent=2, sort_keys=True))
+        os.replace(saving, self.manifest)
+        audit_log.record(AuditEvent.EXPORT, actor, directory=str(self.directory), rows=counts,
+                         watermarks=watermarks)
+        return counts
+
+    def export_sharded(self, table, model, writer, watermarks):
+        """Stream one visit table's new rows from every shard in id order, moving each shard's watermark."""
+        exported = 0
+        copies = ShardMove.objects.copies()
+        for alias in settings.VISIT_SHARDS:
+            key = '%s:%s' % (table, alias)
+            # Rows rebalancing copied here were exported from the shard they came from
+            new = model.objects.using(alias).filter(pk__gt=watermarks.get(key, 0)) \
+                .exclude(copies.get((model._meta.model_name, alias), Q(pk__in=[])))
+            # Rows committed while streaming wait for the next run rather than landing past the watermark
+            high = new.aggregate(high=Max('pk'))['high']
+            if high is None:
+                continue
+            rows = new.filter(pk__lte=high).order_by('pk').values_list(*VISIT_FIELDS)
+            for row in rows.iterator(chunk_size=export_setting('CHUNK_SIZE')):
+                writer.write(row[1].date(), (alias,) + row)
+                exported += 1
+            watermarks[key] = high
+        return exported
+
+    def export_businesses(self, writer, day):
+        exported = 0
+        rows = Business.objects.order_by('pk').values_list(*BUSINESS_FIELDS)
+        for row in rows.iterator(chunk_size=export_setting('CHUNK_SIZE')):
+            writer.write(day, row)
+            exported += 1
+        return exported
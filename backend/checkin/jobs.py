@@ -0,0 +1,135 @@
+"""Background jobs stored in the project database so request handlers can defer work and return."""
+
+import logging
+import threading
+import traceback
+import uuid
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MODULES': ['checkin.tasks'],
+    'EAGER': False,
+    'WORKERS': 2,
+    'USE_PROCESSES': False,
+    'BATCH_SIZE': 10,
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 5,
+    'RETRY_BACKOFF': 10,
+    'LEASE_TIMEOUT': 300,
+}
+
+REGISTRY = {}
+
+
+def job_setting(name):
+    return getattr(settings, 'JOB_QUEUE', {}).get(name, DEFAULTS[name])
+
+
+def job(func):
+    """Register func as a job handler under its own name."""
+    REGISTRY[func.__name__] = func
+    return func
+
+
+def load_tasks():
+    for module in job_setting('MODULES'):
+        import_module(module)
+
+
+def enqueue(name, delay=0, **payload):
+    """Queue a job for a worker; the payload must be JSON serializable."""
+    if job_setting('EAGER'):
+        load_tasks()
+        REGISTRY[name](**payload)
+        return None
+    return Job.objects.create(name=name, payload=payload, max_attempts=job_setting('MAX_ATTEMPTS'),
+                              available_date=timezone.now() + timedelta(seconds=delay))
+
+
+def claim(batch_size):
+    """Lease due jobs with a conditional UPDATE, which SQLite serializes, so each row goes to one worker."""
+    now = timezone.now()
+    due = Job.objects.filter(status__in=[Job.QUEUED, Job.RUNNING], available_date__lte=now)
+    ids = list(due.order_by('available_date').values_list('pk', flat=True)[:batch_size])
+    if not ids:
+        return []
+    token = uuid.uuid4()
+    due.filter(pk__in=ids).update(status=Job.RUNNING, claim=token, attempts=F('attempts') + 1,
+                                  available_date=now + timedelta(seconds=job_setting('LEASE_TIMEOUT')))
+    return list(Job.objects.filter(claim=token))
+
+
+def run(claimed):
+    """Run one claimed job, deleting it on success and backing off or dead-lettering it on failure.
+
+    The outcome is only written while this worker still holds the claim; once the lease has expired and another
+    worker has claimed the job, that worker's attempt decides what happens to it.
+    """
+    handler = REGISTRY.get(claimed.name)
+    held = Job.objects.filter(pk=claimed.pk, claim=claimed.claim)
+    try:
+        if handler is None:
+            raise LookupError('No job handler registered for ' + claimed.name)
+        if claimed.attempts > claimed.max_attempts:
+            raise RuntimeError('Lease expired on the final attempt')
+        handler(**claimed.payload)
+    except Exception:
+        claimed.last_error = traceback.format_exc()
+        if handler is None or claimed.attempts >= claimed.max_attempts:
+            claimed.status = Job.DEAD
+        else:
+            claimed.status = Job.QUEUED
+            backoff = job_setting('RETRY_BACKOFF') * 2 ** (claimed.attempts - 1)
+            claimed.available_date = timezone.now() + timedelta(seconds=backoff)
+        if not held.update(status=claimed.status, last_error=claimed.last_error,
+                           available_date=claimed.available_date):
+            logger.warning('Job %s %s was claimed by another worker before it failed here', claimed.name, claimed.pk)
+        elif claimed.status == Job.DEAD:
+            logger.error('Job %s %s moved to dead letters', claimed.name, claimed.pk)
+        return False
+    deleted, _ = held.delete()
+    if not deleted:
+        logger.warning('Job %s %s was claimed by another worker before it finished here', claimed.name, claimed.pk)
+    return True
+
+
+def work(burst=False, stop=None, batch_size=None, poll_interval=None):
+    """Claim and run jobs until stopped, or until the queue has nothing due when burst is set."""
+    load_tasks()
+    batch_size = batch_size or job_setting('BATCH_SIZE')
+    poll_interval = poll_interval or job_setting('POLL_INTERVAL')
+    stop = stop or threading.Event()
+    processed = 0
+    try:
+        while not stop.is_set():
+            try:
+                claimed = claim(batch_size)
+            except OperationalError as e:
+                logger.warning('Claiming jobs failed: %s', e)
+                claimed = []
+            if not claimed:
+                if burst:
+                    break
+                stop.wait(poll_interval)
+                continue
+            for each in claimed:
+                run(each)
+                processed += 1
+    finally:
+        connection.close()
+    return processed
+
+
+def requeue_dead():
+    return Job.objects.filter(status=Job.DEAD).update(status=Job.QUEUED, attempts=0, claim=None,
+                                                      available_date=timezone.now())
@@ -0,0 +1,81 @@
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from checkin import contacts
+from checkin.audit import audit_log
+from checkin.models import Contact, Customer, User
+
+
+class Command(BaseCommand):
+    help = 'Time bounded-depth contact traces against a large generated co-visit graph.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=200000)
+        parser.add_argument('--contacts', type=int, default=20, help='Average contacts per customer.')
+        parser.add_argument('--traces', type=int, default=200)
+        parser.add_argument('--batch-size', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        # A throwaway database file, so the benchmark never touches real accounts
+        directory = tempfile.TemporaryDirectory()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(directory.name, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            started = time.perf_counter()
+            ids = self.populate(options['customers'], options['contacts'], options['batch_size'])
+            self.stdout.write('Created {} customers and {} contact edges in {:.0f} s'.format(
+                len(ids), Contact.objects.count(), time.perf_counter() - started))
+            for depth in range(1, contacts.contact_setting('MAX_DEPTH') + 1):
+                self.report(ids, depth, options['traces'])
+            # Each trace is audited; write the events while their database still exists
+            audit_log.flush()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            directory.cleanup()
+
+    def populate(self, count, degree, batch_size):
+        rng = random.Random(0)
+        ids = []
+        for start in range(0, count, batch_size):
+            users = [User(email='bench%d@example.com' % i, email_key='bench%d@example.com' % i, password='!',
+                          is_customer=True) for i in range(start, min(start + batch_size, count))]
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+                Customer.objects.bulk_create(Customer(user=user, first_name='Bench', last_name='Customer',
+                                                      phone_num='1') for user in users)
+            ids.extend(user.pk for user in users)
+        # Most contacts are with neighbours in the id order, standing in for people who share venues
+        since = datetime(2021, 1, 1)
+        edges = {}
+        for i, customer_id in enumerate(ids):
+            for _ in range(degree // 2):
+                j = (i + rng.randint(1, 200)) % count if rng.random() < 0.9 else rng.randrange(count)
+                if j != i:
+                    edges[min(i, j), max(i, j)] = since + timedelta(minutes=rng.randrange(60 * 24 * 30))
+            if len(edges) >= batch_size or i == len(ids) - 1:
+                with transaction.atomic():
+                    Contact.objects.bulk_create(
+                        (Contact(customer_id=ids[a], contact_id=ids[b], last_contact=last_contact)
+                         for (first, second), last_contact in edges.items()
+                         for a, b in ((first, second), (second, first))),
+                        batch_size=batch_size, ignore_conflicts=True)
+                edges = {}
+        connection.cursor().execute('ANALYZE')
+        return ids
+
+    def report(self, ids, depth, traces):
+        rng = random.Random(depth)
+        timings, reached = [], 0
+        for _ in range(traces):
+            started = time.perf_counter()
+            reached += len(contacts.trace([rng.choice(ids)], depth))
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        self.stdout.write('depth {}: p50 {:6.1f} ms, p99 {:6.1f} ms, {:7.0f} customers reached on average'.format(
+            depth, timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.99)] * 1000, reached / traces))
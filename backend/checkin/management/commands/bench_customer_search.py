@@ -0,0 +1,73 @@
+import os
+import random
+import string
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from checkin import search
+from checkin.models import Customer, User
+
+NAMES = ['alex', 'ana', 'ben', 'chris', 'dana', 'eli', 'fatima', 'jun', 'li', 'maria', 'noah', 'omar', 'priya', 'sam']
+
+
+class Command(BaseCommand):
+    help = 'Time typeahead customer lookups by email and phone prefix against a large generated customer table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000000)
+        parser.add_argument('--lookups', type=int, default=2000)
+        parser.add_argument('--batch-size', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        # A throwaway database file, so the benchmark never touches real accounts
+        directory = tempfile.TemporaryDirectory()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(directory.name, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            started = time.perf_counter()
+            emails, phones = self.populate(options['customers'], options['batch_size'])
+            self.stdout.write('Created {} customers in {:.0f} s'.format(options['customers'],
+                                                                         time.perf_counter() - started))
+            for name, keys in (('email', emails), ('phone', phones)):
+                self.report(name, keys, options['lookups'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            directory.cleanup()
+
+    def populate(self, count, batch_size):
+        rng = random.Random(0)
+        emails, phones = [], []
+        for start in range(0, count, batch_size):
+            users, customers = [], []
+            for i in range(start, min(start + batch_size, count)):
+                email = '%s.%s%d@example.com' % (rng.choice(NAMES), ''.join(rng.choices(string.ascii_lowercase, k=4)), i)
+                phone = '%03d555%04d' % (rng.randint(200, 999), rng.randint(0, 9999))
+                user = User(email=email, email_key=email, password='!', is_customer=True)
+                users.append(user)
+                customers.append(Customer(user=user, first_name='Bench', last_name='Customer', phone_num=phone,
+                                          phone_key=phone))
+                if i % 1000 == 0:
+                    emails.append(email)
+                    phones.append(phone)
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+                Customer.objects.bulk_create(customers)
+        connection.cursor().execute('ANALYZE')
+        return emails, phones
+
+    def report(self, name, keys, lookups):
+        rng = random.Random(1)
+        timings = []
+        for _ in range(lookups):
+            key = rng.choice(keys)
+            prefix = key[:rng.randint(search.search_setting('MIN_PREFIX'), len(key) - 1)]
+            started = time.perf_counter()
+            search.search(prefix)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        self.stdout.write('{:>6}: p50 {:5.2f} ms, p99 {:5.2f} ms, max {:5.2f} ms over {} lookups'.format(
+            name, timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.99)] * 1000, timings[-1] * 1000,
+            lookups))
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import time
+import uuid
+
+from django.contrib.auth.hashers import MD5PasswordHasher
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from checkin.models import Customer, User
+from checkin.serializers import CustomerSerializer
+
+PROFILE = {'first_name': 'Bench', 'last_name': 'Mark', 'phone_num': '6135550100', 'contact_pref': 'P'}
+
+
+class CountingHasher(MD5PasswordHasher):
+    """A cheap hasher that counts its calls, so the timings show database work rather than PBKDF2."""
+
+    algorithm = 'counting_md5'
+    calls = 0
+
+    def encode(self, password, salt):
+        CountingHasher.calls += 1
+        return super().encode(password, salt)
+
+
+def legacy_sign_up(email, password):
+    """The previous create_account path: validate, create the user, then update_or_create the profile."""
+    CustomerSerializer(data={'user': {'email': email, 'password': password}, **PROFILE}).is_valid()
+    # The query the nested serializer's UniqueValidator used to run
+    if User.objects.filter(email=email).exists():
+        user = User.objects.get(email=email)
+        if user.is_active:
+            return
+        user.is_active = True
+        user.set_password(password)
+        customer = Customer.objects.get(user=user)
+        for name, value in PROFILE.items():
+            setattr(customer, name, value)
+        user.is_customer = True
+        user.save()
+        customer.save()
+        return
+    user = User.objects.create_user(email=email, password=password, is_customer=True)
+    Customer.objects.update_or_create(user=user, **PROFILE)
+
+
+def sign_up(email, password):
+    serializer = CustomerSerializer(data={'user': {'email': email, 'password': password}, **PROFILE})
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+
+
+PATHS = {'before': legacy_sign_up, 'after': sign_up}
+
+
+class Command(BaseCommand):
+    help = 'Compare queries, password hashes and time per customer sign-up for the old and new registration paths.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=200, help='Sign-ups per path and case.')
+
+    def handle(self, *args, **options):
+        # A throwaway database file, so the benchmark never touches real accounts but still pays for commits
+        directory = tempfile.TemporaryDirectory()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(directory.name, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(PASSWORD_HASHERS=['%s.CountingHasher' % __name__]):
+                for name, sign_up_with in PATHS.items():
+                    emails = ['%s-%s@example.com' % (name, uuid.uuid4().hex) for _ in range(options['count'])]
+                    self.report(name, 'new account', sign_up_with, emails)
+                    User.objects.filter(email__in=emails).update(is_active=False)
+                    self.report(name, 'reactivation', sign_up_with, emails)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            directory.cleanup()
+
+    def report(self, name, case, sign_up_with, emails):
+        CountingHasher.calls = 0
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            for email in emails:
+                sign_up_with(email, 'password')
+            elapsed = time.perf_counter() - started
+        self.stdout.write('{:>6} {:>12}: {:5.1f} queries, {:3.1f} hashes, {:6.2f} ms per sign-up'.format(
+            name, case, len(queries) / len(emails), CountingHasher.calls / len(emails), elapsed * 1000 / len(emails)))
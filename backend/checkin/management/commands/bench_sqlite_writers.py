@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from checkin.backends.sqlite3.base import apply_pragmas
+
+CONFIGS = {
+    # What Django does out of the box: rollback journal, deferred transactions, a new connection per request
+    'stock': {'pragmas': {}, 'immediate': False, 'persistent': False},
+    'tuned': {'pragmas': settings.SQLITE_PRAGMAS, 'immediate': True, 'persistent': True},
+}
+
+
+def connect(path, config):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA foreign_keys = ON')
+    apply_pragmas(conn, config['pragmas'])
+    return conn
+
+
+def check_in(conn, config, business_id):
+    """One check-in request: look the venue up and record the visit in a single transaction."""
+    conn.execute('BEGIN IMMEDIATE' if config['immediate'] else 'BEGIN')
+    try:
+        conn.execute('SELECT capacity FROM business WHERE id = ?', (business_id,)).fetchone()
+        conn.execute('INSERT INTO visit (business_id, customer_id, dateTime, numVisitors) VALUES (?, ?, ?, 1)',
+                     (business_id, uuid.uuid4().hex, time.time()))
+        conn.execute('COMMIT')
+    except sqlite3.OperationalError:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def writer(path, config, business_ids, seconds, results):
+    completed = locked = 0
+    conn = connect(path, config) if config['persistent'] else None
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if not config['persistent']:
+            conn = connect(path, config)
+        try:
+            check_in(conn, config, business_ids[completed % len(business_ids)])
+            completed += 1
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+        if not config['persistent']:
+            conn.close()
+    results.put((completed, locked))
+
+
+class Command(BaseCommand):
+    help = 'Measure concurrent check-in throughput and "database is locked" errors with stock and tuned SQLite.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help='Number of writer processes.')
+        parser.add_argument('--seconds', type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        for name, config in CONFIGS.items():
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'bench.sqlite3')
+                business_ids = self.create_schema(path, config)
+                results = multiprocessing.Queue()
+                writers = [multiprocessing.Process(target=writer,
+                                                   args=(path, config, business_ids, options['seconds'], results))
+                           for _ in range(options['writers'])]
+                for process in writers:
+                    process.start()
+                totals = [results.get() for _ in writers]
+                for process in writers:
+                    process.join()
+
+            completed = sum(result[0] for result in totals)
+            locked = sum(result[1] for result in totals)
+            attempts = completed + locked
+            self.stdout.write('{:>6}: {:8.1f} check-ins/s, {:6.2%} of attempts failed with database is locked'.format(
+                name, completed / options['seconds'], locked / attempts if attempts else 0))
+
+    def create_schema(self, path, config):
+        conn = connect(path, config)
+        conn.execute('CREATE TABLE business (id TEXT PRIMARY KEY, capacity INTEGER)')
+        conn.execute('CREATE TABLE visit (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'business_id TEXT REFERENCES business (id), customer_id TEXT, dateTime REAL, numVisitors INTEGER)')
+        conn.execute('CREATE INDEX visit_business ON visit (business_id, dateTime)')
+        business_ids = [uuid.uuid4().hex for _ in range(50)]
+        conn.executemany('INSERT INTO business VALUES (?, 100)', [(business_id,) for business_id in business_ids])
+        conn.close()
+        return business_ids
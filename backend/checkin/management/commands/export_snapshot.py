@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from checkin.export import SnapshotExport
+
+
+class Command(BaseCommand):
+    help = ('Append visits added since the last run, and the current businesses, to the date-partitioned gzipped '
+            'CSV snapshot. Meant to run nightly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help='Where to write the snapshot instead of SNAPSHOT_EXPORT[\'DIRECTORY\'].')
+
+    def handle(self, *args, **options):
+        export = SnapshotExport(options['directory'])
+        counts = export.run()
+        self.stdout.write(self.style.SUCCESS(
+            'Exported {visit} visits, {unregistered_visit} unregistered visits and {business} businesses to {}'
+            .format(export.directory, **counts)))
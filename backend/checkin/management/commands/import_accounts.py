@@ -0,0 +1,39 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from checkin import provisioning
+
+READERS = {'csv': provisioning.read_csv, 'jsonl': provisioning.read_jsonl}
+
+
+class Command(BaseCommand):
+    help = 'Create business or customer accounts in bulk from a CSV file with a header row or a JSON lines file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(provisioning.KINDS))
+        parser.add_argument('path', help='File to import, or - for standard input.')
+        parser.add_argument('--format', choices=sorted(READERS),
+                            help='Defaults to jsonl for .jsonl and .ndjson files and csv otherwise.')
+        parser.add_argument('--chunk-size', type=int, default=provisioning.import_setting('CHUNK_SIZE'))
+        parser.add_argument('--hash-workers', type=int, default=provisioning.import_setting('HASH_WORKERS'),
+                            help='Processes hashing passwords; 0 hashes in this process. Defaults to one per CPU.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        try:
+            lines = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(e)
+        with lines:
+            result = provisioning.AccountImport(options['kind'], options['chunk_size'],
+                                                options['hash_workers']).run(READERS[file_format](lines))
+
+        for error in result['errors']:
+            self.stderr.write(json.dumps(error))
+        if result['error_count'] > len(result['errors']):
+            self.stderr.write(f'... and {result["error_count"] - len(result["errors"])} more errors')
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {result["created"]} {options["kind"]} accounts, skipped {result["error_count"]} rows'))
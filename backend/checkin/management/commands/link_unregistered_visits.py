@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from checkin.models import Customer, UnregisteredVisit, User, normalize_phone
+
+
+class Command(BaseCommand):
+    help = 'Normalize stored phone numbers and emails and link unregistered visits to matching customer accounts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # Walk-ins live on their business's shard, so each shard is normalized in turn
+        for model, aliases in ((Customer, ['default']), (UnregisteredVisit, settings.VISIT_SHARDS)):
+            normalized = sum(self.normalize_phones(model.objects.using(alias), batch_size) for alias in aliases)
+            self.stdout.write(f'Normalized {normalized} {model._meta.verbose_name_plural} phone numbers')
+
+        stale = []
+        for user in User.objects.only('pk', 'email', 'email_key').iterator(chunk_size=batch_size):
+            if user.email_key != user.email.lower():
+                user.email_key = user.email.lower()
+                stale.append(user)
+        User.objects.bulk_update(stale, ['email_key'], batch_size=batch_size)
+        self.stdout.write(f'Normalized {len(stale)} user emails')
+
+        linked = UnregisteredVisit.objects.backfill_links(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Linked {linked} unregistered visits'))
+
+    @staticmethod
+    def normalize_phones(objects, batch_size):
+        stale = []
+        for obj in objects.only('pk', 'phone_num', 'phone_key').iterator(chunk_size=batch_size):
+            phone_key = normalize_phone(obj.phone_num)
+            if obj.phone_key != phone_key:
+                obj.phone_key = phone_key
+                stale.append(obj)
+        objects.bulk_update(stale, ['phone_key'], batch_size=batch_size)
+        return len(stale)
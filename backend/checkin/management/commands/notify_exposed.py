@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from checkin import contacts
+from checkin.models import Business, Customer
+from checkin.notifications import enqueue_exposure_notifications, exposed_customers
+
+
+class Command(BaseCommand):
+    help = 'Queue exposure notifications for every customer who visited a business during a time window.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('business', help='User id of the business where the exposure happened.')
+        parser.add_argument('start')
+        parser.add_argument('end')
+        parser.add_argument('--subject', default='Possible exposure')
+        parser.add_argument('--message', required=True)
+        parser.add_argument('--contact-depth', type=int, default=0,
+                            help='Also notify contacts of the exposed customers up to this many hops away.')
+
+    def handle(self, *args, **options):
+        start, end = parse_datetime(options['start']), parse_datetime(options['end'])
+        if start is None or end is None:
+            raise CommandError('start and end must be ISO 8601 datetimes')
+        try:
+            business = Business.objects.get(user__id=options['business'])
+        except Business.DoesNotExist:
+            raise CommandError('No business with id ' + options['business'])
+
+        customers = exposed_customers(business, start, end)
+        if options['contact_depth']:
+            hops = contacts.trace(list(customers.values_list('pk', flat=True)), options['contact_depth'], since=start)
+            customers = Customer.objects.filter(pk__in=list(hops))
+        queued = enqueue_exposure_notifications(customers, options['subject'], options['message'])
+        self.stdout.write(self.style.SUCCESS(f'Queued {len(queued)} notifications'))
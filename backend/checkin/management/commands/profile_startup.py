@@ -0,0 +1,70 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Runs in a fresh interpreter so nothing is imported yet; prints phase timings as JSON on stdout
+PROBE = '''
+import json, os, time
+started = time.perf_counter()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+import django
+from django.conf import settings
+settings.INSTALLED_APPS
+configured = time.perf_counter()
+django.setup()
+ready = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+routed = time.perf_counter()
+from wsgiref.util import setup_testing_defaults
+from django.core.handlers.wsgi import WSGIHandler
+environ = {"PATH_INFO": PATH, "HTTP_HOST": "localhost"}
+setup_testing_defaults(environ)
+WSGIHandler()(environ, lambda status, headers: None)
+first = time.perf_counter()
+print(json.dumps({"settings": configured - started, "apps_ready": ready - configured,
+                  "urlconf": routed - ready, "first_request": first - routed, "total": first - started}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Report per-module import time and the time to apps ready and to the first request.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters to time; the median is shown.')
+        parser.add_argument('--top', type=int, default=25, help='Number of slowest imports to list.')
+        parser.add_argument('--path', default='/checkin/business/', help='URL the first request is sent to.')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'backend.settings'))
+        runs = []
+        for _ in range(options['runs']):
+            probe = 'PATH = %r\n%s' % (options['path'], PROBE)
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe], cwd=settings.BASE_DIR,
+                                    env=env, capture_output=True, text=True, check=True)
+            runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+            imports = result.stderr
+
+        self.stdout.write('Startup phases (median of %d runs):' % len(runs))
+        for phase in runs[0]:
+            self.stdout.write('  %-14s %8.1f ms' % (phase, statistics.median(run[phase] for run in runs) * 1000))
+
+        self.stdout.write('\nSlowest imports by cumulative time (last run):')
+        self.stdout.write('  %10s %10s  %s' % ('self ms', 'cumul. ms', 'module'))
+        for self_us, cumulative_us, module in self.parse_importtime(imports)[:options['top']]:
+            self.stdout.write('  %10.1f %10.1f  %s' % (self_us / 1000, cumulative_us / 1000, module))
+
+    @staticmethod
+    def parse_importtime(output):
+        rows = []
+        for line in output.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            self_us, cumulative_us, module = line[len('import time:'):].split('|')
+            rows.append((int(self_us), int(cumulative_us), module.rstrip()))
+        return sorted(rows, key=lambda row: row[1], reverse=True)
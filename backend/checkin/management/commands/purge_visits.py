@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from checkin import contacts
+from checkin.models import Visit
+
+
+class Command(BaseCommand):
+    help = ('Delete registered visits older than the retention period, update the customers\' visit summaries and '
+            'drop contacts no longer backed by a visit.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, required=True, help='Keep visits from the last DAYS days.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        purged = Visit.objects.purge(before)
+        dropped = contacts.purge(before)
+        self.stdout.write(self.style.SUCCESS(f'Purged {purged} visits and {dropped} contact edges'))
@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Max
+
+from checkin.models import ShardMove, UnregisteredVisit, Visit, VisitSummary
+from checkin.sharding import shard_for_business
+
+
+class Command(BaseCommand):
+    help = 'Move visits onto the shard their business hashes to after settings.VISIT_SHARDS has changed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many visits would move.')
+        parser.add_argument('--retired', action='append', default=[], metavar='PATH',
+                            help='SQLite file of a shard removed from the list, to drain into the current shards.')
+
+    def handle(self, *args, **options):
+        sources = list(settings.VISIT_SHARDS)
+        for i, path in enumerate(options['retired'], 1):
+            alias = 'retired%d' % i
+            connections.databases[alias] = dict(connections.databases['default'], NAME=path)
+            connections.ensure_defaults(alias)
+            connections.prepare_test_settings(alias)
+            sources.append(alias)
+
+        for model in (Visit, UnregisteredVisit):
+            for source in sources:
+                business_ids = model.objects.using(source).values_list('business_id', flat=True).distinct()
+                for business_id in list(business_ids):
+                    target = shard_for_business(business_id)
+                    if target == source:
+                        continue
+                    if options['dry_run']:
+                        count = model.objects.using(source).filter(business_id=business_id).count()
+                    else:
+                        count = self.move(model, business_id, source, target, options['batch_size'])
+                    self.stdout.write(f'{model._meta.verbose_name_plural} of business {business_id}: '
+                                      f'{count} from {source} to {target}')
+
+        if not options['dry_run']:
+            # Visit summaries are kept per shard, so the moved visits are recounted where they now live
+            rebuilt = VisitSummary.objects.rebuild(batch_size=options['batch_size'])
+            self.stdout.write(f'Rebuilt {rebuilt} visit summaries')
+
+    def move(self, model, business_id, source, target, batch_size):
+        """Copy one batch at a time to the target shard before deleting it from the source.
+
+        Visits get new ids on the target shard, which are recorded as a ShardMove so the export and the change
+        feed don't take them for new check-ins. An interrupted run can leave one batch on both shards.
+        """
+        moved = 0
+        while True:
+            batch = list(model.objects.using(source).filter(business_id=business_id).order_by('pk')[:batch_size])
+            if not batch:
+                return moved
+            ids = [visit.pk for visit in batch]
+            for visit in batch:
+                visit.pk = None
+            # The target commits first, so a recorded range never covers ids the target could issue again
+            with transaction.atomic(), transaction.atomic(using=target):
+                model.objects.using(target).bulk_create(batch)
+                # Nothing else writes to the target while its transaction is open, so the new ids are consecutive
+                last_id = model.objects.using(target).aggregate(last=Max('pk'))['last']
+                ShardMove.objects.create(model_name=model._meta.model_name, shard=target,
+                                         first_id=last_id - len(batch) + 1, last_id=last_id, source=source)
+            with transaction.atomic(using=source):
+                model.objects.using(source).filter(pk__in=ids).delete()
+            moved += len(batch)
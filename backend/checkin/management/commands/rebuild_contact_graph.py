@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from checkin import contacts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the co-visit contact graph from the stored visits, e.g. after changing its window.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        written = contacts.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} contact edges'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from checkin.models import VisitSummary
+
+
+class Command(BaseCommand):
+    help = 'Recount every customer\'s visit summary from their stored visits, e.g. after a failed write.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rebuilt = VisitSummary.objects.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} visit summaries'))
@@ -0,0 +1,55 @@
+import multiprocessing
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from checkin import jobs
+
+
+def work_in_process(burst):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    jobs.work(burst=burst, stop=stop)
+
+
+class Command(BaseCommand):
+    help = 'Run background job workers from a pool of threads or processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=jobs.job_setting('WORKERS'))
+        parser.add_argument('--processes', action='store_true', default=jobs.job_setting('USE_PROCESSES'),
+                            help='Run each worker in its own process instead of a thread.')
+        parser.add_argument('--burst', action='store_true', help='Exit once no jobs are due.')
+        parser.add_argument('--requeue-dead', action='store_true', help='Give dead-lettered jobs another run first.')
+
+    def handle(self, *args, **options):
+        if options['requeue_dead']:
+            self.stdout.write(f'Requeued {jobs.requeue_dead()} dead jobs')
+
+        if options['processes']:
+            # Children must open their own database connections rather than share the parent's
+            connections.close_all()
+            workers = [multiprocessing.Process(target=work_in_process, args=(options['burst'],))
+                       for _ in range(options['workers'])]
+        else:
+            stop = threading.Event()
+            workers = [threading.Thread(target=jobs.work, kwargs={'burst': options['burst'], 'stop': stop})
+                       for _ in range(options['workers'])]
+
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping workers after their current jobs')
+            if options['processes']:
+                for worker in workers:
+                    worker.terminate()
+            else:
+                stop.set()
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from checkin.notifications import Dispatcher
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued exposure notifications in rate-limited batches per channel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int)
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--loop', action='store_true', help='Keep polling the queue instead of exiting once empty.')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between polls with --loop.')
+
+    def handle(self, *args, **options):
+        dispatcher = Dispatcher(workers=options['workers'], batch_size=options['batch_size'])
+        while True:
+            stats = dispatcher.run_once()
+            self.stdout.write(
+                'sent={sent} failed={failed} pending={pending} throughput={throughput:.1f}/s '
+                'queue_lag={queue_lag:.1f}s'.format(**stats))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,51 @@
+from rest_framework.permissions import SAFE_METHODS
+
+from .profiling import is_staff, profile_request, requested_mode
+from .routers import pin_to_primary
+from .slowqueries import current_view
+
+
+class ReplicaPinMiddleware:
+    """Pin a user's reads to the primary database after any successful write request they make."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # DRF copies the token-authenticated user back onto the Django request
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and response.status_code < 400 and user is not None \
+                and user.is_authenticated:
+            pin_to_primary(user.pk)
+        return response
+
+
+class ProfilingMiddleware:
+    """Run a staff user's request under cProfile when it carries the profiling header or query parameter."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = requested_mode(request)
+        if mode is None or not is_staff(request):
+            return self.get_response(request)
+        return profile_request(self.get_response, request, mode)
+
+
+class QueryAttributionMiddleware:
+    """Remember which view is running so slow queries can be traced back to it."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            current_view.set(None)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'view_class', view_func)
+        current_view.set('%s.%s' % (view.__module__, view.__qualname__))
@@ -1,9 +1,30 @@
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db import models
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, models, transaction
+from django.db.models import Count, F, Max
+from django.db.models.functions import Coalesce, Greatest
 from django.utils.translation import ugettext_lazy as _
 
+import heapq
+import re
 import uuid
 
+from . import dedupe
+from .sharding import fan_out, shard_for_business
+
+
+def normalize_phone(phone_num):
+    """Reduce a phone number to its bare digits, dropping a leading country code of 1."""
+    digits = re.sub(r'\D', '', str(phone_num or ''))
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    return digits
+
+
+class AccountExists(Exception):
+    """An active account already uses the email address."""
+
 
 class UserManager(BaseUserManager):
     """Define a model manager for User model with no username field."""
@@ -38,6 +59,46 @@ class UserManager(BaseUserManager):
 
         return self._create_user(email, password, **extra_fields)
 
+    def register(self, email, password, profile_model, profile_fields, **extra_fields):
+        """Create a user with its Customer or Business profile, or reactivate a deactivated one, atomically.
+
+        The password is hashed once, before the transaction, so the write lock is only held for one lookup by
+        email followed by two inserts, or two updates when a deactivated account signs up again. Returns the
+        profile and whether the account is new; raises AccountExists if an active user has the email.
+        """
+        if not email:
+            raise ValueError('The given email must be set')
+        email = self.normalize_email(email)
+        password = make_password(password)
+        try:
+            with transaction.atomic(using=self._db):
+                existing = self.filter(email=email).values_list('pk', 'is_active').first()
+                if existing is None:
+                    extra_fields.setdefault('is_staff', False)
+                    extra_fields.setdefault('is_superuser', False)
+                    user = self.model(email=email, password=password, **extra_fields)
+                    user.save(force_insert=True, using=self._db)
+                    profile = profile_model(user=user, **profile_fields)
+                    profile.save(force_insert=True, using=self._db)
+                    return profile, True
+
+                pk, is_active = existing
+                if is_active:
+                    raise AccountExists(email)
+                self.filter(pk=pk).update(is_active=True, password=password, **extra_fields)
+                profile = profile_model(user_id=pk, **profile_fields)
+                try:
+                    # A savepoint, as the failed save would otherwise doom the whole transaction
+                    with transaction.atomic(using=self._db):
+                        profile.save(update_fields=list(profile_fields), using=self._db)
+                except DatabaseError:
+                    # The deactivated account had the other kind of profile
+                    profile.save(force_insert=True, using=self._db)
+                return profile, False
+        except IntegrityError:
+            # Another sign-up with the same email committed between the lookup and the insert
+            raise AccountExists(email)
+
 
 class User(AbstractUser):
     """User model."""
@@ -52,6 +113,15 @@ class User(AbstractUser):
     objects = UserManager()
 
     is_customer = models.BooleanField(default=False) 
+    # Lowercased email, indexed so typeahead lookups can range scan it
+    email_key = models.EmailField(max_length=254, db_index=True, editable=False, blank=True)
+
+    def save(self, *args, **kwargs):
+        self.email_key = self.email.lower()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'email' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'email_key'}
+        super().save(*args, **kwargs)
 
 
 class Customer(models.Model):
@@ -59,6 +129,7 @@ class Customer(models.Model):
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     phone_num = models.CharField(max_length=11)
+    phone_key = models.CharField(max_length=11, db_index=True, editable=False, blank=True)
     created_date = models.DateTimeField(auto_now_add=True)
     email_verification = models.BooleanField(default=False)
 
@@ -68,6 +139,13 @@ class Customer(models.Model):
     ]
     contact_pref = models.CharField(max_length=1, choices=CONTACT_METHODS, default='P')
 
+    def save(self, *args, **kwargs):
+        self.phone_key = normalize_phone(self.phone_num)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'phone_num' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'phone_key'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.first_name + ' ' + self.last_name
 
@@ -87,24 +165,439 @@ class Business(models.Model):
         return self.name
 
 
+class ShardedVisitQuerySet(models.QuerySet):
+    """Queries over visits stored on the shard chosen by their business."""
+
+    def create(self, **kwargs):
+        if self._db is None:
+            return self.using(shard_for_business(kwargs.get('business_id') or kwargs['business'])).create(**kwargs)
+        return super().create(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if self._db is not None:
+            return super().bulk_create(objs, *args, **kwargs)
+        by_shard = {}
+        for obj in objs:
+            by_shard.setdefault(shard_for_business(obj.business_id), []).append(obj)
+        for alias, shard_objs in by_shard.items():
+            self.using(alias).bulk_create(shard_objs, *args, **kwargs)
+        return objs
+
+    def for_business(self, business_id):
+        """Filter to one business, reading only the shard that holds it."""
+        return self.using(shard_for_business(business_id)).filter(business_id=getattr(business_id, 'pk', business_id))
+
+    def across_shards(self, key=None, reverse=False):
+        """Evaluate the query on every shard in parallel; with key, merge the per-shard orderings."""
+        parts = fan_out(lambda alias: list(self.using(alias)))
+        if key is None:
+            return [obj for part in parts for obj in part]
+        return list(heapq.merge(*parts, key=key, reverse=reverse))
+
+    def update_across_shards(self, **kwargs):
+        return sum(fan_out(lambda alias: self.using(alias).update(**kwargs)))
+
+
+class UnregisteredVisitManager(models.Manager.from_queryset(ShardedVisitQuerySet)):
+    """Link walk-in visits to the customer account registered under the same phone number."""
+
+    def link_to_customer(self, customer):
+        """Attach every unlinked visit recorded under the customer's phone number, one UPDATE per shard."""
+        if not customer.phone_key:
+            return 0
+        return self.filter(phone_key=customer.phone_key, customer__isnull=True).update_across_shards(customer=customer)
+
+    def backfill_links(self, batch_size=500):
+        """Link all outstanding visits, oldest account first when several share a number."""
+        linked = 0
+        customers = Customer.objects.exclude(phone_key='').order_by('created_date').values_list('phone_key', 'pk')
+        batch = {}
+        for phone_key, customer_id in customers.iterator(chunk_size=batch_size):
+            batch.setdefault(phone_key, customer_id)
+            if len(batch) >= batch_size:
+                linked += sum(fan_out(lambda alias: self._link_batch(alias, batch, batch_size)))
+                batch = {}
+        if batch:
+            linked += sum(fan_out(lambda alias: self._link_batch(alias, batch, batch_size)))
+        return linked
+
+    def _link_batch(self, alias, customer_ids, batch_size):
+        visits = list(self.using(alias).filter(phone_key__in=customer_ids, customer__isnull=True).only('pk', 'phone_key'))
+        for visit in visits:
+            visit.customer_id = customer_ids[visit.phone_key]
+        self.using(alias).bulk_update(visits, ['customer'], batch_size=batch_size)
+        return len(visits)
+
+
 class UnregisteredVisit(models.Model):
     dateTime = models.DateTimeField(auto_now_add=False)
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     phone_num = models.CharField(max_length=11)
-    business = models.ForeignKey(Business, on_delete=models.PROTECT)
+    phone_key = models.CharField(max_length=11, db_index=True, editable=False, blank=True)
+    # Visits may live on a different shard from the accounts they reference, so the database can't enforce
+    # these relations; deleting an account only cascades to visits on the default shard.
+    business = models.ForeignKey(Business, on_delete=models.PROTECT, db_constraint=False)
+    customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False)
     numVisitors = models.IntegerField()
 
+    objects = UnregisteredVisitManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['business', 'dateTime']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.phone_key = normalize_phone(self.phone_num)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.first_name + ' ' + self.last_name + ' ' + self.phone_num + ' ' + self.business.__str__() + ' ' + self.dateTime.__str__()
 
 
+class VisitQuerySet(ShardedVisitQuerySet):
+    """Visits, which are counted in their customer's VisitSummary when recorded and when purged."""
+
+    def record(self, **kwargs):
+        """Create a visit and count it in one transaction on the visit's shard, which holds its counters too.
+
+        A check-in by the same customer at the same business within the DUPLICATE_CHECKINS window of an earlier
+        one is merged into it instead, keeping the larger party. Returns the visit and whether it was created.
+        """
+        # Visits created from raw request data may still hold the time as a string
+        kwargs['dateTime'] = self.model._meta.get_field('dateTime').to_python(kwargs['dateTime'])
+        customer_id = kwargs.get('customer_id') or kwargs['customer'].pk
+        business_id = kwargs.get('business_id') or kwargs['business'].pk
+        alias = shard_for_business(business_id)
+        window = dedupe.dedupe_setting('WINDOW')
+        # The shard's write lock is held from here, so concurrent duplicates can't both miss
+        with transaction.atomic(using=alias):
+            visit = self.duplicate(alias, customer_id, business_id, kwargs['dateTime'], window) if window else None
+            if visit is not None:
+                if kwargs['numVisitors'] > visit.numVisitors:
+                    visit.numVisitors = kwargs['numVisitors']
+                    self.using(alias).filter(pk=visit.pk).update(
+                        numVisitors=Greatest('numVisitors', kwargs['numVisitors']))
+                    transaction.on_commit(lambda: dedupe.remember(visit, alias), using=alias)
+                return visit, False
+            visit = self.using(alias).create(**kwargs)
+            VisitSummary.objects.count_visit(visit)
+            if window:
+                transaction.on_commit(lambda: dedupe.remember(visit, alias), using=alias)
+        return visit, True
+
+    def duplicate(self, alias, customer_id, business_id, date_time, window):
+        """The customer's visit to the business within window of date_time, from the recent check-in cache when
+        it has one and otherwise from the (customer, business, dateTime) index. Call inside a transaction on the
+        business's shard, whose commit caches what was found."""
+        cached = dedupe.recent(customer_id, business_id)
+        if cached is not None and cached[0] == alias and abs(cached[2] - date_time) <= window:
+            visit = self.model(pk=cached[1], customer_id=customer_id, business_id=business_id, dateTime=cached[2],
+                               numVisitors=cached[3])
+            visit._state.adding, visit._state.db = False, alias
+            return visit
+        visit = self.using(alias).filter(customer_id=customer_id, business_id=business_id,
+                                         dateTime__range=(date_time - window, date_time + window)) \
+            .order_by('dateTime').first()
+        if visit is not None:
+            transaction.on_commit(lambda: dedupe.remember(visit, alias), using=alias)
+        return visit
+
+    def purge(self, before):
+        """Delete visits from before the given time on every shard and take them off their customers' summaries.
+
+        Returns how many visits were deleted.
+        """
+        purged = 0
+        for alias in settings.VISIT_SHARDS:
+            old = self.using(alias).filter(dateTime__lt=before)
+            with transaction.atomic(using=alias):
+                counts = list(old.order_by().values('customer_id', 'business_id').annotate(visits=Count('pk'))
+                              .values_list('customer_id', 'business_id', 'visits'))
+                old.delete()
+                VisitSummary.objects.uncount_visits(counts, alias)
+            purged += sum(visits for customer_id, business_id, visits in counts)
+        return purged
+
+
 class Visit(models.Model):
     dateTime = models.DateTimeField(auto_now_add=False)
-    customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
-    business = models.ForeignKey(Business, on_delete=models.CASCADE)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, db_constraint=False)
+    business = models.ForeignKey(Business, on_delete=models.CASCADE, db_constraint=False)
 
     numVisitors = models.IntegerField()
 
+    objects = VisitQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['business', 'dateTime']),
+            models.Index(fields=['customer', 'business', 'dateTime']),
+        ]
+
     def __str__(self):
         return self.customer.__str__() + ' ' + self.business.__str__() + ' ' + self.dateTime.__str__()
+
+
+class VisitSummaryManager(models.Manager):
+    """Keep each customer's summary in step with their visits using conditional UPDATEs, so concurrent
+    check-ins add up without reading the counters first.
+
+    Counters live on the shard of the visits they count, one summary per customer and shard, so recording a
+    visit only takes its own shard's write lock. Each business's visits are on one shard, so venues never
+    overlap between a customer's summaries.
+    """
+
+    def for_customer(self, customer_id):
+        """The customer's summaries from every shard added up, or None if they have no visits."""
+        summaries = [summary for summary in fan_out(lambda alias: self.using(alias).filter(customer_id=customer_id)
+                                                    .first()) if summary is not None]
+        if not summaries:
+            return None
+        return VisitSummary(customer_id=customer_id,
+                            total_visits=sum(summary.total_visits for summary in summaries),
+                            venues_visited=sum(summary.venues_visited for summary in summaries),
+                            last_visit=max(summary.last_visit for summary in summaries))
+
+    def count_visit(self, visit):
+        alias, date_time = visit._state.db, visit.dateTime
+        new_venue = not CustomerVenue.objects.using(alias) \
+            .filter(customer_id=visit.customer_id, business_id=visit.business_id).update(visits=F('visits') + 1)
+        if new_venue:
+            CustomerVenue.objects.using(alias).create(customer_id=visit.customer_id, business_id=visit.business_id,
+                                                      visits=1)
+        updated = self.using(alias).filter(customer_id=visit.customer_id).update(
+            total_visits=F('total_visits') + 1, venues_visited=F('venues_visited') + int(new_venue),
+            last_visit=Greatest(Coalesce('last_visit', date_time), date_time))
+        if not updated:
+            self.using(alias).create(customer_id=visit.customer_id, total_visits=1, venues_visited=1,
+                                     last_visit=date_time)
+
+    def uncount_visits(self, counts, alias):
+        """Subtract visits purged from the shard, given as (customer id, business id, visits) triples.
+
+        Purges remove the oldest visits, so a customer's last visit only changes when none are left, and then
+        the summary goes too.
+        """
+        venues_on_shard = CustomerVenue.objects.using(alias)
+        totals = {}
+        for customer_id, business_id, visits in counts:
+            venues_on_shard.filter(customer_id=customer_id, business_id=business_id) \
+                .update(visits=F('visits') - visits)
+            totals[customer_id] = totals.get(customer_id, 0) + visits
+        emptied = venues_on_shard.filter(customer_id__in=totals, visits__lte=0)
+        venues = dict(emptied.order_by().values('customer_id').annotate(venues=Count('pk'))
+                      .values_list('customer_id', 'venues'))
+        emptied.delete()
+        for customer_id, visits in totals.items():
+            self.using(alias).filter(customer_id=customer_id).update(
+                total_visits=F('total_visits') - visits,
+                venues_visited=F('venues_visited') - venues.get(customer_id, 0))
+        self.using(alias).filter(customer_id__in=totals, total_visits__lte=0).delete()
+
+    def rebuild(self, batch_size=1000):
+        """Recount every summary from the visits with one grouped query per shard.
+
+        Each shard is recounted inside its own write transaction, so no visit can be recorded there meanwhile.
+        Returns how many summaries were written.
+        """
+        rebuilt = 0
+        for alias in settings.VISIT_SHARDS:
+            venues, summaries = [], {}
+            with transaction.atomic(using=alias):
+                rows = Visit.objects.using(alias).order_by().values('customer_id', 'business_id') \
+                    .annotate(visits=Count('pk'), last_visit=Max('dateTime')) \
+                    .values_list('customer_id', 'business_id', 'visits', 'last_visit')
+                for customer_id, business_id, visits, last_visit in rows.iterator():
+                    venues.append(CustomerVenue(customer_id=customer_id, business_id=business_id, visits=visits))
+                    summary = summaries.get(customer_id)
+                    if summary is None:
+                        summary = summaries[customer_id] = VisitSummary(customer_id=customer_id, total_visits=0,
+                                                                         venues_visited=0, last_visit=last_visit)
+                    summary.total_visits += visits
+                    summary.venues_visited += 1
+                    summary.last_visit = max(summary.last_visit, last_visit)
+                CustomerVenue.objects.using(alias).all().delete()
+                self.using(alias).all().delete()
+                CustomerVenue.objects.using(alias).bulk_create(venues, batch_size=batch_size)
+                self.using(alias).bulk_create(summaries.values(), batch_size=batch_size)
+            rebuilt += len(summaries)
+        return rebuilt
+
+
+class VisitSummary(models.Model):
+    """A customer's visit totals on one shard, kept up to date as visits are recorded and purged."""
+
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True, db_constraint=False)
+    total_visits = models.IntegerField(default=0)
+    venues_visited = models.IntegerField(default=0)
+    last_visit = models.DateTimeField(null=True, blank=True)
+
+    objects = VisitSummaryManager()
+
+    def __str__(self):
+        return self.customer_id.__str__() + ' ' + str(self.total_visits) + ' visits'
+
+
+class CustomerVenue(models.Model):
+    """How many of a customer's stored visits were to one business, so purges know when a venue drops out.
+    Kept on the shard of the business's visits."""
+
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, db_constraint=False)
+    business = models.ForeignKey(Business, on_delete=models.CASCADE, db_constraint=False)
+    visits = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'business'], name='unique_customer_venue'),
+        ]
+
+
+class Contact(models.Model):
+    """One direction of an edge in the co-visit graph: the customers checked in at the same business within the
+    contact window of each other, most recently at last_contact. Each edge is stored both ways round, so a
+    customer's contacts are one range of the unique index."""
+
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='contacts', db_index=False)
+    contact = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='+')
+    last_contact = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'contact'], name='unique_contact'),
+        ]
+
+
+class Notification(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed')
+    ]
+
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
+    channel = models.CharField(max_length=1, choices=Customer.CONTACT_METHODS)
+    recipient = models.CharField(max_length=254)
+    subject = models.CharField(max_length=150)
+    message = models.TextField()
+    status = models.CharField(max_length=7, choices=STATUSES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    claim = models.UUIDField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    available_date = models.DateTimeField()
+    sent_date = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'channel', 'available_date']),
+        ]
+
+    def __str__(self):
+        return self.get_channel_display() + ' to ' + self.recipient + ' (' + self.status + ')'
+
+
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DEAD = 'dead'
+    STATUSES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DEAD, 'Dead')
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=7, choices=STATUSES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField()
+    claim = models.UUIDField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    available_date = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_date']),
+        ]
+
+    def __str__(self):
+        return self.name + ' (' + self.status + ')'
+
+
+class ShardMoveManager(models.Manager):
+    def copies(self):
+        """Q objects matching the rows that rebalancing copied onto each shard, keyed by (model name, shard)."""
+        copies = {}
+        for model_name, shard, first_id, last_id in self.values_list('model_name', 'shard', 'first_id', 'last_id'):
+            copies[model_name, shard] = copies.get((model_name, shard), models.Q(pk__in=[])) \
+                | models.Q(pk__range=(first_id, last_id))
+        return copies
+
+
+class ShardMove(models.Model):
+    """Ids of visits that rebalancing copied onto a shard. They are new ids there for rows that were already
+    stored, so the change feed and the export skip them rather than take them for new check-ins."""
+    model_name = models.CharField(max_length=100)
+    shard = models.CharField(max_length=100)
+    first_id = models.IntegerField()
+    last_id = models.IntegerField()
+    source = models.CharField(max_length=100)
+    moved_date = models.DateTimeField(auto_now_add=True)
+
+    objects = ShardMoveManager()
+
+    def __str__(self):
+        return '%s %d-%d from %s to %s' % (self.model_name, self.first_id, self.last_id, self.source, self.shard)
+
+
+class Heartbeat(models.Model):
+    """A single row the replica lag monitor stamps on the primary. Replicas copy it along with everything else,
+    so the stamp a replica holds tells how far behind it is."""
+    beat = models.DateTimeField()
+
+    def __str__(self):
+        return self.beat.__str__()
+
+
+class TokenRevocation(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    # Tokens issued before this second are rejected
+    revoked_date = models.DateTimeField()
+
+    def __str__(self):
+        return self.user.__str__() + ' ' + self.revoked_date.__str__()
+
+
+class AuditEvent(models.Model):
+    CUSTOMER_DETAIL = 'customer_detail'
+    CUSTOMER_LIST = 'customer_list'
+    TRACE = 'trace'
+    EXPORT = 'export'
+    VISITOR_LOG = 'visitor_log'
+    ACTIONS = [
+        (CUSTOMER_DETAIL, 'Customer detail'),
+        (CUSTOMER_LIST, 'Customer list'),
+        (TRACE, 'Contact trace'),
+        (EXPORT, 'Export'),
+        (VISITOR_LOG, 'Visitor log')
+    ]
+
+    # Audit records outlive the accounts they mention, so neither side is a real foreign key
+    actor = models.ForeignKey(User, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False,
+                              related_name='+')
+    action = models.CharField(max_length=20, choices=ACTIONS)
+    subjects = models.JSONField(default=list)
+    detail = models.JSONField(default=dict)
+    # When the data was read, not when the buffered event reached the table
+    created_date = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.get_action_display() + ' by ' + str(self.actor_id) + ' at ' + self.created_date.__str__()
@@ -0,0 +1,212 @@
+"""Queue exposure notifications and deliver them over each customer's preferred channel."""
+
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core import mail
+from django.db import connection, transaction
+from django.db.models import F, Min, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .audit import audit_log
+from .models import AuditEvent, Customer, Notification, Visit
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'TRANSPORTS': {
+        'E': 'checkin.notifications.EmailTransport',
+        'P': 'checkin.notifications.FileSMSTransport',
+    },
+    'SMS_FILE_PATH': 'sent_notifications/sms.jsonl',
+    'WORKERS': 4,
+    'BATCH_SIZE': 100,
+    'RATE_LIMITS': {},
+    'MAX_ATTEMPTS': 5,
+    'RETRY_BACKOFF': 30,
+    'CLAIM_TIMEOUT': 300,
+}
+
+
+def notification_setting(name):
+    return getattr(settings, 'NOTIFICATIONS', {}).get(name, DEFAULTS[name])
+
+
+def exposed_customers(business, start, end, actor=None):
+    """Customers who checked in at the business between start and end, read from the business's shard."""
+    customer_ids = list(Visit.objects.for_business(business.pk).filter(dateTime__range=(start, end))
+                        .values_list('customer_id', flat=True).distinct())
+    audit_log.record(AuditEvent.TRACE, actor, customer_ids, business=str(business.pk),
+                     start=str(start), end=str(end))
+    return Customer.objects.filter(pk__in=customer_ids)
+
+
+def enqueue_exposure_notifications(customers, subject, message):
+    """Queue one notification per active customer on the channel named by their contact_pref."""
+    now = timezone.now()
+    notifications = []
+    for customer in customers.filter(user__is_active=True).select_related('user'):
+        recipient = customer.user.email if customer.contact_pref == 'E' else customer.phone_key or customer.phone_num
+        notifications.append(Notification(customer=customer, channel=customer.contact_pref, recipient=recipient,
+                                          subject=subject, message=message, available_date=now))
+    return Notification.objects.bulk_create(notifications)
+
+
+class EmailTransport:
+    """Send a batch over a single connection to the configured EMAIL_BACKEND."""
+
+    def send_batch(self, notifications):
+        messages = [mail.EmailMessage(n.subject, n.message, to=[n.recipient]) for n in notifications]
+        mail.get_connection().send_messages(messages)
+
+
+class FileSMSTransport:
+    """Offline stand-in for an SMS gateway that appends each message to a JSON lines file."""
+
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.path = Path(settings.BASE_DIR, notification_setting('SMS_FILE_PATH'))
+
+    def send_batch(self, notifications):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        sent = timezone.now().isoformat()
+        lines = [json.dumps({'to': n.recipient, 'body': n.message, 'sent': sent}) + '\n' for n in notifications]
+        with self.lock, self.path.open('a') as sms_file:
+            sms_file.writelines(lines)
+
+
+class RateLimiter:
+    """Token bucket shared by every worker sending on one channel, refilled at rate messages per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count):
+        """Take count tokens, sleeping off any deficit so a batch larger than the bucket still goes out."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Dispatcher:
+    """Drain the notification queue with a pool of workers that claim and send batches per channel."""
+
+    def __init__(self, workers=None, batch_size=None):
+        self.workers = workers or notification_setting('WORKERS')
+        self.batch_size = batch_size or notification_setting('BATCH_SIZE')
+        self.transports = {channel: import_string(path)()
+                           for channel, path in notification_setting('TRANSPORTS').items()}
+        rates = notification_setting('RATE_LIMITS')
+        self.limiters = {channel: RateLimiter(rates.get(channel)) for channel in self.transports}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def claim_batch(self, channel):
+        """Lease up to batch_size due notifications with a conditional UPDATE so no two workers share a row."""
+        now = timezone.now()
+        due = Notification.objects.filter(Q(status=Notification.PENDING) | Q(status=Notification.SENDING),
+                                          channel=channel, available_date__lte=now)
+        ids = list(due.order_by('available_date').values_list('pk', flat=True)[:self.batch_size])
+        if not ids:
+            return []
+        claim = uuid.uuid4()
+        due.filter(pk__in=ids).update(status=Notification.SENDING, claim=claim,
+                                      available_date=now + timedelta(seconds=notification_setting('CLAIM_TIMEOUT')))
+        return list(Notification.objects.filter(claim=claim))
+
+    @staticmethod
+    def held(batch):
+        """The batch's rows that are still leased under its claim. Once CLAIM_TIMEOUT has passed another worker
+        may have claimed them again, and then that worker's attempt decides what happens to them."""
+        return Notification.objects.filter(pk__in=[n.pk for n in batch], claim=batch[0].claim)
+
+    def send_batch(self, channel, batch):
+        self.limiters[channel].acquire(len(batch))
+        try:
+            self.transports[channel].send_batch(batch)
+        except Exception as e:
+            logger.warning('Sending %d %s notifications failed: %s', len(batch), channel, e)
+            self.retry_later(batch, str(e))
+            return
+        sent = self.held(batch).update(status=Notification.SENT, sent_date=timezone.now(),
+                                       attempts=F('attempts') + 1)
+        if sent < len(batch):
+            logger.warning('%d of %d %s notifications were claimed by another worker before they were sent here',
+                           len(batch) - sent, len(batch), channel)
+        with self.lock:
+            self.sent += sent
+
+    def retry_later(self, batch, error):
+        now = timezone.now()
+        # The write lock is held from the lookup to the update, so no other worker can claim the rows in between
+        with transaction.atomic():
+            held = set(self.held(batch).values_list('pk', flat=True))
+            if len(held) < len(batch):
+                logger.warning('%d of %d notifications were claimed by another worker before they failed here',
+                               len(batch) - len(held), len(batch))
+            batch = [notification for notification in batch if notification.pk in held]
+            for notification in batch:
+                notification.attempts += 1
+                notification.last_error = error
+                if notification.attempts >= notification_setting('MAX_ATTEMPTS'):
+                    notification.status = Notification.FAILED
+                    with self.lock:
+                        self.failed += 1
+                else:
+                    notification.status = Notification.PENDING
+                    backoff = notification_setting('RETRY_BACKOFF') * 2 ** (notification.attempts - 1)
+                    notification.available_date = now + timedelta(seconds=backoff)
+            Notification.objects.bulk_update(batch, ['attempts', 'last_error', 'status', 'available_date'])
+
+    def drain(self, channel):
+        try:
+            while True:
+                batch = self.claim_batch(channel)
+                if not batch:
+                    return
+                self.send_batch(channel, batch)
+        finally:
+            connection.close()
+
+    def run_once(self):
+        """Send everything currently due and return throughput and queue-lag metrics."""
+        self.sent = self.failed = 0
+        started = time.monotonic()
+        channels = list(self.transports)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.drain, channels[i % len(channels)])
+                       for i in range(max(self.workers, len(channels)))]
+            for future in futures:
+                future.result()
+        elapsed = time.monotonic() - started
+        return dict(self.metrics(), sent=self.sent, failed=self.failed, elapsed=elapsed,
+                    throughput=self.sent / elapsed if elapsed else 0.0)
+
+    @staticmethod
+    def metrics():
+        pending = Notification.objects.filter(status__in=[Notification.PENDING, Notification.SENDING])
+        oldest = pending.aggregate(oldest=Min('created_date'))['oldest']
+        return {
+            'pending': pending.count(),
+            'queue_lag': (timezone.now() - oldest).total_seconds() if oldest else 0.0,
+        }
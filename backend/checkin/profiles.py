@@ -0,0 +1,88 @@
+"""Serialized customer and business profiles cached per id, shared by the detail and batch lookup views.
+
+Entries are dropped whenever the profile or its user is saved or deleted, so readers see the change on their
+next request. Ids that don't exist aren't cached, so an account is visible as soon as it is created.
+"""
+
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Business, Customer, User
+from .serializers import BusinessSerializer, CustomerSerializer
+
+DEFAULTS = {
+    'CACHE': 'default',
+    'TIMEOUT': 60,
+    'MAX_IDS': 100,
+}
+
+KINDS = {
+    'customer': (Customer, CustomerSerializer),
+    'business': (Business, BusinessSerializer),
+}
+
+
+def profile_setting(name):
+    return getattr(settings, 'PROFILE_CACHE', {}).get(name, DEFAULTS[name])
+
+
+def profile_cache():
+    return caches[profile_setting('CACHE')]
+
+
+def cache_key(kind, pk):
+    return 'profile:%s:%s' % (kind, pk)
+
+
+def parse_ids(values):
+    """Distinct ids in the order given, from a list of values that may each be comma separated; invalid ones
+    are dropped since they can't match a profile."""
+    ids = []
+    for value in values:
+        for part in value.split(','):
+            try:
+                pk = str(uuid.UUID(part.strip()))
+            except ValueError:
+                continue
+            if pk not in ids:
+                ids.append(pk)
+    return ids
+
+
+def get_many(kind, ids):
+    """Serialized profiles by id for the ids that exist, reading the database once for those not cached."""
+    model, serializer_class = KINDS[kind]
+    cache = profile_cache()
+    cached = cache.get_many([cache_key(kind, pk) for pk in ids])
+    found = {pk: cached[cache_key(kind, pk)] for pk in ids if cache_key(kind, pk) in cached}
+    missing = [pk for pk in ids if pk not in found]
+    if missing:
+        profiles = list(model.objects.select_related('user').filter(pk__in=missing))
+        fetched = {str(profile.pk): data for profile, data in zip(profiles, serializer_class(profiles, many=True).data)}
+        cache.set_many({cache_key(kind, pk): data for pk, data in fetched.items()}, profile_setting('TIMEOUT'))
+        found.update(fetched)
+    return found
+
+
+def invalidate(kinds, pk):
+    profile_cache().delete_many([cache_key(kind, pk) for kind in kinds])
+
+
+@receiver([post_save, post_delete], sender=Customer, dispatch_uid='checkin.profiles.customer')
+def customer_changed(sender, instance, **kwargs):
+    invalidate(['customer'], instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Business, dispatch_uid='checkin.profiles.business')
+def business_changed(sender, instance, **kwargs):
+    invalidate(['business'], instance.pk)
+
+
+@receiver([post_save, post_delete], sender=User, dispatch_uid='checkin.profiles.user')
+def user_changed(sender, instance, **kwargs):
+    # Both serializers nest the user, and the id alone doesn't say which kind of profile it has
+    invalidate(KINDS, instance.pk)
@@ -0,0 +1,73 @@
+"""Profile a single request on demand, for staff users who ask for it with a header or query parameter."""
+
+import cProfile
+import io
+import logging
+import pstats
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+
+from .authentication import JWTAuthentication
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'HEADER': 'X-Profile',
+    'QUERY_PARAM': '_profile',
+    'DIRECTORY': 'profiles',
+    'TOP': 30,
+}
+
+
+def profiling_setting(name):
+    return getattr(settings, 'REQUEST_PROFILING', {}).get(name, DEFAULTS[name])
+
+
+def requested_mode(request):
+    """'text' to return the report instead of the response, 'store' to save it, or None to not profile."""
+    header = 'HTTP_' + profiling_setting('HEADER').upper().replace('-', '_')
+    mode = request.META.get(header) or request.GET.get(profiling_setting('QUERY_PARAM'))
+    if not mode:
+        return None
+    return 'text' if mode == 'text' else 'store'
+
+
+def is_staff(request):
+    """Staff logged into the admin, or presenting a valid staff access token."""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.is_staff
+    try:
+        authenticated = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return authenticated is not None and authenticated[0].is_staff
+
+
+def report(profile, top=None):
+    """Top functions by cumulative time, followed by who called each of them."""
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out).strip_dirs().sort_stats('cumulative')
+    stats.print_stats(top or profiling_setting('TOP'))
+    stats.print_callers(top or profiling_setting('TOP'))
+    return out.getvalue()
+
+
+def profile_request(get_response, request, mode):
+    profile = cProfile.Profile()
+    response = profile.runcall(get_response, request)
+    if mode == 'text':
+        return HttpResponse(report(profile), content_type='text/plain; charset=utf-8')
+
+    directory = Path(profiling_setting('DIRECTORY'))
+    directory.mkdir(parents=True, exist_ok=True)
+    profile_id = uuid.uuid4().hex
+    # Load with pstats or a viewer such as snakeviz for the full call graph
+    profile.dump_stats(str(directory / ('%s.prof' % profile_id)))
+    logger.info('Profiled %s %s as %s', request.method, request.path, profile_id)
+    response['X-Profile-Id'] = profile_id
+    return response
@@ -0,0 +1,183 @@
+"""Create many business or customer accounts at once from CSV or JSON lines, for onboarding a whole site.
+
+Rows are validated one at a time as they are read and inserted in chunks, so an import of any size holds one
+chunk in memory. Each chunk costs one lookup of taken emails and two bulk inserts; the password hashes, which
+dominate the time, are spread over a process pool when importing from the command line. A bad row is reported
+and skipped without failing the rest.
+"""
+
+import codecs
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from rest_framework.parsers import BaseParser
+
+from .jobs import enqueue
+from .models import Business, Customer, User, normalize_phone
+from .serializers import BusinessSerializer, CustomerSerializer
+
+DEFAULTS = {
+    'CHUNK_SIZE': 500,
+    'HASH_WORKERS': None,
+    'MAX_ERRORS': 1000,
+}
+
+KINDS = {
+    'business': (Business, BusinessSerializer),
+    'customer': (Customer, CustomerSerializer),
+}
+
+
+def import_setting(name):
+    return getattr(settings, 'ACCOUNT_IMPORT', {}).get(name, DEFAULTS[name])
+
+
+def read_csv(lines):
+    """(line number, row) pairs from CSV text with a header row naming the fields."""
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_jsonl(lines):
+    """(line number, row) pairs from one JSON object per line; a row that isn't an object is None."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+def as_registration(row):
+    """A flat row with email and password columns in the nested shape create_account accepts."""
+    row = dict(row)
+    if 'user' not in row:
+        row['user'] = {'email': row.pop('email', None), 'password': row.pop('password', None)}
+    return row
+
+
+class AccountImport:
+    """One import of business or customer accounts. Call run() with (line number, row) pairs."""
+
+    def __init__(self, kind, chunk_size=None, hash_workers=None):
+        self.model, self.serializer_class = KINDS[kind]
+        self.chunk_size = chunk_size or import_setting('CHUNK_SIZE')
+        self.hash_workers = import_setting('HASH_WORKERS') if hash_workers is None else hash_workers
+        self.created = 0
+        self.errors = []
+        self.error_count = 0
+        self.seen = set()
+
+    def error(self, line, errors):
+        self.error_count += 1
+        if len(self.errors) < import_setting('MAX_ERRORS'):
+            self.errors.append({'line': line, 'errors': errors})
+
+    def validated(self, rows):
+        """Valid rows as (line, email, password, profile fields), each email once."""
+        for line, row in rows:
+            if row is None:
+                self.error(line, {'non_field_errors': ['Expected an object of account fields.']})
+                continue
+            serializer = self.serializer_class(data=as_registration(row))
+            if not serializer.is_valid():
+                self.error(line, serializer.errors)
+                continue
+            fields = dict(serializer.validated_data)
+            user = fields.pop('user')
+            fields.pop('email_verification', None)
+            email = User.objects.normalize_email(user['email'])
+            if email in self.seen:
+                self.error(line, {'email': ['Appears earlier in the import.']})
+                continue
+            self.seen.add(email)
+            yield line, email, user['password'], fields
+
+    def chunks(self, rows):
+        chunk = []
+        for row in self.validated(rows):
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run(self, rows):
+        if self.hash_workers == 0:
+            self.insert_all(rows, map)
+        else:
+            with ProcessPoolExecutor(self.hash_workers or os.cpu_count()) as pool:
+                self.insert_all(rows, pool.map)
+        return {'created': self.created, 'error_count': self.error_count, 'errors': self.errors}
+
+    def insert_all(self, rows, map_):
+        for chunk in self.chunks(rows):
+            taken = set(User.objects.filter(email__in=[email for line, email, password, fields in chunk])
+                        .values_list('email', flat=True))
+            for line, email, password, fields in chunk:
+                if email in taken:
+                    self.error(line, {'email': ['An account with this email address already exists.']})
+            chunk = [row for row in chunk if row[1] not in taken]
+            hashes = map_(make_password, [password for line, email, password, fields in chunk])
+            accounts = [(line, self.account(email, hashed, fields))
+                        for (line, email, password, fields), hashed in zip(chunk, hashes)]
+            self.insert(accounts)
+
+    def account(self, email, hashed, fields):
+        # bulk_create skips User.save and Customer.save
+        user = User(email=email, email_key=email.lower(), password=hashed, is_customer=self.model is Customer)
+        profile = self.model(user=user, **fields)
+        if self.model is Customer:
+            profile.phone_key = normalize_phone(profile.phone_num)
+        return user, profile
+
+    def insert(self, accounts):
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create([user for line, (user, profile) in accounts])
+                self.model.objects.bulk_create([profile for line, (user, profile) in accounts])
+        except IntegrityError:
+            # Someone signed up with one of the emails since the lookup; find it by inserting one at a time
+            inserted = []
+            for line, (user, profile) in accounts:
+                try:
+                    with transaction.atomic():
+                        user.save(force_insert=True)
+                        profile.save(force_insert=True)
+                    inserted.append((line, (user, profile)))
+                except IntegrityError:
+                    self.error(line, {'email': ['An account with this email address already exists.']})
+            accounts = inserted
+        self.created += len(accounts)
+        if self.model is Customer:
+            for line, (user, profile) in accounts:
+                enqueue('link_unregistered_visits', customer_id=str(user.pk))
+
+
+class CSVParser(BaseParser):
+    """Request bodies of CSV, parsed lazily into (line number, row) pairs."""
+
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        return read_csv(codecs.iterdecode(stream, encoding))
+
+
+class JSONLinesParser(BaseParser):
+    """Request bodies of one JSON object per line, parsed lazily into (line number, row) pairs."""
+
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        return read_jsonl(codecs.iterdecode(stream, encoding))
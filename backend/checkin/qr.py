@@ -0,0 +1,68 @@
+"""Signed, time-limited check-in tokens for the QR codes venues display."""
+
+import base64
+import io
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+SALT = 'checkin.qr.checkin-token'
+
+
+class InvalidCheckinToken(ValueError):
+    pass
+
+
+def token_lifetime():
+    return int(settings.CHECKIN_TOKEN_LIFETIME.total_seconds())
+
+
+def sign(business_id, expires):
+    digest = salted_hmac(SALT, f'{business_id}.{expires}', algorithm='sha256').digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def make_checkin_token(business_id, now=None):
+    """Sign the business id with an expiry at the end of the next lifetime window.
+
+    Every request within one window gets the same token, so a rendered QR code can be cached for the
+    whole window and stays valid for at least one lifetime after it is first shown.
+    """
+    lifetime = token_lifetime()
+    now = int(now if now is not None else time.time())
+    expires = (now // lifetime + 2) * lifetime
+    business_id = uuid.UUID(str(business_id)).hex
+    return f'{business_id}.{expires}.{sign(business_id, expires)}'
+
+
+def verify_checkin_token(token, now=None):
+    """Return the business id a token was issued for without touching the database."""
+    try:
+        business_id, expires, signature = token.split('.')
+        expires = int(expires)
+    except (AttributeError, ValueError):
+        raise InvalidCheckinToken('Malformed check-in token')
+    if not constant_time_compare(signature, sign(business_id, expires)):
+        raise InvalidCheckinToken('Check-in token signature does not match')
+    if expires <= (now if now is not None else time.time()):
+        raise InvalidCheckinToken('Check-in token has expired')
+    return uuid.UUID(business_id)
+
+
+def render_qr_code(token):
+    """Render a token as an SVG QR code, cached until the token expires."""
+    key = 'checkin:qr:' + token
+    image = cache.get(key)
+    if image is None:
+        import qrcode
+        import qrcode.image.svg
+
+        buffer = io.BytesIO()
+        qrcode.make(token, image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+        image = buffer.getvalue()
+        expires = int(token.split('.')[1])
+        cache.set(key, image, max(expires - int(time.time()), 1))
+    return image
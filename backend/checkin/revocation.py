@@ -0,0 +1,95 @@
+"""Revoke issued JWTs per user, with a Bloom filter that clears almost every request without a query."""
+
+import hashlib
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import TokenRevocation
+
+
+class BloomFilter:
+    """Set membership with no false negatives and a false positive rate near error_rate at capacity."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position // 8] |= 1 << position % 8
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & 1 << position % 8 for position in self.positions(key))
+
+
+def token_lifetimes():
+    return {
+        'access': api_settings.ACCESS_TOKEN_LIFETIME,
+        'refresh': api_settings.REFRESH_TOKEN_LIFETIME,
+    }
+
+
+def issued_at(token):
+    """simplejwt tokens carry no iat claim, so work it out from the expiry and the token type's lifetime."""
+    return token['exp'] - int(token_lifetimes()[token.token_type].total_seconds())
+
+
+class RevocationList:
+    """Per-process Bloom filter of users with recent revocations, rebuilt in each new worker process.
+
+    Revocations made by other workers reach this one on the next periodic rebuild.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.built = 0.0
+        self.filter = BloomFilter(1)
+
+    def rebuild(self):
+        # A revocation only matters until the longest-lived token issued before it has expired
+        cutoff = timezone.now() - max(token_lifetimes().values())
+        user_ids = list(TokenRevocation.objects.filter(revoked_date__gt=cutoff).values_list('user_id', flat=True))
+        config = settings.TOKEN_REVOCATION
+        bloom = BloomFilter(max(len(user_ids) * 2, config['CAPACITY']), config['ERROR_RATE'])
+        for user_id in user_ids:
+            bloom.add(user_id)
+        with self.lock:
+            self.filter, self.pid, self.built = bloom, os.getpid(), time.monotonic()
+
+    def might_be_revoked(self, user_id):
+        if self.pid != os.getpid() or time.monotonic() - self.built > settings.TOKEN_REVOCATION['REFRESH_INTERVAL']:
+            self.rebuild()
+        return str(user_id) in self.filter
+
+    def is_revoked(self, user_id, issued):
+        if not self.might_be_revoked(user_id):
+            return False
+        revoked_after = datetime.fromtimestamp(issued, tz=dt_timezone.utc)
+        if not settings.USE_TZ:
+            revoked_after = timezone.make_naive(revoked_after)
+        return TokenRevocation.objects.filter(user_id=user_id, revoked_date__gt=revoked_after).exists()
+
+    def revoke(self, user):
+        """Reject every token issued to user before the current second."""
+        TokenRevocation.objects.update_or_create(user=user, defaults={
+            'revoked_date': timezone.now().replace(microsecond=0)})
+        with self.lock:
+            self.filter.add(str(user.pk))
+
+
+revocations = RevocationList()
@@ -0,0 +1,170 @@
+"""Route visits to their shard and reads from list and analytics views to replica databases."""
+
+import contextvars
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.utils import timezone
+from rest_framework.permissions import SAFE_METHODS
+
+from .models import Heartbeat
+from .sharding import SHARDED_MODELS, shard_for_business
+
+logger = logging.getLogger(__name__)
+
+replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+
+def replication_setting(name):
+    return settings.DATABASE_REPLICATION[name]
+
+
+def pin_key(user_id):
+    return 'replica-pin:%s' % user_id
+
+
+def pin_to_primary(user_id):
+    """Send the user's reads to the primary until their own writes have had time to replicate."""
+    cache.set(pin_key(user_id), True, replication_setting('STICKY_SECONDS'))
+
+
+def is_pinned(user_id):
+    return cache.get(pin_key(user_id), False)
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'checkin' and model._meta.model_name in SHARDED_MODELS
+
+
+class ShardRouter:
+    """Send visit writes to their business's shard and keep every other model on default."""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and not is_sharded(model) and instance._state.db not in (None, 'default'):
+            # Following a foreign key out of a sharded visit
+            return 'default'
+        return None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        # Summaries have no business to go by and are always written to an explicit shard
+        if is_sharded(model) and isinstance(instance, model) and getattr(instance, 'business_id', None) is not None:
+            return shard_for_business(instance.business_id)
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded(type(obj1)) or is_sharded(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db != 'default' and db in settings.VISIT_SHARDS:
+            return app_label == 'checkin' and model_name in SHARDED_MODELS
+        return None
+
+
+class ReplicaLagMonitor:
+    """Check how far each replica trails the primary, at most once per LAG_CHECK_INTERVAL.
+
+    Each round of checks first stamps the time into the Heartbeat row on the primary. A replica's lag is the age of
+    the stamp it has copied, so a healthy replica holds every write committed on the primary more than
+    MAX_LAG_SECONDS ago, whichever tables it touched.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = {}
+        self.beaten = None
+
+    def beat(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.beaten is not None and now - self.beaten < replication_setting('LAG_CHECK_INTERVAL'):
+                return
+            self.beaten = now
+        stamp = timezone.now()
+        if not Heartbeat.objects.using('default').filter(pk=1).update(beat=stamp):
+            Heartbeat.objects.using('default').bulk_create([Heartbeat(pk=1, beat=stamp)], ignore_conflicts=True)
+
+    def lag(self, alias):
+        """Seconds since the primary stamped the heartbeat the replica holds, or None if it has none yet."""
+        beat = Heartbeat.objects.using(alias).filter(pk=1).values_list('beat', flat=True).first()
+        return None if beat is None else (timezone.now() - beat).total_seconds()
+
+    def is_healthy(self, alias):
+        now = time.monotonic()
+        with self.lock:
+            healthy, checked = self.checked.get(alias, (True, None))
+            if checked is not None and now - checked < replication_setting('LAG_CHECK_INTERVAL'):
+                return healthy
+            self.checked[alias] = (healthy, now)
+        try:
+            self.beat()
+        except DatabaseError as e:
+            logger.warning('Stamping the replication heartbeat failed: %s', e)
+        try:
+            lag = self.lag(alias)
+            healthy = lag is not None and lag <= replication_setting('MAX_LAG_SECONDS')
+            if not healthy:
+                logger.warning('Replica %s is %s seconds behind, reading from primary', alias,
+                               'unknown' if lag is None else '%.0f' % lag)
+        except DatabaseError as e:
+            logger.warning('Replica %s is unavailable, reading from primary: %s', alias, e)
+            healthy = False
+        with self.lock:
+            self.checked[alias] = (healthy, now)
+        return healthy
+
+
+class ReplicaRouter:
+    """Send reads made inside replica_reads to a healthy replica in turn and everything else to default."""
+
+    def __init__(self, replicas=None, monitor=None):
+        self.replicas = replicas if replicas is not None else replication_setting('REPLICAS')
+        self.monitor = monitor or ReplicaLagMonitor()
+        self.cycle = itertools.cycle(self.replicas)
+        self.lock = threading.Lock()
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or not replica_reads.get():
+            return None
+        for _ in range(len(self.replicas)):
+            # Requests on several threads share the rotation
+            with self.lock:
+                alias = next(self.cycle)
+            if self.monitor.is_healthy(alias):
+                return alias
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in self.replicas:
+            return False
+        return None
+
+
+class ReplicaReadMixin:
+    """Serve safe requests from a replica unless the requesting user wrote something moments ago."""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and not is_pinned(request.user.pk):
+            self.replica_token = replica_reads.set(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, 'replica_token', None)
+        if token is not None:
+            replica_reads.reset(token)
+            self.replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
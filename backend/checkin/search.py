@@ -0,0 +1,53 @@
+"""Typeahead lookup of customers by the start of their email address or phone number.
+
+Both keys are stored normalized and indexed, and a prefix becomes a range on the index, [prefix, successor),
+so a lookup reads only the first few matching index entries however many customers there are. SQLite's LIKE
+is case insensitive and can't use an ordinary index for this, which is why startswith isn't used.
+"""
+
+import re
+
+from django.conf import settings
+
+from .models import Customer
+
+DEFAULTS = {
+    'MIN_PREFIX': 3,
+    'MAX_RESULTS': 10,
+}
+
+LETTERS = re.compile(r'[^\d\s()+.-]')
+
+
+def search_setting(name):
+    return getattr(settings, 'CUSTOMER_SEARCH', {}).get(name, DEFAULTS[name])
+
+
+def prefix_range(field, prefix):
+    """Filter kwargs matching values of field that start with prefix, as one index range."""
+    return {field + '__gte': prefix, field + '__lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)}
+
+
+def parse_query(query):
+    """The indexed field to search and the normalized prefix to search it for."""
+    query = query.strip()
+    if LETTERS.search(query):
+        return 'user__email_key', query.lower()
+    digits = re.sub(r'\D', '', query)
+    # Area codes never start with 1, so a leading 1 is the country code even in a partial number
+    return 'phone_key', digits[1:] if digits.startswith('1') else digits
+
+
+def matching(field, prefix):
+    return Customer.objects.select_related('user').filter(user__is_active=True, **prefix_range(field, prefix)) \
+        .order_by(field)
+
+
+def search(query, limit=None):
+    """Up to limit active customers whose email, or phone number when query is only digits and punctuation,
+    starts with query, in key order. Prefixes shorter than MIN_PREFIX match nothing."""
+    limit = min(limit or search_setting('MAX_RESULTS'), search_setting('MAX_RESULTS'))
+    field, prefix = parse_query(query)
+    if len(prefix) < search_setting('MIN_PREFIX'):
+        return []
+    return list(matching(field, prefix)[:limit])
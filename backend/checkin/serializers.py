@@ -1,7 +1,12 @@
 from rest_framework import serializers
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 
-from .models import Customer, User, Business, Visit, UnregisteredVisit
+from .models import Customer, User, Business, Visit, UnregisteredVisit, normalize_phone
+from .qr import InvalidCheckinToken, verify_checkin_token
+from .revocation import issued_at, revocations
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
@@ -13,6 +18,14 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         return data
 
 
+class CustomTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        refresh = RefreshToken(attrs['refresh'])
+        if revocations.is_revoked(refresh[api_settings.USER_ID_CLAIM], issued_at(refresh)):
+            raise TokenError('Token has been revoked')
+        return super(CustomTokenRefreshSerializer, self).validate(attrs)
+
+
 class UserSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
@@ -22,6 +35,8 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'email', 'password']
+        # Sign-ups check the email inside the registration transaction instead of with a separate query
+        extra_kwargs = {'email': {'validators': []}}
 
 class DeactivateUserSerializer(serializers.Serializer):
 
@@ -48,12 +63,10 @@ class CustomerSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         user_data = validated_data.pop('user')
-        user_data['is_customer'] = True
-        user = UserSerializer.create(UserSerializer(), validated_data=user_data)
-        customer, created = Customer.objects.update_or_create(user=user, first_name=validated_data.pop('first_name'),
-                                                              last_name=validated_data.pop('last_name'),
-                                                              phone_num=validated_data.pop('phone_num'),
-                                                              contact_pref=validated_data.pop('contact_pref'))
+        # Customers verify their email afterwards rather than claiming it at sign-up
+        validated_data.pop('email_verification', None)
+        customer, created = User.objects.register(user_data['email'], user_data['password'], Customer,
+                                                  validated_data, is_customer=True)
         return customer
 
 
@@ -66,36 +79,36 @@ class BusinessSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         user_data = validated_data.pop('user')
-        user = UserSerializer.create(UserSerializer(), validated_data=user_data)
-        business, created = Business.objects.update_or_create(
-            user=user,
-            name=validated_data.pop('name'),
-            phone_num=validated_data.pop('phone_num'),
-            street_address=validated_data.pop('street_address'),
-            city=validated_data.pop('city'),
-            postal_code=validated_data.pop('postal_code'),
-            province=validated_data.pop('province'),
-            capacity=validated_data.pop('capacity'))
+        business, created = User.objects.register(user_data['email'], user_data['password'], Business,
+                                                  validated_data, is_customer=False)
         return business
 
 
 class VisitSerializer(serializers.ModelSerializer):
+    token = serializers.CharField(write_only=True, required=False)
 
     class Meta:
         model = Visit
-        fields = ['dateTime', 'customer', 'business', 'numVisitors']
-
-    def create(self, validated_data):
-
-        customer = Customer.objects.get(user__id=validated_data.pop("customer"))
-        business = Business.objects.get(user__id=validated_data.pop("business"))
+        fields = ['dateTime', 'customer', 'business', 'numVisitors', 'token']
+        extra_kwargs = {'business': {'required': False}}
 
-        visit = Visit.objects.create(
-            dateTime=validated_data.pop('dateTime'),
-            customer=customer,
-            business=business,
-            numVisitors=validated_data.pop('numVisitors'))
+    def validate(self, attrs):
+        # A scanned QR code names the venue through its signature, so the business only needs to be active
+        token = attrs.pop('token', None)
+        if token is not None:
+            try:
+                attrs['business_id'] = verify_checkin_token(token)
+            except InvalidCheckinToken as e:
+                raise serializers.ValidationError({'token': str(e)})
+            # Tokens outlive a venue's deactivation or deletion, and visits have no foreign key to catch it
+            if not Business.objects.filter(pk=attrs['business_id'], user__is_active=True).exists():
+                raise serializers.ValidationError({'token': 'This venue no longer accepts check-ins.'})
+        elif 'business' not in attrs:
+            raise serializers.ValidationError({'business': 'Either business or token is required.'})
+        return attrs
 
+    def create(self, validated_data):
+        visit, self.created = Visit.objects.record(**validated_data)
         return visit
 
 
@@ -108,13 +121,16 @@ class BusinessAddedUnregisteredVisitSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
 
         business = Business.objects.get(user__id=validated_data.pop("business"))
+        phone_num = validated_data.pop('phone_num')
+        customer = Customer.objects.filter(phone_key=normalize_phone(phone_num)).order_by('created_date').first()
 
         unregisteredvisit = UnregisteredVisit.objects.create(
             dateTime=validated_data.pop('dateTime'),
             first_name=validated_data.pop('first_name'),
             last_name=validated_data.pop('last_name'),
-            phone_num=validated_data.pop('phone_num'),
+            phone_num=phone_num,
             business=business,
+            customer=customer,
             numVisitors=validated_data.pop('numVisitors'))
 
         return unregisteredvisit
@@ -131,7 +147,7 @@ class BusinessAddedVisitSerializer(serializers.Serializer):
         customer = Customer.objects.get(user__email=validated_data.pop("customer"))
         business = Business.objects.get(user__id=validated_data.pop("business"))
 
-        visit = Visit.objects.create(
+        visit, self.created = Visit.objects.record(
             dateTime=validated_data.pop('dateTime'),
             customer=customer,
             business=business,
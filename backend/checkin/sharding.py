@@ -0,0 +1,38 @@
+"""Place visit rows on one of settings.VISIT_SHARDS by business, and run queries across every shard."""
+
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.db import connections
+
+# Visits and the counters kept from them
+SHARDED_MODELS = ('visit', 'unregisteredvisit', 'visitsummary', 'customervenue')
+
+
+def shard_for_business(business_id, shards=None):
+    """Pick a shard by rendezvous hashing, so adding a shard only moves the businesses it wins."""
+    shards = shards or settings.VISIT_SHARDS
+    if len(shards) == 1:
+        return shards[0]
+    key = uuid.UUID(str(getattr(business_id, 'pk', business_id))).bytes
+    return max(shards, key=lambda alias: hashlib.blake2b(key + alias.encode(), digest_size=8).digest())
+
+
+def fan_out(query, shards=None):
+    """Call query(alias) for every shard in parallel and return the results in shard order."""
+    shards = shards or settings.VISIT_SHARDS
+    if len(shards) == 1:
+        return [query(shards[0])]
+
+    def run(alias):
+        try:
+            return query(alias)
+        finally:
+            connections[alias].close()
+
+    # Single-shard deployments never get here, so they don't pay for importing the thread pool
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        return list(pool.map(run, shards))
@@ -0,0 +1,136 @@
+"""Log queries slower than a threshold, aggregated per normalized SQL with the view, call site and query plan."""
+
+import contextvars
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'THRESHOLD': None,
+    'MAX_FINGERPRINTS': 500,
+    'EXPLAIN': True,
+}
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Set by QueryAttributionMiddleware to the view handling the current request
+current_view = contextvars.ContextVar('current_view', default=None)
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+def slow_query_setting(name):
+    return getattr(settings, 'SLOW_QUERY_LOG', {}).get(name, DEFAULTS[name])
+
+
+def fingerprint(sql):
+    """SQL with literals and parameters replaced, so queries differing only in values share an entry."""
+    sql = sql.replace('%s', '?')
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = PLACEHOLDER_LIST.sub('(...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+
+def call_site():
+    """The innermost views or serializers frame, else the innermost frame in this app, as file:line in function."""
+    frame, site = sys._getframe(2), None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and filename != __file__:
+            here = '%s:%d in %s' % (os.path.relpath(filename, APP_DIR), frame.f_lineno, frame.f_code.co_name)
+            if os.path.basename(filename) in ('views.py', 'serializers.py'):
+                return here
+            site = site or here
+        frame = frame.f_back
+    return site
+
+
+def explain(connection, sql, params):
+    """The query plan for sql, read through a raw cursor so the plan query isn't logged itself."""
+    cursor = connection.create_cursor()
+    try:
+        cursor.execute('%s %s' % (connection.ops.explain_query_prefix(), sql), params)
+        return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+    except Exception as exc:
+        return ['EXPLAIN failed: %s' % exc]
+    finally:
+        cursor.close()
+
+
+class SlowQueryLog:
+    """Per process totals of slow queries, keyed by fingerprint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        threshold = slow_query_setting('THRESHOLD')
+        if threshold is None:
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            if duration >= threshold:
+                self.record(sql, params, many, duration, context['connection'])
+
+    def record(self, sql, params, many, duration, connection):
+        key = fingerprint(sql)
+        view = current_view.get()
+        site = call_site()
+        logger.warning('Slow query (%.1f ms) from %s at %s: %s', duration * 1000, view, site, key)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= slow_query_setting('MAX_FINGERPRINTS'):
+                    return
+                entry = self.entries[key] = {
+                    'fingerprint': key, 'count': 0, 'total_time': 0.0, 'max_time': 0.0,
+                    'views': {}, 'call_sites': {}, 'plan': None,
+                }
+            entry['count'] += 1
+            entry['total_time'] += duration
+            entry['max_time'] = max(entry['max_time'], duration)
+            entry['views'][view] = entry['views'].get(view, 0) + 1
+            entry['call_sites'][site] = entry['call_sites'].get(site, 0) + 1
+            needs_plan = entry['plan'] is None and not many and slow_query_setting('EXPLAIN') \
+                and sql.lstrip()[:6].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+            if needs_plan:
+                entry['plan'] = []
+
+        if needs_plan:
+            entry['plan'] = explain(connection, sql, params)
+
+    def report(self):
+        """Entries with the most total time first."""
+        with self.lock:
+            entries = [dict(entry, views=dict(entry['views']), call_sites=dict(entry['call_sites']))
+                       for entry in self.entries.values()]
+        return sorted(entries, key=lambda entry: entry['total_time'], reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+slow_queries = SlowQueryLog()
+
+
+def install(sender, connection, **kwargs):
+    """connection_created receiver that wraps every query run on the connection."""
+    if slow_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(slow_queries)
@@ -0,0 +1,19 @@
+"""Job handlers deferred from request handlers through checkin.jobs.enqueue."""
+
+from . import contacts
+from .jobs import job
+from .models import Customer, UnregisteredVisit, Visit
+
+
+@job
+def link_unregistered_visits(customer_id):
+    customer = Customer.objects.filter(pk=customer_id).first()
+    if customer is not None:
+        UnregisteredVisit.objects.link_to_customer(customer)
+
+
+@job
+def add_contacts(business_id, visit_id):
+    visit = Visit.objects.for_business(business_id).filter(pk=visit_id).first()
+    if visit is not None:
+        contacts.add_visit(visit)
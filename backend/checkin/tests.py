@@ -1,12 +1,113 @@
-from django.db import IntegrityError
-from django.test import TestCase
-from rest_framework import status
+import asyncio
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+from unittest import mock
+from datetime import timedelta
+from pathlib import Path
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core import mail
+from django.core.management import call_command
+from django.core.cache import caches
+from django.db import IntegrityError, connection, connections, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase as DjangoTestCase, TransactionTestCase as DjangoTransactionTestCase
+from django.utils import timezone
+from rest_framework import serializers, status
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
 from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.tokens import RefreshToken
 from django.test import Client
 from django.core.exceptions import ObjectDoesNotExist
 
-from .models import User, Customer, Business, Visit, UnregisteredVisit
+from .models import User, Customer, Business, Visit, UnregisteredVisit, Notification, Job, TokenRevocation, \
+    AuditEvent, Contact, CustomerVenue, Heartbeat, ShardMove, VisitSummary, normalize_phone
 from .views import CustomerCreate
+from . import contacts, dedupe, jobs, search, urls
+from .audit import audit_log, flush_at_exit
+from .events import EventStreamApplication, Subscription
+from .export import SnapshotExport
+from .notifications import Dispatcher, enqueue_exposure_notifications, exposed_customers
+from .profiles import profile_cache
+from .qr import InvalidCheckinToken, make_checkin_token, verify_checkin_token
+from .revocation import BloomFilter, revocations
+from .routers import ReplicaLagMonitor, ReplicaRouter, is_pinned, replica_reads
+from .sharding import shard_for_business
+from .slowqueries import fingerprint, slow_queries
+from .throttling import bucket
+
+
+class FreshStateMixin:
+    """Start each test with full throttle buckets, no cached profiles or recent check-ins and an empty audit
+    buffer, since they all outlive the per-test database. Audit events are only written when a test flushes them;
+    the rest are discarded after the test, so none are left for the exit flush to write to the real database."""
+
+    def _pre_setup(self):
+        super()._pre_setup()
+        caches[settings.THROTTLE_CACHE].clear()
+        profile_cache().clear()
+        caches[dedupe.dedupe_setting('CACHE')].clear()
+        audit_log.buffer.clear()
+
+    def _post_teardown(self):
+        audit_log.buffer.clear()
+        super()._post_teardown()
+
+
+@override_settings(AUDIT_LOG=dict(settings.AUDIT_LOG, BACKGROUND=False))
+class TestCase(FreshStateMixin, DjangoTestCase):
+    pass
+
+
+@override_settings(AUDIT_LOG=dict(settings.AUDIT_LOG, BACKGROUND=False))
+class TransactionTestCase(FreshStateMixin, DjangoTransactionTestCase):
+    pass
+
+
+def add_visit_shard(test, alias='visits1'):
+    """Add a second visit shard, migrated in a temporary file, for the rest of the test."""
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    connections.databases[alias] = dict(connections.databases['default'], NAME=str(Path(directory.name, alias)))
+    test.addCleanup(connections.databases.pop, alias)
+    test.addCleanup(connections.__delitem__, alias)
+    test.addCleanup(connections[alias].close)
+    shards = override_settings(VISIT_SHARDS=['default', alias])
+    shards.enable()
+    test.addCleanup(shards.disable)
+    call_command('migrate', database=alias, verbosity=0)
+
+
+def add_business(email, name="Business", shard=None):
+    """A business, whose visits hash to the given shard if there is one."""
+    pk = next(pk for pk in iter(uuid.uuid4, None) if shard is None or shard_for_business(pk) == shard)
+    user = User.objects.create_user(id=pk, email=email, password="password")
+    return Business.objects.create(user=user, name=name, phone_num="1", street_address="1 St.", city="City",
+                                   postal_code="E4X 2M1", province="Ontario", capacity=10)
+
+
+class VisitFixtureMixin:
+    """Two businesses to check in at, and a helper to add customers."""
+
+    def setUp(self):
+        super().setUp()
+        self.businesses = [add_business(f"business{i}@example.com", f"Business {i}") for i in range(2)]
+
+    def add_customer(self, email, first_name="Customer", last_name="One"):
+        user = User.objects.create_user(email=email, password="password", is_customer=True)
+        return Customer.objects.create(user=user, first_name=first_name, last_name=last_name, phone_num="1")
 
 
 class UserModelTests(TestCase):
@@ -113,6 +214,50 @@ class CustomerCreateViewTests(TestCase):
         self.assertEqual(User.objects.get(email="user1@example.com").is_customer, True)
         self.assertEqual(Customer.objects.get(user=User.objects.get(email="user1@example.com")).last_name, "OneAgain")
 
+    def test_customer_creation_with_active_email_is_forbidden(self):
+        c = Client()
+        data = {"user": {"email": "user1@example.com", "password": "test"}, "first_name": "Customer",
+                "last_name": "One", "phone_num": 1000000000, "contact_pref": 'P'}
+        c.post('/checkin/customer/create_account/', data=data, content_type="application/json")
+
+        data.update(last_name="Imposter")
+        response = c.post('/checkin/customer/create_account/', data=data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Customer.objects.get(user__email="user1@example.com").last_name, "One")
+
+    def test_registration_hashes_once_and_reactivates_with_updates(self):
+        with mock.patch('checkin.models.make_password', wraps=make_password) as hashed:
+            customer, created = User.objects.register('user1@EXAMPLE.com', 'test', Customer, {
+                'first_name': 'Customer', 'last_name': 'One', 'phone_num': '1000000000'}, is_customer=True)
+        self.assertEqual(hashed.call_count, 1)
+        self.assertTrue(created)
+        self.assertEqual(customer.user.email, 'user1@example.com')
+        User.objects.filter(pk=customer.pk).update(is_active=False)
+
+        with CaptureQueriesContext(connection) as queries:
+            customer, created = User.objects.register('user1@example.com', 'again', Customer, {
+                'first_name': 'Customer', 'last_name': 'Again', 'phone_num': '+1 (613) 555-0100'}, is_customer=True)
+        self.assertFalse(created)
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual(statements, ['SAVEPOINT', 'SELECT', 'UPDATE', 'SAVEPOINT', 'UPDATE', 'RELEASE', 'RELEASE'])
+        customer = Customer.objects.select_related('user').get(pk=customer.pk)
+        self.assertTrue(customer.user.is_active)
+        self.assertTrue(customer.user.check_password('again'))
+        self.assertEqual((customer.last_name, customer.phone_key), ('Again', '6135550100'))
+
+    def test_deactivated_business_can_sign_up_again_as_a_customer(self):
+        business, created = User.objects.register('venue@example.com', 'test', Business, {
+            'name': 'Venue', 'phone_num': '1000000000', 'street_address': '1 St.', 'city': 'City',
+            'postal_code': 'E4X 2M1', 'province': 'Ontario', 'capacity': 10})
+        User.objects.filter(pk=business.pk).update(is_active=False)
+
+        customer, created = User.objects.register('venue@example.com', 'again', Customer, {
+            'first_name': 'Former', 'last_name': 'Venue', 'phone_num': '1000000001'}, is_customer=True)
+        self.assertFalse(created)
+        self.assertEqual(Customer.objects.get(pk=business.pk).first_name, 'Former')
+        user = User.objects.get(pk=business.pk)
+        self.assertTrue(user.is_active and user.is_customer)
+
 
 class CustomerDetailViewTests(TestCase):
     def setUp(self):
@@ -172,6 +317,172 @@ class CustomerDetailViewTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(User.objects.get(id=user_id).is_active, False)
 
+
+class AccountImportTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_superuser(email="admin@example.com", password="password")
+        User.objects.create_user(email="taken@example.com", password="password")
+
+    def test_command_imports_csv_and_reports_bad_rows(self):
+        rows = ("email,password,first_name,last_name,phone_num,contact_pref\n"
+                "one@example.com,secret1,Customer,One,16135550100,P\n"
+                "two@example.com,secret2,Customer,Two,6135550101,E\n"
+                "one@example.com,again,Customer,Again,6135550102,P\n"
+                "taken@example.com,secret,Customer,Taken,6135550103,P\n"
+                "bad@example.com,secret,,Blank,6135550104,X\n")
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as f:
+            f.write(rows)
+            f.flush()
+            out, err = io.StringIO(), io.StringIO()
+            call_command('import_accounts', 'customer', f.name, '--hash-workers', '0', '--chunk-size', '1',
+                         stdout=out, stderr=err)
+
+        self.assertIn('Created 2 customer accounts, skipped 3 rows', out.getvalue())
+        errors = [json.loads(line) for line in err.getvalue().splitlines()]
+        self.assertEqual([error['line'] for error in errors], [4, 5, 6])
+        self.assertEqual(set(errors[2]['errors']), {'first_name', 'contact_pref'})
+        customer = Customer.objects.select_related('user').get(user__email="one@example.com")
+        self.assertTrue(customer.user.is_customer)
+        self.assertTrue(customer.user.check_password('secret1'))
+        self.assertEqual(customer.phone_key, '6135550100')
+        self.assertEqual(Job.objects.filter(name='link_unregistered_visits').count(), 2)
+
+    def test_staff_import_json_lines_without_forking_a_process_pool(self):
+        business = {"name": "Store", "phone_num": "1", "street_address": "1 St.", "city": "City",
+                    "postal_code": "E4X 2M1", "province": "Ontario", "capacity": 10}
+        body = "\n".join([
+            json.dumps(dict(business, user={"email": "store1@example.com", "password": "secret1"})),
+            "not json",
+            json.dumps(dict(business, email="store2@example.com", password="secret2", name="Store 2")),
+        ])
+        authorization = 'Bearer ' + str(RefreshToken.for_user(self.staff).access_token)
+        with override_settings(ACCOUNT_IMPORT={'HASH_WORKERS': 2}), \
+                mock.patch('checkin.provisioning.ProcessPoolExecutor') as pool:
+            response = Client().post('/checkin/business/import_accounts/', data=body,
+                                     content_type='application/x-ndjson', HTTP_AUTHORIZATION=authorization)
+
+        self.assertFalse(pool.called)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual([error['line'] for error in response.json()['errors']], [2])
+        store = Business.objects.select_related('user').get(user__email="store2@example.com")
+        self.assertEqual(store.name, "Store 2")
+        self.assertFalse(store.user.is_customer)
+        self.assertTrue(store.user.check_password('secret2'))
+
+    def test_command_hashes_with_a_process_pool(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write(json.dumps({"email": "one@example.com", "password": "secret1", "first_name": "Customer",
+                                "last_name": "One", "phone_num": "6135550100", "contact_pref": "P"}))
+            f.flush()
+            call_command('import_accounts', 'customer', f.name, '--hash-workers', '2', stdout=io.StringIO())
+
+        self.assertTrue(User.objects.get(email="one@example.com").check_password('secret1'))
+
+    def test_only_staff_can_import(self):
+        customer = User.objects.get(email="taken@example.com")
+        response = Client().post('/checkin/customer/import_accounts/', data=[], content_type='application/json',
+                                 HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(customer).access_token))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ProfileBatchTests(TestCase):
+    def setUp(self):
+        self.users = []
+        for i in range(3):
+            user = User.objects.create_user(email=f"user{i}@example.com", password="password", is_customer=True)
+            Customer.objects.create(user=user, first_name="Customer", last_name=str(i), phone_num="1")
+            self.users.append(user)
+        self.authorization = 'Bearer ' + str(RefreshToken.for_user(self.users[0]).access_token)
+
+    def test_batch_returns_profiles_in_order_from_one_query_then_the_cache(self):
+        ids = [str(self.users[2].pk), str(uuid.uuid4()), 'not-an-id', str(self.users[1].pk)]
+        path = '/checkin/customer/batch/?ids=' + ','.join(ids)
+        revocations.rebuild()
+        with CaptureQueriesContext(connection) as queries:
+            response = Client().get(path, HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([profile['last_name'] for profile in response.json()], ['2', '1'])
+
+        with CaptureQueriesContext(connection) as queries:
+            Client().get(f'/checkin/customer/batch/?ids={ids[0]}&ids={ids[3]}', HTTP_AUTHORIZATION=self.authorization)
+        # Only authentication reads the database once both profiles are cached
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.json()[0], Client().get(f'/checkin/customer/{self.users[2].pk}/',
+                                                          HTTP_AUTHORIZATION=self.authorization).json())
+
+    def test_updates_and_deactivation_reach_cached_profiles(self):
+        pk = str(self.users[1].pk)
+        Client().get('/checkin/customer/batch/?ids=' + pk, HTTP_AUTHORIZATION=self.authorization)
+        own = 'Bearer ' + str(RefreshToken.for_user(self.users[1]).access_token)
+        Client().put(f'/checkin/customer/{pk}/', data={"last_name": "Renamed"}, content_type="application/json",
+                     HTTP_AUTHORIZATION=own)
+        response = Client().get(f'/checkin/customer/batch/?ids={pk}', HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.json()[0]['last_name'], "Renamed")
+
+        Client().put(f'/checkin/change_email/{pk}/', data={"email": "moved@example.com"},
+                     content_type="application/json", HTTP_AUTHORIZATION=own)
+        response = Client().get(f'/checkin/customer/{pk}/', HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.json()['user']['email'], "moved@example.com")
+
+    def test_too_many_ids_are_rejected(self):
+        with override_settings(PROFILE_CACHE={'MAX_IDS': 2}):
+            response = Client().get('/checkin/business/batch/?ids=' + ','.join(str(uuid.uuid4()) for _ in range(3)),
+                                    HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_unknown_profile_is_not_found(self):
+        response = Client().get(f'/checkin/business/{self.users[0].pk}/', HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = Client().get('/checkin/business/not-an-id/', HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CustomerSearchTests(TestCase):
+    def setUp(self):
+        self.business = User.objects.create_user(email="business@example.com", password="password")
+        Business.objects.create(user=self.business, name="Business", phone_num="1", street_address="1 St.",
+                                city="City", postal_code="E4X 2M1", province="Ontario", capacity=10)
+        for email, phone_num in (("Alice.Smith@Example.com", "6135550100"), ("alina@example.com", "6135550299"),
+                                 ("bob@example.com", "4165550100"), ("alfred@example.com", "6135550142")):
+            user = User.objects.create_user(email=email, password="password", is_customer=True)
+            Customer.objects.create(user=user, first_name=email.split('@')[0], last_name="Customer",
+                                    phone_num=phone_num)
+        User.objects.filter(email="alfred@example.com").update(is_active=False)
+        self.authorization = 'Bearer ' + str(RefreshToken.for_user(self.business).access_token)
+
+    def lookup(self, q, **headers):
+        return Client().get('/checkin/customer/search/', {'q': q}, **dict({'HTTP_AUTHORIZATION': self.authorization},
+                                                                           **headers))
+
+    def test_email_and_phone_prefixes_match_active_customers_in_order(self):
+        response = self.lookup('ALI')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([customer['email'] for customer in response.json()],
+                         ["Alice.Smith@example.com", "alina@example.com"])
+        self.assertEqual([customer['first_name'] for customer in self.lookup('+1 (613) 555-01').json()],
+                         ["Alice.Smith"])
+        self.assertEqual(len(self.lookup('613555').json()), 2)
+        self.assertEqual(self.lookup('al').json(), [])
+
+    def test_prefixes_are_index_range_scans(self):
+        for field, prefix in (('user__email_key', 'ali'), ('phone_key', '613')):
+            plan = search.matching(field, prefix)[:10].explain()
+            column = field.split('__')[-1]
+            self.assertIn('USING INDEX', plan)
+            self.assertIn(f'({column}>? AND {column}<?)', plan)
+
+    def test_only_businesses_can_search(self):
+        customer = User.objects.get(email="bob@example.com")
+        response = self.lookup('ali', HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(customer).access_token))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_searches_are_throttled(self):
+        codes = [self.lookup('ali').status_code for _ in range(31)]
+        self.assertEqual(codes[-1], status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(set(codes[:30]), {status.HTTP_200_OK})
+
+
 class BusinessModelTests(TestCase):
     def setUp(self):
         user1 = User.objects.create(email="business1@example.com", password="test")
@@ -439,7 +750,6 @@ class ChangeEmailViewTests(TestCase):
         self.assertTrue(User.objects.get(id=user_id).check_password("password"))
 
 
-
 class UnregisteredVisitModelTests(TestCase):
     def setUp(self):
         user11 = User.objects.create(email="business1@example.com", password="test")
@@ -756,4 +1066,1338 @@ class VisitListViewTests(TestCase):
         c = Client()
 
         response = c.get("/checkin/visit/", HTTP_AUTHORIZATION='Bearer ' + 'invalidaccess')
-        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class UnregisteredVisitLinkingTests(TestCase):
+    def setUp(self):
+        user11 = User.objects.create(email="business1@example.com", password="test")
+        self.business1 = Business.objects.create(user=user11, name="Business One", phone_num=1000000000,
+                                                 street_address="1234 Street St.", city="City", postal_code="E4X 2M1",
+                                                 province="Ontario", capacity=123)
+        UnregisteredVisit.objects.create(dateTime='2021-01-25 14:30:59', first_name="Walk", last_name="In",
+                                         phone_num="1-613-555-0101", business=self.business1, numVisitors=1)
+
+    def test_phone_numbers_are_normalized(self):
+        self.assertEqual(normalize_phone("(613) 555-0101"), "6135550101")
+        self.assertEqual(normalize_phone("16135550101"), "6135550101")
+        self.assertEqual(UnregisteredVisit.objects.get(first_name="Walk").phone_key, "6135550101")
+
+    def test_customer_registration_links_unregistered_visits(self):
+        c = Client()
+        data = {
+            "user":
+                {
+                    "email": "user1@example.com",
+                    "password": "test"
+                },
+            "first_name": "Walk",
+            "last_name": "In",
+            "phone_num": "6135550101",
+            "contact_pref": 'P'
+        }
+        response = c.post('/checkin/customer/create_account/', data=data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(jobs.work(burst=True), 1)
+
+        customer = Customer.objects.get(user__email="user1@example.com")
+        self.assertEqual(UnregisteredVisit.objects.filter(customer=customer).count(), 1)
+
+    @override_settings(JOB_QUEUE=dict(settings.JOB_QUEUE, EAGER=True))
+    def test_signup_links_earlier_walk_in_visits_by_phone(self):
+        UnregisteredVisit.objects.create(dateTime='2021-01-26 09:00:00', first_name="Walk", last_name="In",
+                                         phone_num="613-5550101", business=self.business1, numVisitors=2)
+        other = UnregisteredVisit.objects.create(dateTime='2021-01-26 10:00:00', first_name="Someone", last_name="Else",
+                                                 phone_num="6135550199", business=self.business1, numVisitors=1)
+
+        response = Client().post('/checkin/customer/create_account/', data={
+            "user": {"email": "user1@example.com", "password": "test"}, "first_name": "Walk", "last_name": "In",
+            "phone_num": "16135550101", "contact_pref": 'P'}, content_type="application/json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        customer = Customer.objects.get(user__email="user1@example.com")
+        self.assertEqual(sorted(UnregisteredVisit.objects.filter(customer=customer).values_list('numVisitors',
+                                                                                                flat=True)), [1, 2])
+        self.assertIsNone(UnregisteredVisit.objects.get(pk=other.pk).customer)
+
+    def test_unregistered_visit_for_existing_customer_is_linked(self):
+        user1 = User.objects.create(email="user1@example.com", password="test")
+        customer = Customer.objects.create(user=user1, first_name="Walk", last_name="In", phone_num="6135550199")
+        visit = UnregisteredVisit.objects.create(dateTime='2021-01-25 15:30:59', first_name="Walk", last_name="In",
+                                                 phone_num="6135550199", business=self.business1, numVisitors=1)
+        self.assertIsNone(visit.customer)
+
+        self.assertEqual(UnregisteredVisit.objects.backfill_links(), 1)
+        self.assertEqual(UnregisteredVisit.objects.get(pk=visit.pk).customer, customer)
+
+
+class ShardedUnregisteredVisitLinkingTests(TransactionTestCase):
+    """The backfill reads every shard from its own thread, which only sees committed rows."""
+
+    def test_backfill_normalizes_and_links_walk_ins_on_every_shard(self):
+        add_visit_shard(self)
+        business = add_business("business2@example.com", shard='visits1')
+        visit = UnregisteredVisit.objects.create(dateTime='2021-01-26 09:00:00', first_name="Walk", last_name="In",
+                                                 phone_num="613-555-0101", business=business, numVisitors=1)
+        # As stored before phone numbers were normalized
+        UnregisteredVisit.objects.using('visits1').update(phone_key='')
+        user = User.objects.create(email="user1@example.com", password="test", is_customer=True)
+        customer = Customer.objects.create(user=user, first_name="Walk", last_name="In", phone_num="6135550101")
+
+        out = io.StringIO()
+        call_command('link_unregistered_visits', stdout=out)
+        self.assertIn('Normalized 1 unregistered visits phone numbers', out.getvalue())
+        visit = UnregisteredVisit.objects.using('visits1').get(pk=visit.pk)
+        self.assertEqual((visit.phone_key, visit.customer_id), ("6135550101", customer.pk))
+
+
+class NotificationDispatchTests(TransactionTestCase):
+    def setUp(self):
+        self.sms_dir = tempfile.TemporaryDirectory()
+        business_user = User.objects.create(email="business1@example.com", password="test")
+        self.business1 = Business.objects.create(user=business_user, name="Business One", phone_num=1000000000,
+                                                 street_address="1234 Street St.", city="City",
+                                                 postal_code="E4X 2M1", province="Ontario", capacity=123)
+        for i, contact_pref in enumerate(["E", "P", "P"]):
+            user = User.objects.create(email=f"user{i}@example.com", password="test")
+            customer = Customer.objects.create(user=user, first_name="Customer", last_name=str(i),
+                                               phone_num=f"613555010{i}", contact_pref=contact_pref)
+            Visit.objects.create(dateTime='2021-01-25 14:30:59', customer=customer, business=self.business1,
+                                 numVisitors=1)
+
+    def tearDown(self):
+        self.sms_dir.cleanup()
+
+    def notifications_settings(self, **overrides):
+        return override_settings(NOTIFICATIONS=dict({
+            'SMS_FILE_PATH': str(Path(self.sms_dir.name, "sms.jsonl")),
+            'RATE_LIMITS': {},
+            'RETRY_BACKOFF': 0,
+        }, **overrides))
+
+    def test_notifications_follow_contact_pref(self):
+        customers = exposed_customers(self.business1, '2021-01-25 00:00:00', '2021-01-26 00:00:00')
+        enqueue_exposure_notifications(customers, "Exposure", "You may have been exposed.")
+
+        with self.notifications_settings():
+            stats = Dispatcher(workers=2, batch_size=1).run_once()
+
+        self.assertEqual(stats["sent"], 3)
+        self.assertEqual(stats["pending"], 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["user0@example.com"])
+        with open(Path(self.sms_dir.name, "sms.jsonl")) as sms_file:
+            self.assertEqual(sorted(json.loads(line)["to"] for line in sms_file), ["6135550101", "6135550102"])
+        self.assertEqual(Notification.objects.filter(status=Notification.SENT).count(), 3)
+
+    def test_failed_sends_are_retried_then_marked_failed(self):
+        enqueue_exposure_notifications(Customer.objects.filter(contact_pref="E"), "Exposure", "Message")
+
+        with self.notifications_settings(TRANSPORTS={'E': 'checkin.tests.BrokenTransport'}, MAX_ATTEMPTS=2):
+            with self.assertLogs('checkin.notifications', 'WARNING'):
+                stats = Dispatcher(workers=1).run_once()
+
+        notification = Notification.objects.get()
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(notification.status, Notification.FAILED)
+        self.assertEqual(notification.attempts, 2)
+
+    def test_outcome_of_a_batch_reclaimed_during_sending_is_left_to_the_new_claim(self):
+        enqueue_exposure_notifications(Customer.objects.filter(contact_pref="E"), "Exposure", "Message")
+
+        self.addCleanup(setattr, SlowTransport, 'fail', False)
+        for fail in (False, True):
+            SlowTransport.fail = fail
+            with self.notifications_settings(TRANSPORTS={'E': 'checkin.tests.SlowTransport'}, CLAIM_TIMEOUT=0):
+                dispatcher = Dispatcher(workers=1)
+                with self.assertLogs('checkin.notifications', 'WARNING'):
+                    dispatcher.send_batch('E', dispatcher.claim_batch('E'))
+
+            notification = Notification.objects.get()
+            self.assertEqual(notification.claim, SlowTransport.reclaimed[0].claim)
+            self.assertEqual((notification.status, notification.attempts), (Notification.SENDING, 0))
+            self.assertEqual((dispatcher.sent, dispatcher.failed), (0, 0))
+
+
+class BrokenTransport:
+    def send_batch(self, notifications):
+        raise ConnectionError("gateway unavailable")
+
+
+class SlowTransport:
+    """Takes so long that the batch's lease runs out and another worker claims it again while sending."""
+    fail = False
+    reclaimed = []
+
+    def send_batch(self, notifications):
+        SlowTransport.reclaimed = Dispatcher().claim_batch('E')
+        if SlowTransport.fail:
+            raise ConnectionError("gateway timed out")
+
+
+def flaky_job(fail):
+    if fail:
+        raise ValueError("boom")
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        jobs.REGISTRY['flaky_job'] = flaky_job
+
+    def tearDown(self):
+        del jobs.REGISTRY['flaky_job']
+
+    def test_successful_job_is_removed(self):
+        jobs.enqueue('flaky_job', fail=False)
+
+        self.assertEqual(jobs.work(burst=True), 1)
+        self.assertFalse(Job.objects.exists())
+
+    def test_failing_job_backs_off_then_is_dead_lettered(self):
+        queued = jobs.enqueue('flaky_job', fail=True)
+
+        jobs.work(burst=True)
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Job.QUEUED)
+        self.assertEqual(queued.attempts, 1)
+        self.assertIn("ValueError", queued.last_error)
+
+        Job.objects.update(available_date=queued.created_date, attempts=queued.max_attempts - 1)
+        with self.assertLogs('checkin.jobs', 'ERROR'):
+            jobs.work(burst=True)
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Job.DEAD)
+
+        self.assertEqual(jobs.requeue_dead(), 1)
+        self.assertEqual(Job.objects.get().status, Job.QUEUED)
+
+    def test_claimed_jobs_are_not_claimed_twice(self):
+        jobs.enqueue('flaky_job', fail=False)
+
+        self.assertEqual(len(jobs.claim(10)), 1)
+        self.assertEqual(jobs.claim(10), [])
+
+    def test_expired_lease_does_not_touch_the_job_another_worker_claimed(self):
+        queued = jobs.enqueue('flaky_job', fail=False)
+        [stale] = jobs.claim(10)
+        Job.objects.update(available_date=queued.created_date)
+        [current] = jobs.claim(10)
+
+        with self.assertLogs('checkin.jobs', 'WARNING'):
+            jobs.run(stale)
+        self.assertEqual(Job.objects.get().claim, current.claim)
+
+        stale.payload = {'fail': True}
+        with self.assertLogs('checkin.jobs', 'WARNING'):
+            jobs.run(stale)
+        self.assertEqual(Job.objects.get().status, Job.RUNNING)
+
+        self.assertTrue(jobs.run(current))
+        self.assertFalse(Job.objects.exists())
+
+
+class CheckinTokenTests(TestCase):
+    def setUp(self):
+        c = Client()
+        data = {
+            "user":
+                {
+                    "email": "user1@example.com",
+                    "password": "test"
+                },
+            "first_name": "Customer",
+            "last_name": "One",
+            "phone_num": "1000000000",
+            "contact_pref": 'P'
+        }
+        c.post('/checkin/customer/create_account/', data=data, content_type="application/json")
+
+        data = {
+            "user":
+                {
+                    "email": "business1@example.com",
+                    "password": "test"
+                },
+            "name": "business one",
+            "phone_num": "1000000000",
+            "street_address": "1234 Street St.",
+            "city": "City",
+            "postal_code": "E4X 2M1",
+            "province": "Ontario",
+            "capacity": 123,
+        }
+        c.post('/checkin/business/create_account/', data=data, content_type="application/json")
+
+        response = c.post('/api/token/', data={"email": "user1@example.com", "password": "test"},
+                          content_type="application/json")
+        self.access = response.json()["access"]
+        response = c.post('/api/token/', data={"email": "business1@example.com", "password": "test"},
+                          content_type="application/json")
+        self.business_access = response.json()["access"]
+        self.business_id = User.objects.get(email="business1@example.com").id
+
+    def test_token_round_trip(self):
+        token = make_checkin_token(self.business_id)
+        self.assertEqual(verify_checkin_token(token), self.business_id)
+
+    def test_forged_and_stale_tokens_are_rejected(self):
+        token = make_checkin_token(self.business_id, now=0)
+        self.assertRaises(InvalidCheckinToken, verify_checkin_token, token)
+
+        business_id, expires, signature = make_checkin_token(self.business_id).split('.')
+        forged = '.'.join([User.objects.get(email="user1@example.com").id.hex, expires, signature])
+        self.assertRaises(InvalidCheckinToken, verify_checkin_token, forged)
+        self.assertRaises(InvalidCheckinToken, verify_checkin_token, "garbage")
+
+    def test_visit_creation_with_token(self):
+        c = Client()
+        token = c.get(f'/checkin/business/{self.business_id}/checkin_token/',
+                      HTTP_AUTHORIZATION='Bearer ' + self.business_access).json()["token"]
+        data = {
+            "dateTime": "2021-01-25 14:30:59",
+            "customer": User.objects.get(email="user1@example.com").id,
+            "token": token,
+            "numVisitors": "2"
+        }
+        response = c.post('/checkin/visit/create_visit/', HTTP_AUTHORIZATION='Bearer ' + self.access, data=data,
+                          content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Visit.objects.get().business_id, self.business_id)
+
+        data["token"] = token[:-1] + ("A" if token[-1] != "A" else "B")
+        response = c.post('/checkin/visit/create_visit/', HTTP_AUTHORIZATION='Bearer ' + self.access, data=data,
+                          content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_token_of_deactivated_or_deleted_venue_is_rejected(self):
+        data = {"dateTime": "2021-01-25 14:30:59", "customer": User.objects.get(email="user1@example.com").id,
+                "token": make_checkin_token(self.business_id), "numVisitors": 1}
+        User.objects.filter(pk=self.business_id).update(is_active=False)
+        response = Client().post('/checkin/visit/create_visit/', HTTP_AUTHORIZATION='Bearer ' + self.access,
+                                 data=data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        User.objects.filter(pk=self.business_id).delete()
+        response = Client().post('/checkin/visit/create_visit/', HTTP_AUTHORIZATION='Bearer ' + self.access,
+                                 data=data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Visit.objects.exists())
+
+    def test_qr_code_only_for_own_business(self):
+        c = Client()
+        response = c.get(f'/checkin/business/{self.business_id}/checkin_token/?image=svg',
+                         HTTP_AUTHORIZATION='Bearer ' + self.business_access)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/svg+xml")
+
+        response = c.get(f'/checkin/business/{self.business_id}/checkin_token/',
+                         HTTP_AUTHORIZATION='Bearer ' + self.access)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TokenRevocationTests(TestCase):
+    def setUp(self):
+        c = Client()
+        data = {
+            "user":
+                {
+                    "email": "user1@example.com",
+                    "password": "password"
+                },
+            "first_name": "User",
+            "last_name": "One",
+            "phone_num": "1111111111",
+            "contact_pref": 'P'
+        }
+        c.post('/checkin/customer/create_account/', data=data, content_type="application/json")
+
+        data = {
+            "email": "user1@example.com",
+            "password": "password"
+        }
+        response = c.post('/api/token/', data=data, content_type="application/json")
+        self.access = response.json()["access"]
+        self.refresh = response.json()["refresh"]
+        self.user_id = User.objects.get(email="user1@example.com").id
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(100, 0.01)
+        for i in range(100):
+            bloom.add(f"user{i}")
+        self.assertTrue(all(f"user{i}" in bloom for i in range(100)))
+        self.assertLess(sum(f"other{i}" in bloom for i in range(1000)), 50)
+
+    def test_unrevoked_user_is_cleared_without_a_query(self):
+        revocations.rebuild()
+        with self.assertNumQueries(0):
+            self.assertFalse(revocations.is_revoked(self.user_id, 0))
+
+    def test_password_change_revokes_issued_tokens(self):
+        c = Client()
+        data = {
+            "old_password": "password",
+            "new_password": "newpassword"
+        }
+        response = c.put(f'/checkin/change_password/{self.user_id}/', HTTP_AUTHORIZATION='Bearer ' + self.access,
+                         data=data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        TokenRevocation.objects.filter(user_id=self.user_id).update(revoked_date=timezone.now() + timedelta(seconds=1))
+
+        response = c.get(f'/checkin/customer/{self.user_id}/', HTTP_AUTHORIZATION='Bearer ' + self.access)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = c.post('/api/token/refresh/', data={"refresh": self.refresh}, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_tokens_issued_after_revocation_are_accepted(self):
+        revocations.revoke(User.objects.get(id=self.user_id))
+
+        c = Client()
+        response = c.post('/api/token/', data={"email": "user1@example.com", "password": "password"},
+                          content_type="application/json")
+        response = c.get(f'/checkin/customer/{self.user_id}/', HTTP_AUTHORIZATION='Bearer ' + response.json()["access"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ThrottlingTests(TestCase):
+    def setUp(self):
+        c = Client()
+        data = {
+            "user":
+                {
+                    "email": "user1@example.com",
+                    "password": "test"
+                },
+            "first_name": "Customer",
+            "last_name": "One",
+            "phone_num": "1000000000",
+            "contact_pref": 'P'
+        }
+        c.post('/checkin/customer/create_account/', data=data, content_type="application/json")
+
+    def test_login_attempts_are_throttled_per_account(self):
+        c = Client()
+        data = {
+            "email": "user1@example.com",
+            "password": "wrong"
+        }
+        for i in range(10):
+            response = c.post('/api/token/', data=data, content_type="application/json")
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = c.post('/api/token/', data=data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+
+        data["email"] = "other@example.com"
+        response = c.post('/api/token/', data=data, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def business_ident(self, user, data):
+        request = Request(APIRequestFactory().post('/', data, format='json'), parsers=[JSONParser()])
+        request.user = user
+        return bucket('business', '1/min')().get_ident_for_scope(request, None)
+
+    def test_venue_bucket_is_only_spent_by_the_venue_or_its_signed_token(self):
+        customer = User.objects.get(email="user1@example.com")
+        business = User.objects.create_user(email="business1@example.com", password="test")
+
+        self.assertIsNone(self.business_ident(customer, {"business": str(business.id)}))
+        self.assertEqual(self.business_ident(customer, {"token": make_checkin_token(business.id)}), business.id.hex)
+        self.assertEqual(self.business_ident(business, {"business": str(customer.id)}), business.id.hex)
+        self.assertIsNone(self.business_ident(customer, [{"business": str(business.id)}]))
+
+    def test_list_body_is_rejected_rather_than_crashing(self):
+        access = str(RefreshToken.for_user(User.objects.get(email="user1@example.com")).access_token)
+        response = Client().post('/checkin/visit/create_visit/', data=[{"numVisitors": 1}],
+                                 content_type="application/json", HTTP_AUTHORIZATION='Bearer ' + access)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FakeLagMonitor:
+    def __init__(self, lagging=()):
+        self.lagging = lagging
+
+    def is_healthy(self, alias):
+        return alias not in self.lagging
+
+
+class ReplicaRouterTests(TestCase):
+    def test_reads_outside_replica_views_use_primary(self):
+        router = ReplicaRouter(replicas=['replica1'], monitor=FakeLagMonitor())
+        self.assertIsNone(router.db_for_read(Visit))
+        self.assertEqual(router.db_for_write(Visit), 'default')
+
+    def test_replica_reads_rotate_and_skip_lagging_replicas(self):
+        router = ReplicaRouter(replicas=['replica1', 'replica2'], monitor=FakeLagMonitor())
+        token = replica_reads.set(True)
+        try:
+            self.assertEqual({router.db_for_read(Visit), router.db_for_read(Visit)}, {'replica1', 'replica2'})
+
+            router.monitor = FakeLagMonitor(lagging=['replica1'])
+            self.assertEqual([router.db_for_read(Visit) for i in range(3)], ['replica2'] * 3)
+
+            router.monitor = FakeLagMonitor(lagging=['replica1', 'replica2'])
+            self.assertEqual(router.db_for_read(Visit), 'default')
+        finally:
+            replica_reads.reset(token)
+
+    def test_lag_is_the_age_of_the_heartbeat_a_replica_holds(self):
+        monitor = ReplicaLagMonitor()
+        # The primary stands in for a replica that copied everything up to the stamp
+        self.assertTrue(monitor.is_healthy('default'))
+        self.assertLess(monitor.lag('default'), 1)
+
+        Heartbeat.objects.update(beat=timezone.now() - timedelta(minutes=5))
+        monitor.checked.clear()
+        with self.assertLogs('checkin.routers', 'WARNING'):
+            self.assertFalse(monitor.is_healthy('default'))
+
+    def test_replica_without_a_heartbeat_is_not_used(self):
+        monitor = ReplicaLagMonitor()
+        monitor.beaten = time.monotonic()
+        with self.assertLogs('checkin.routers', 'WARNING'):
+            self.assertFalse(monitor.is_healthy('default'))
+
+    def test_replicas_are_not_migrated(self):
+        router = ReplicaRouter(replicas=['replica1'], monitor=FakeLagMonitor())
+        self.assertFalse(router.allow_migrate('replica1', 'checkin'))
+        self.assertIsNone(router.allow_migrate('default', 'checkin'))
+
+    def test_writes_pin_user_to_primary(self):
+        c = Client()
+        data = {
+            "user":
+                {
+                    "email": "user1@example.com",
+                    "password": "password"
+                },
+            "first_name": "User",
+            "last_name": "One",
+            "phone_num": "1111111111",
+            "contact_pref": 'P'
+        }
+        c.post('/checkin/customer/create_account/', data=data, content_type="application/json")
+        response = c.post('/api/token/', data={"email": "user1@example.com", "password": "password"},
+                          content_type="application/json")
+        access = response.json()["access"]
+        user_id = User.objects.get(email="user1@example.com").id
+        self.assertFalse(is_pinned(user_id))
+
+        response = c.put(f'/checkin/customer/{user_id}/', HTTP_AUTHORIZATION='Bearer ' + access,
+                         data={"contact_pref": "E"}, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(is_pinned(user_id))
+
+
+class VisitShardingTests(TestCase):
+    def test_businesses_stay_on_their_shard(self):
+        shards = ['default', 'visits1', 'visits2']
+        business_ids = [uuid.uuid4() for i in range(300)]
+        placement = [shard_for_business(business_id, shards) for business_id in business_ids]
+
+        self.assertEqual(placement, [shard_for_business(str(business_id), shards) for business_id in business_ids])
+        self.assertEqual(set(placement), set(shards))
+
+    def test_adding_a_shard_only_moves_businesses_to_it(self):
+        business_ids = [uuid.uuid4() for i in range(300)]
+        before = [shard_for_business(business_id, ['default', 'visits1']) for business_id in business_ids]
+        after = [shard_for_business(business_id, ['default', 'visits1', 'visits2']) for business_id in business_ids]
+
+        self.assertTrue(all(old == new or new == 'visits2' for old, new in zip(before, after)))
+
+    def test_visit_queries_on_a_single_shard(self):
+        user1 = User.objects.create(email="user1@example.com", password="test")
+        user11 = User.objects.create(email="business1@example.com", password="test")
+        customer1 = Customer.objects.create(user=user1, first_name="Customer", last_name="One", phone_num=1000000000)
+        business1 = Business.objects.create(user=user11, name="Business One", phone_num=1000000000,
+                                            street_address="1234 Street St.", city="City", postal_code="E4X 2M1",
+                                            province="Ontario", capacity=123)
+        Visit.objects.create(dateTime='2021-01-25 14:30:59', customer=customer1, business=business1, numVisitors=3)
+        Visit.objects.create(dateTime='2021-01-24 14:30:59', customer=customer1, business_id=business1.pk,
+                             numVisitors=1)
+
+        self.assertEqual(Visit.objects.for_business(business1).count(), 2)
+        visits = Visit.objects.filter(customer=customer1).order_by('dateTime').across_shards(key=lambda v: v.dateTime)
+        self.assertEqual([visit.numVisitors for visit in visits], [1, 3])
+
+
+class SQLiteTuningTests(TestCase):
+    def test_connection_pragmas_are_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['cache_size'])
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class RequestProfilingTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_superuser(email="admin@example.com", password="password")
+        self.user = User.objects.create_user(email="user1@example.com", password="password")
+
+    def bearer(self, user):
+        return 'Bearer ' + str(RefreshToken.for_user(user).access_token)
+
+    def test_staff_get_a_profile_report(self):
+        response = Client().get('/checkin/business/', HTTP_X_PROFILE='text', HTTP_AUTHORIZATION=self.bearer(self.staff))
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertIn('cumulative', response.content.decode())
+
+    def test_stored_profiles_are_named_in_the_response(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(REQUEST_PROFILING={'DIRECTORY': directory}), self.assertLogs('checkin.profiling'):
+            response = Client().get('/checkin/business/?_profile=1', HTTP_AUTHORIZATION=self.bearer(self.staff))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue((Path(directory) / (response['X-Profile-Id'] + '.prof')).exists())
+
+    def test_other_users_are_not_profiled(self):
+        response = Client().get('/checkin/business/', HTTP_X_PROFILE='text', HTTP_AUTHORIZATION=self.bearer(self.user))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertNotIn('X-Profile-Id', response)
+
+
+class SlowQueryLogTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_superuser(email="admin@example.com", password="password")
+        self.authorization = 'Bearer ' + str(RefreshToken.for_user(self.staff).access_token)
+        slow_queries.clear()
+
+    def test_fingerprints_ignore_values(self):
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE a = 'x' AND b IN (%s, %s, %s)"),
+                         fingerprint("SELECT *  FROM t WHERE a = 'it''s' AND b IN (%s)"))
+        self.assertEqual(fingerprint("SELECT * FROM t LIMIT 21"), "SELECT * FROM t LIMIT ?")
+
+    def test_slow_queries_are_reported_with_view_and_plan(self):
+        c = Client()
+        with override_settings(SLOW_QUERY_LOG={'THRESHOLD': 0}), self.assertLogs('checkin.slowqueries', 'WARNING'):
+            c.get('/checkin/business/', HTTP_AUTHORIZATION=self.authorization)
+
+        response = c.get('/checkin/slow_queries/', HTTP_AUTHORIZATION=self.authorization)
+        entry = next(entry for entry in response.json() if 'FROM "checkin_business"' in entry['fingerprint'])
+        self.assertEqual(entry['views'], {'checkin.views.BusinessList': 1})
+        self.assertTrue(all(site.startswith('views.py:') for site in entry['call_sites']))
+        self.assertTrue(entry['plan'])
+
+    def test_only_staff_can_read_slow_queries(self):
+        customer = User.objects.create_user(email="user1@example.com", password="password")
+        response = Client().get('/checkin/slow_queries/',
+                                HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(customer).access_token))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+# Queries each route runs, and the most serializer calls it may make per item returned, whatever the size of the
+# database. Changing a number here changes how the endpoint scales, so do it deliberately.
+QUERY_CONTRACTS = {
+    ('POST', 'api/token/'): {'queries': 1, 'serializations': 0},
+    ('POST', 'api/token/refresh/'): {'queries': 0, 'serializations': 0},
+    ('GET', 'checkin/customer/'): {'queries': 2, 'serializations': 2},
+    ('POST', 'checkin/customer/create_account/'): {'queries': 6, 'serializations': 0},
+    ('POST', 'checkin/customer/import_accounts/'): {'queries': 7, 'serializations': 0},
+    ('GET', 'checkin/customer/batch/'): {'queries': 2, 'serializations': 2},
+    ('GET', 'checkin/customer/search/'): {'queries': 3, 'serializations': 0},
+    ('GET', 'checkin/customer/<user__id>/'): {'queries': 2, 'serializations': 2},
+    ('GET', 'checkin/customer/<user__id>/visit_summary/'): {'queries': 2, 'serializations': 0},
+    ('PUT', 'checkin/customer/<user__id>/'): {'queries': 3, 'serializations': 2},
+    ('DELETE', 'checkin/customer/<user__id>/'): {'queries': 9, 'serializations': 1},
+    ('GET', 'checkin/business/'): {'queries': 2, 'serializations': 2},
+    ('POST', 'checkin/business/create_account/'): {'queries': 5, 'serializations': 0},
+    ('POST', 'checkin/business/import_accounts/'): {'queries': 6, 'serializations': 0},
+    ('GET', 'checkin/business/batch/'): {'queries': 2, 'serializations': 2},
+    ('GET', 'checkin/business/<user__id>/'): {'queries': 2, 'serializations': 2},
+    ('PUT', 'checkin/business/<user__id>/'): {'queries': 3, 'serializations': 2},
+    ('DELETE', 'checkin/business/<user__id>/'): {'queries': 9, 'serializations': 1},
+    ('GET', 'checkin/business/<user__id>/checkin_token/'): {'queries': 1, 'serializations': 0},
+    ('GET', 'checkin/business/<user__id>/visitors/'): {'queries': 6, 'serializations': 0},
+    ('PUT', 'checkin/change_password/<id>/'): {'queries': 9, 'serializations': 1},
+    ('PUT', 'checkin/change_email/<id>/'): {'queries': 3, 'serializations': 1},
+    ('GET', 'checkin/visit/'): {'queries': 3, 'serializations': 1},
+    ('POST', 'checkin/visit/create_visit/'): {'queries': 13, 'serializations': 1},
+    ('POST', 'checkin/visit/business_create_visit/'): {'queries': 12, 'serializations': 1},
+    ('POST', 'checkin/visit/business_create_unregistered_visit/'): {'queries': 5, 'serializations': 1},
+    ('GET', 'checkin/slow_queries/'): {'queries': 1, 'serializations': 0},
+}
+
+
+class QueryContractTests(TestCase):
+    """Run every route against a small and a large database and compare its work with QUERY_CONTRACTS."""
+
+    def setUp(self):
+        self.customer = User.objects.create_user(email="customer1@example.com", password="password",
+                                                 is_customer=True)
+        Customer.objects.create(user=self.customer, first_name="Customer", last_name="One", phone_num="1111111111")
+        self.business = User.objects.create_user(email="business1@example.com", password="password")
+        Business.objects.create(user=self.business, name="Business One", phone_num="1000000000",
+                                street_address="1234 Street St.", city="City", postal_code="E4X 2M1",
+                                province="Ontario", capacity=100)
+        self.staff = User.objects.create_superuser(email="admin@example.com", password="password")
+        self.seeded = 0
+
+    def seed(self, count):
+        """Grow the database to count customers and businesses, with count visits by the first customer."""
+        users = [User(email=f"seed{i}@example.com", email_key=f"seed{i}@example.com", is_customer=i % 2 == 0)
+                 for i in range(self.seeded, count)]
+        User.objects.bulk_create(users)
+        Customer.objects.bulk_create(Customer(user=user, first_name="Seed", last_name="Customer", phone_num="1",
+                                              phone_key="1") for user in users if user.is_customer)
+        Business.objects.bulk_create(Business(user=user, name="Seed", phone_num="1", street_address="1 St.",
+                                              city="City", postal_code="E4X 2M1", province="Ontario", capacity=1)
+                                     for user in users if not user.is_customer)
+        Visit.objects.bulk_create(Visit(dateTime='2021-01-25 14:30:59', customer_id=self.customer.id,
+                                        business_id=user.id, numVisitors=1) for user in users if not user.is_customer)
+        Visit.objects.bulk_create(Visit(dateTime='2021-01-25 14:30:59', customer_id=user.id,
+                                        business_id=self.business.id, numVisitors=1) for user in users if user.is_customer)
+        UnregisteredVisit.objects.bulk_create(UnregisteredVisit(
+            dateTime='2021-01-25 15:00:00', first_name="Walk", last_name="In", phone_num="1",
+            business_id=self.business.id, numVisitors=1) for user in users)
+        self.seeded = count
+
+    def bearer(self, user):
+        return {'HTTP_AUTHORIZATION': 'Bearer ' + str(RefreshToken.for_user(user).access_token)}
+
+    def requests(self):
+        """The request made to each route, as (method, path, data, user)."""
+        customer, business = str(self.customer.id), str(self.business.id)
+        visit = {"dateTime": "2021-03-24 20:30:23", "customer": customer, "numVisitors": 2}
+        new_account = {"email": "new@example.com", "password": "password"}
+        seeded_customers = ','.join(str(pk) for pk in Customer.objects.filter(last_name="Customer")
+                                    .values_list('pk', flat=True))
+        seeded_businesses = ','.join(str(pk) for pk in Business.objects.filter(name="Seed").values_list('pk', flat=True))
+        return {
+            ('POST', 'api/token/'): ('/api/token/', {"email": "customer1@example.com", "password": "password"}, None),
+            ('POST', 'api/token/refresh/'):
+                ('/api/token/refresh/', {"refresh": str(RefreshToken.for_user(self.customer))}, None),
+            ('GET', 'checkin/customer/'): ('/checkin/customer/', None, self.customer),
+            ('POST', 'checkin/customer/create_account/'):
+                ('/checkin/customer/create_account/', {"user": new_account, "first_name": "New", "last_name": "One",
+                                                       "phone_num": "1", "contact_pref": 'P'}, None),
+            ('POST', 'checkin/customer/import_accounts/'):
+                ('/checkin/customer/import_accounts/', [dict(new_account, first_name="New", last_name="One",
+                                                             phone_num="1")], self.staff),
+            ('GET', 'checkin/customer/batch/'):
+                (f'/checkin/customer/batch/?ids={customer},{seeded_customers}', None, self.customer),
+            ('GET', 'checkin/customer/search/'): ('/checkin/customer/search/?q=seed', None, self.business),
+            ('GET', 'checkin/customer/<user__id>/'): (f'/checkin/customer/{customer}/', None, self.customer),
+            ('GET', 'checkin/customer/<user__id>/visit_summary/'):
+                (f'/checkin/customer/{customer}/visit_summary/', None, self.customer),
+            ('PUT', 'checkin/customer/<user__id>/'):
+                (f'/checkin/customer/{customer}/', {"first_name": "Renamed"}, self.customer),
+            ('DELETE', 'checkin/customer/<user__id>/'):
+                (f'/checkin/customer/{customer}/', {"password": "password"}, self.customer),
+            ('GET', 'checkin/business/'): ('/checkin/business/', None, self.customer),
+            ('POST', 'checkin/business/create_account/'):
+                ('/checkin/business/create_account/', {"user": new_account, "name": "New", "phone_num": "1",
+                                                       "street_address": "1 St.", "city": "City",
+                                                       "postal_code": "E4X 2M1", "province": "Ontario",
+                                                       "capacity": 1}, None),
+            ('POST', 'checkin/business/import_accounts/'):
+                ('/checkin/business/import_accounts/', [dict(new_account, name="New", phone_num="1",
+                                                             street_address="1 St.", city="City",
+                                                             postal_code="E4X 2M1", province="Ontario",
+                                                             capacity=1)], self.staff),
+            ('GET', 'checkin/business/batch/'):
+                (f'/checkin/business/batch/?ids={business},{seeded_businesses}', None, self.customer),
+            ('GET', 'checkin/business/<user__id>/'): (f'/checkin/business/{business}/', None, self.business),
+            ('PUT', 'checkin/business/<user__id>/'):
+                (f'/checkin/business/{business}/', {"name": "Renamed"}, self.business),
+            ('DELETE', 'checkin/business/<user__id>/'):
+                (f'/checkin/business/{business}/', {"password": "password"}, self.business),
+            ('GET', 'checkin/business/<user__id>/checkin_token/'):
+                (f'/checkin/business/{business}/checkin_token/', None, self.business),
+            ('GET', 'checkin/business/<user__id>/visitors/'):
+                (f'/checkin/business/{business}/visitors/?day=2021-01-25', None, self.business),
+            ('PUT', 'checkin/change_password/<id>/'):
+                (f'/checkin/change_password/{customer}/', {"old_password": "password", "new_password": "new"},
+                 self.customer),
+            ('PUT', 'checkin/change_email/<id>/'):
+                (f'/checkin/change_email/{customer}/', {"email": "renamed@example.com"}, self.customer),
+            ('GET', 'checkin/visit/'): ('/checkin/visit/', None, self.customer),
+            ('POST', 'checkin/visit/create_visit/'):
+                ('/checkin/visit/create_visit/', dict(visit, token=make_checkin_token(business)), self.customer),
+            ('POST', 'checkin/visit/business_create_visit/'):
+                ('/checkin/visit/business_create_visit/',
+                 dict(visit, customer="customer1@example.com", business=business), self.business),
+            ('POST', 'checkin/visit/business_create_unregistered_visit/'):
+                ('/checkin/visit/business_create_unregistered_visit/',
+                 {"dateTime": "2021-03-24 20:30:23", "first_name": "Walk", "last_name": "In", "phone_num": "1",
+                  "business": business, "numVisitors": 1}, self.business),
+            ('GET', 'checkin/slow_queries/'): ('/checkin/slow_queries/', None, self.staff),
+        }
+
+    def measure(self, method, path, data, user):
+        """Queries, serializer calls and items returned by one request, whose writes are rolled back."""
+        headers = self.bearer(user) if user is not None else {}
+        revocations.rebuild()
+        to_representation = serializers.Serializer.to_representation
+        with transaction.atomic(), CaptureQueriesContext(connection) as queries, \
+                mock.patch.object(serializers.Serializer, 'to_representation', autospec=True,
+                                  side_effect=to_representation) as serializations:
+            response = Client().generic(method, path, json.dumps(data) if data is not None else '',
+                                        content_type="application/json", **headers)
+            transaction.set_rollback(True)
+        for cache in caches.all():
+            cache.clear()
+        self.assertLess(response.status_code, 400, f'{method} {path}: {response.content[:200]}')
+        body = response.json() if response.get('Content-Type') == 'application/json' else None
+        items = len(body) if isinstance(body, list) else 1
+        return len(queries), serializations.call_count, items, [query['sql'] for query in queries]
+
+    def test_every_route_has_a_contract(self):
+        routes = {str(pattern.pattern) for pattern in urls.urlpatterns}
+        self.assertEqual(routes, {route for method, route in QUERY_CONTRACTS})
+        self.assertEqual(set(self.requests()), set(QUERY_CONTRACTS))
+
+    def test_work_does_not_grow_with_the_database(self):
+        diffs = []
+        results = {}
+        for size in (5, 50):
+            self.seed(size)
+            for key, (path, data, user) in self.requests().items():
+                results[key, size] = self.measure(key[0], path, data, user)
+
+        for key, contract in QUERY_CONTRACTS.items():
+            (small, _, _, _), (large, serializations, items, sql) = results[key, 5], results[key, 50]
+            if small != contract['queries'] or large != contract['queries']:
+                diffs.append('%s %s: expected %d queries, ran %d on the small and %d on the large database\n    %s'
+                             % (*key, contract['queries'], small, large, '\n    '.join(sql)))
+            if serializations > contract['serializations'] * items:
+                diffs.append('%s %s: expected at most %d serializer calls per item, made %d for %d items'
+                             % (*key, contract['serializations'], serializations, items))
+        if diffs:
+            self.fail('Query contracts changed:\n' + '\n'.join(diffs))
+
+
+class AuditLogTests(TestCase):
+    def setUp(self):
+        self.customer = User.objects.create_user(email="customer1@example.com", password="password",
+                                                 is_customer=True)
+        Customer.objects.create(user=self.customer, first_name="Customer", last_name="One", phone_num="1111111111")
+        self.reader = User.objects.create_user(email="customer2@example.com", password="password",
+                                               is_customer=True)
+        Customer.objects.create(user=self.reader, first_name="Customer", last_name="Two", phone_num="2222222222")
+        self.authorization = 'Bearer ' + str(RefreshToken.for_user(self.reader).access_token)
+
+    def test_reads_of_other_customers_are_audited_on_flush(self):
+        c = Client()
+        c.get(f'/checkin/customer/{self.reader.id}/', HTTP_AUTHORIZATION=self.authorization)
+        with self.assertNumQueries(2):
+            response = c.get(f'/checkin/customer/{self.customer.id}/', HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(AuditEvent.objects.exists())
+
+        self.assertEqual(audit_log.flush(), 1)
+        event = AuditEvent.objects.get()
+        self.assertEqual((event.actor_id, event.action), (self.reader.id, AuditEvent.CUSTOMER_DETAIL))
+        self.assertEqual(event.subjects, [str(self.customer.id)])
+
+    def test_events_go_back_to_the_buffer_when_a_write_fails(self):
+        audit_log.record(AuditEvent.EXPORT, self.reader, [self.customer])
+        with override_settings(AUDIT_LOG=dict(settings.AUDIT_LOG, BACKEND='missing')):
+            self.assertRaises(KeyError, audit_log.flush)
+        self.assertEqual(len(audit_log.buffer), 1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'access.jsonl'
+            with override_settings(AUDIT_LOG=dict(settings.AUDIT_LOG, BACKEND='file', FILE_PATH=str(path))):
+                audit_log.flush()
+            self.assertEqual(json.loads(path.read_text())['subjects'], [str(self.customer.id)])
+
+    def test_buffered_events_are_written_at_exit_by_the_process_that_recorded_them(self):
+        self.addCleanup(setattr, audit_log, 'pid', audit_log.pid)
+        # Recorded without a flusher thread, as with BACKGROUND off
+        audit_log.record(AuditEvent.EXPORT, self.reader, [self.customer])
+        audit_log.pid = os.getpid() + 1
+        flush_at_exit()
+        self.assertFalse(AuditEvent.objects.exists())
+
+        audit_log.pid = os.getpid()
+        flush_at_exit()
+        self.assertEqual(len(audit_log.buffer), 0)
+        self.assertEqual(AuditEvent.objects.get().subjects, [str(self.customer.id)])
+
+
+class BusinessVisitorLogTests(TestCase):
+    def setUp(self):
+        self.business = User.objects.create_user(email="business1@example.com", password="password")
+        Business.objects.create(user=self.business, name="Business One", phone_num="1000000000",
+                                street_address="1234 Street St.", city="City", postal_code="E4X 2M1",
+                                province="Ontario", capacity=100)
+        self.customer = User.objects.create_user(email="customer1@example.com", password="password",
+                                                 is_customer=True)
+        Customer.objects.create(user=self.customer, first_name="Customer", last_name="One", phone_num="1111111111")
+        for hour in (9, 10, 10, 11):
+            Visit.objects.create(dateTime=f'2021-01-25 {hour}:00:00', customer_id=self.customer.id,
+                                 business_id=self.business.id, numVisitors=1)
+            UnregisteredVisit.objects.create(dateTime=f'2021-01-25 {hour}:00:00', first_name="Walk", last_name="In",
+                                             phone_num="2222222222", business_id=self.business.id, numVisitors=2)
+        Visit.objects.create(dateTime='2021-01-26 09:00:00', customer_id=self.customer.id,
+                             business_id=self.business.id, numVisitors=1)
+        self.url = f'/checkin/business/{self.business.id}/visitors/'
+        self.authorization = 'Bearer ' + str(RefreshToken.for_user(self.business).access_token)
+
+    def get(self, query):
+        response = Client().get(self.url + query, HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def test_pages_merge_both_kinds_of_visit_in_order(self):
+        visits, query = [], '?day=2021-01-25&limit=3'
+        while query is not None:
+            body = self.get(query)
+            visits += body['results']
+            query = body['next'] and f'?day=2021-01-25&limit=3&after={body["next"]}'
+
+        self.assertEqual(len(visits), 8)
+        self.assertEqual([visit['registered'] for visit in visits[:2]], [True, False])
+        self.assertEqual(visits[0]['first_name'], "Customer")
+        self.assertEqual([visit['dateTime'] for visit in visits], sorted(visit['dateTime'] for visit in visits))
+        self.assertEqual(len({(visit['registered'], visit['id']) for visit in visits}), 8)
+
+    def test_tail_only_returns_new_visits(self):
+        tail = self.get('?day=2021-01-25&limit=1')['tail']
+        self.assertEqual(self.get(f'?since={tail}')['results'], [])
+
+        UnregisteredVisit.objects.create(dateTime='2021-01-25 08:00:00', first_name="Late", last_name="Entry",
+                                         phone_num="3333333333", business_id=self.business.id, numVisitors=1)
+        body = self.get(f'?since={tail}')
+        self.assertEqual([visit['first_name'] for visit in body['results']], ["Late"])
+        self.assertEqual(self.get(f'?since={body["tail"]}')['results'], [])
+
+    def test_only_the_business_can_read_its_log(self):
+        response = Client().get(self.url, HTTP_AUTHORIZATION='Bearer ' + str(
+            RefreshToken.for_user(self.customer).access_token))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = Client().get(self.url + '?after=garbage', HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_tampered_cursor_is_rejected(self):
+        for decoded in ('garbage|0|1', '2021-02-30T10:00:00|0|1', '2021-01-25T10:00:00|0|x'):
+            cursor = base64.urlsafe_b64encode(decoded.encode()).decode()
+            response = Client().get(self.url + '?after=' + cursor, HTTP_AUTHORIZATION=self.authorization)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, decoded)
+
+
+class EventStreamTests(TransactionTestCase):
+    """The stream reads from worker threads, which only see committed rows."""
+
+    def setUp(self):
+        self.business = User.objects.create_user(email="business1@example.com", password="password")
+        Business.objects.create(user=self.business, name="Business One", phone_num="1000000000",
+                                street_address="1234 Street St.", city="City", postal_code="E4X 2M1",
+                                province="Ontario", capacity=100)
+        self.customer = User.objects.create_user(email="customer1@example.com", password="password",
+                                                 is_customer=True)
+        Customer.objects.create(user=self.customer, first_name="Customer", last_name="One", phone_num="1111111111")
+
+    def stream(self, user, during, headers=()):
+        """Follow the business's stream as user, run during() once it is open, and return what was sent."""
+        application = EventStreamApplication(None)
+        messages = []
+
+        async def follow():
+            closed = asyncio.Event()
+
+            async def receive():
+                await closed.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+
+            token = str(RefreshToken.for_user(user).access_token)
+            scope = {'type': 'http', 'method': 'GET', 'path': f'/checkin/business/{self.business.id}/events/',
+                     'query_string': f'token={token}'.encode(), 'headers': list(headers)}
+            stream = asyncio.ensure_future(application(scope, receive, send))
+            try:
+                await during(application, messages)
+            finally:
+                closed.set()
+                await stream
+                if application.feed_task is not None:
+                    application.feed_task.cancel()
+
+        with override_settings(EVENT_STREAM=dict(settings.EVENT_STREAM, POLL_INTERVAL=0.01)):
+            async_to_sync(follow)()
+        return b''.join(message.get('body', b'') for message in messages)
+
+    async def wait_for(self, condition):
+        for i in range(500):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('Timed out waiting for the event stream')
+
+    def test_checkins_and_occupancy_are_pushed(self):
+        async def during(application, messages):
+            await self.wait_for(lambda: application.feed is not None and application.feed.last_ids is not None)
+            await sync_to_async(Visit.objects.create)(dateTime=timezone.now(), customer_id=self.customer.id,
+                                                      business_id=self.business.id, numVisitors=3)
+            await self.wait_for(lambda: any(b'"visitors": 3' in message.get('body', b'') for message in messages))
+
+        body = self.stream(self.business, during).decode()
+        self.assertIn('event: occupancy\ndata: {"visitors": 0}', body)
+        self.assertIn('event: checkin\nid: ', body)
+        self.assertIn('"first_name": "Customer"', body)
+
+    def test_other_users_cannot_follow_a_business(self):
+        async def during(application, messages):
+            await self.wait_for(lambda: messages)
+
+        body = self.stream(self.customer, during)
+        self.assertIn(b'Not allowed', body)
+
+    def test_slow_subscribers_lose_their_oldest_events(self):
+        with override_settings(EVENT_STREAM=dict(settings.EVENT_STREAM, QUEUE_SIZE=2)):
+            subscription = Subscription(str(self.business.id))
+        for i in range(5):
+            subscription.offer(i)
+        self.assertEqual(subscription.dropped, 3)
+        self.assertEqual([subscription.queue.get_nowait() for i in range(2)], [3, 4])
+
+    def test_reconnecting_screen_catches_up_on_every_missed_batch_with_ids(self):
+        visits = [Visit.objects.create(dateTime=timezone.now(), customer_id=self.customer.id,
+                                       business_id=self.business.id, numVisitors=1) for i in range(3)]
+        walk_in = UnregisteredVisit.objects.create(dateTime=timezone.now(), first_name="Walk", last_name="In",
+                                                   phone_num="6135550101", business_id=self.business.id,
+                                                   numVisitors=1)
+
+        async def during(application, messages):
+            await self.wait_for(lambda: any(b'event: occupancy' in message.get('body', b'') for message in messages))
+
+        with override_settings(EVENT_STREAM=dict(settings.EVENT_STREAM, BATCH_SIZE=2)):
+            body = self.stream(self.business, during, [(b'last-event-id', b'0.0')]).decode()
+        ids = re.findall(r'^id: (.*)$', body, re.M)
+        # The first batch holds two of the visits and the walk-in, the second the last visit
+        self.assertEqual(ids, ['%d.0' % visits[0].pk, '%d.0' % visits[1].pk, '%d.%d' % (visits[1].pk, walk_in.pk),
+                               '%d.%d' % (visits[2].pk, walk_in.pk)])
+        self.assertLess(body.index('event: checkin'), body.index('event: occupancy'))
+
+    def test_live_checkins_already_sent_while_catching_up_are_skipped(self):
+        subscription = Subscription(str(self.business.id))
+        subscription.offer(((0, 3), b'old'))
+        subscription.offer((None, b'occupancy'))
+        subscription.offer(((1, 8), b'new'))
+        sent = []
+
+        async def relay():
+            disconnected = asyncio.get_event_loop().create_future()
+
+            async def send(message):
+                sent.append(message['body'])
+                if len(sent) == 2:
+                    disconnected.set_result(None)
+
+            await EventStreamApplication(None).relay(subscription, disconnected, send, (3, 7))
+
+        async_to_sync(relay)()
+        self.assertEqual(sent, [b'occupancy', b'new'])
+
+
+class VisitSummaryTests(VisitFixtureMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.add_customer("customer@example.com")
+        self.user = self.customer.user
+        self.authorization = 'Bearer ' + str(RefreshToken.for_user(self.user).access_token)
+
+    def summary(self):
+        return Client().get(f'/checkin/customer/{self.user.id}/visit_summary/',
+                            HTTP_AUTHORIZATION=self.authorization).json()
+
+    def test_check_ins_are_counted_as_they_arrive(self):
+        self.assertEqual(self.summary(), {'total_visits': 0, 'last_visit': None, 'venues_visited': 0})
+        for date_time in ("2021-03-24 20:30:00", "2021-03-22 10:00:00"):
+            Client().post('/checkin/visit/create_visit/', data={
+                "dateTime": date_time, "customer": str(self.user.id), "numVisitors": 1,
+                "token": make_checkin_token(self.businesses[0].pk)}, content_type="application/json",
+                HTTP_AUTHORIZATION=self.authorization)
+        business = self.businesses[1].user
+        Client().post('/checkin/visit/business_create_visit/', data={
+            "dateTime": "2021-03-23 12:00:00", "customer": "customer@example.com", "business": str(business.id),
+            "numVisitors": 1}, content_type="application/json",
+            HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(business).access_token))
+
+        self.assertEqual(self.summary(),
+                         {'total_visits': 3, 'last_visit': '2021-03-24T20:30:00', 'venues_visited': 2})
+
+    def test_only_the_customer_can_read_their_summary(self):
+        response = Client().get(f'/checkin/customer/{self.user.id}/visit_summary/', HTTP_AUTHORIZATION='Bearer ' +
+                                str(RefreshToken.for_user(self.businesses[0].user).access_token))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_purge_takes_visits_off_the_summary(self):
+        for date_time, business in (("2021-01-01 10:00:00", 0), ("2021-01-02 10:00:00", 1),
+                                    ("2021-03-01 10:00:00", 0)):
+            Visit.objects.record(dateTime=date_time, customer=self.customer, business=self.businesses[business],
+                                 numVisitors=1)
+
+        self.assertEqual(Visit.objects.purge(timezone.datetime(2021, 2, 1)), 2)
+        self.assertEqual(self.summary(),
+                         {'total_visits': 1, 'last_visit': '2021-03-01T10:00:00', 'venues_visited': 1})
+        self.assertEqual(list(CustomerVenue.objects.values_list('business_id', 'visits')),
+                         [(self.businesses[0].pk, 1)])
+
+        Visit.objects.purge(timezone.datetime(2021, 4, 1))
+        self.assertFalse(VisitSummary.objects.exists())
+        self.assertEqual(self.summary()['total_visits'], 0)
+
+    def test_rebuild_recounts_from_one_aggregate_query(self):
+        for date_time, business in (("2021-01-01 10:00:00", 0), ("2021-01-02 10:00:00", 1),
+                                    ("2021-01-03 10:00:00", 1)):
+            Visit.objects.record(dateTime=date_time, customer=self.customer, business=self.businesses[business],
+                                 numVisitors=1)
+        expected = self.summary()
+        VisitSummary.objects.update(total_visits=99, venues_visited=0, last_visit=None)
+        CustomerVenue.objects.all().delete()
+
+        with CaptureQueriesContext(connection) as queries:
+            out = io.StringIO()
+            call_command('rebuild_visit_summaries', stdout=out)
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if 'FROM "checkin_visit"' in query['sql']]), 1)
+        self.assertIn('Rebuilt 1 visit summaries', out.getvalue())
+        self.assertEqual(self.summary(), expected)
+        self.assertEqual(CustomerVenue.objects.count(), 2)
+
+    def test_visits_on_another_shard_are_counted_there_without_touching_default(self):
+        add_visit_shard(self)
+        business = add_business("business2@example.com", shard='visits1')
+        with CaptureQueriesContext(connection) as queries:
+            Visit.objects.record(dateTime="2021-03-24 20:30:00", customer=self.customer, business=business,
+                                 numVisitors=1)
+        self.assertEqual(queries.captured_queries, [])
+        self.assertEqual(VisitSummary.objects.using('visits1').get(customer=self.customer).total_visits, 1)
+        self.assertFalse(VisitSummary.objects.exists())
+
+
+class DuplicateCheckinTests(VisitFixtureMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.add_customer("customer@example.com")
+        self.user = self.customer.user
+
+    def scan(self, date_time, business=0, num_visitors=1):
+        return Client().post('/checkin/visit/create_visit/', data={
+            "dateTime": date_time, "customer": str(self.user.id), "numVisitors": num_visitors,
+            "token": make_checkin_token(self.businesses[business].pk)}, content_type="application/json",
+            HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+
+    def test_repeat_scan_within_window_is_merged(self):
+        self.assertEqual(self.scan("2021-03-24 20:30:00").status_code, status.HTTP_201_CREATED)
+        response = self.scan("2021-03-24 20:35:00", num_visitors=3)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(list(Visit.objects.values_list('dateTime', 'numVisitors')),
+                         [(timezone.datetime(2021, 3, 24, 20, 30), 3)])
+        self.assertEqual(VisitSummary.objects.get(customer=self.customer).total_visits, 1)
+
+    def test_staff_entry_merges_into_the_customers_scan(self):
+        self.scan("2021-03-24 20:30:00", num_visitors=2)
+        business = self.businesses[0].user
+        response = Client().post('/checkin/visit/business_create_visit/', data={
+            "dateTime": "2021-03-24 20:25:00", "customer": "customer@example.com", "business": str(business.id),
+            "numVisitors": 1}, content_type="application/json",
+            HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(business).access_token))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(Visit.objects.values_list('numVisitors', flat=True)), [2])
+
+    def test_check_ins_outside_the_window_or_at_another_business_are_kept(self):
+        for date_time, business in (("2021-03-24 20:30:00", 0), ("2021-03-24 20:41:00", 0),
+                                    ("2021-03-24 20:42:00", 1)):
+            self.assertEqual(self.scan(date_time, business).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Visit.objects.count(), 3)
+
+    @override_settings(DUPLICATE_CHECKINS={'WINDOW': None})
+    def test_window_can_be_turned_off(self):
+        for date_time in ("2021-03-24 20:30:00", "2021-03-24 20:30:00"):
+            self.assertEqual(self.scan(date_time).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Visit.objects.count(), 2)
+
+    def test_lookup_uses_the_customer_business_index(self):
+        window = dedupe.dedupe_setting('WINDOW')
+        date_time = timezone.datetime(2021, 3, 24, 20, 30)
+        plan = Visit.objects.filter(customer=self.customer, business=self.businesses[0],
+                                    dateTime__range=(date_time - window, date_time + window)).explain()
+        self.assertIn('checkin_vis_custome', plan)
+
+
+class DuplicateCheckinCacheTests(VisitFixtureMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.add_customer("customer@example.com")
+        self.business = self.businesses[0]
+
+    def test_repeat_within_window_is_answered_from_the_cache(self):
+        first, created = Visit.objects.record(dateTime="2021-03-24 20:30:00", customer=self.customer,
+                                              business=self.business, numVisitors=1)
+        self.assertTrue(created)
+
+        with CaptureQueriesContext(connection) as queries:
+            visit, created = Visit.objects.record(dateTime="2021-03-24 20:31:00", customer=self.customer,
+                                                  business=self.business, numVisitors=1)
+            self.assertFalse([query for query in queries.captured_queries if 'checkin_visit' in query['sql']])
+        self.assertFalse(created)
+        self.assertEqual(visit.pk, first.pk)
+        self.assertEqual(Visit.objects.count(), 1)
+
+    def test_merge_runs_on_the_shard_and_is_cached_once_it_commits(self):
+        add_visit_shard(self)
+        business = add_business("business2@example.com", shard='visits1')
+        Visit.objects.record(dateTime="2021-03-24 20:30:00", customer=self.customer, business=business,
+                             numVisitors=1)
+        caches[dedupe.dedupe_setting('CACHE')].clear()
+
+        with CaptureQueriesContext(connection) as queries, self.assertRaises(RuntimeError):
+            with transaction.atomic(using='visits1'):
+                Visit.objects.record(dateTime="2021-03-24 20:31:00", customer=self.customer, business=business,
+                                     numVisitors=3)
+                raise RuntimeError('rolled back')
+        self.assertEqual(queries.captured_queries, [])
+        self.assertIsNone(dedupe.recent(self.customer.pk, business.pk))
+        self.assertEqual(Visit.objects.for_business(business).get().numVisitors, 1)
+
+
+class ContactGraphTests(VisitFixtureMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customers = {name: self.add_customer(f"{name}@example.com", first_name=name, last_name="Customer")
+                          for name in ("a", "b", "c", "d")}
+
+    def visit(self, name, date_time, business=0):
+        visit, created = Visit.objects.record(dateTime=date_time, customer=self.customers[name],
+                                              business=self.businesses[business], numVisitors=1)
+        contacts.add_visit(visit)
+
+    def edges(self):
+        names = {customer.pk: name for name, customer in self.customers.items()}
+        return {(names[customer_id], names[contact_id], last_contact)
+                for customer_id, contact_id, last_contact in
+                Contact.objects.values_list('customer_id', 'contact_id', 'last_contact')}
+
+    def chain(self):
+        """a and b meet at the first business, b and c at the second, then c and d at the first a day later."""
+        for name, date_time, business in (("a", "2021-03-01 10:00:00", 0), ("b", "2021-03-01 10:30:00", 0),
+                                          ("b", "2021-03-01 14:00:00", 1), ("c", "2021-03-01 14:20:00", 1),
+                                          ("c", "2021-03-02 09:00:00", 0), ("d", "2021-03-02 09:45:00", 0)):
+            self.visit(name, date_time, business)
+
+    def test_check_ins_queue_the_edges_they_add(self):
+        for name, date_time in (("a", "2021-03-01 10:00:00"), ("b", "2021-03-01 10:30:00"),
+                                ("c", "2021-03-01 12:00:00")):
+            user = self.customers[name].user
+            Client().post('/checkin/visit/create_visit/', data={
+                "dateTime": date_time, "customer": str(user.id), "numVisitors": 1,
+                "token": make_checkin_token(self.businesses[0].pk)}, content_type="application/json",
+                HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(user).access_token))
+
+        self.assertEqual(jobs.work(burst=True), 3)
+        later = timezone.datetime(2021, 3, 1, 10, 30)
+        self.assertEqual(self.edges(), {("a", "b", later), ("b", "a", later)})
+
+    def test_trace_walks_one_query_per_hop(self):
+        self.chain()
+        start = [self.customers["a"].pk]
+
+        with self.assertNumQueries(2):
+            hops = contacts.trace(start, 2)
+        names = {customer.pk: name for name, customer in self.customers.items()}
+        self.assertEqual({names[customer_id]: hop for customer_id, hop in hops.items()}, {"a": 0, "b": 1, "c": 2})
+        self.assertEqual(len(contacts.trace(start, 3)), 4)
+        self.assertEqual(len(contacts.trace(start, 3, since=timezone.datetime(2021, 3, 1, 12))), 1)
+
+    def test_rebuild_matches_the_incremental_graph(self):
+        self.chain()
+        expected = self.edges()
+        Contact.objects.all().delete()
+
+        out = io.StringIO()
+        call_command('rebuild_contact_graph', stdout=out)
+        self.assertIn('Wrote 6 contact edges', out.getvalue())
+        self.assertEqual(self.edges(), expected)
+
+    def test_exposure_notices_can_reach_contacts_of_the_exposed(self):
+        self.chain()
+        call_command('notify_exposed', str(self.businesses[1].pk), '2021-03-01T13:00:00', '2021-03-01T15:00:00',
+                     message='Possible exposure', contact_depth=1, stdout=io.StringIO())
+        # a met b before the exposure started
+        self.assertEqual(set(Notification.objects.values_list('customer__first_name', flat=True)),
+                         {"b", "c", "d"})
+
+
+class SnapshotExportTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        user = User.objects.create_user(email="customer@example.com", password="password", is_customer=True)
+        self.customer = Customer.objects.create(user=user, first_name="Customer", last_name="One", phone_num="1")
+        user = User.objects.create_user(email="business@example.com", password="password")
+        self.business = Business.objects.create(user=user, name="Business", phone_num="1", street_address="1 St.",
+                                                city="City", postal_code="E4X 2M1", province="Ontario", capacity=10)
+        for date_time in ("2021-03-01 10:00:00", "2021-03-01 18:00:00", "2021-03-02 09:00:00"):
+            Visit.objects.create(dateTime=date_time, customer=self.customer, business=self.business, numVisitors=1)
+        UnregisteredVisit.objects.create(dateTime="2021-03-01 12:00:00", first_name="Walk", last_name="In",
+                                         phone_num="6135550101", business=self.business, numVisitors=2)
+
+    def export(self):
+        return SnapshotExport(self.directory.name).run()
+
+    def parts(self, table):
+        return sorted(str(path.relative_to(Path(self.directory.name, table)).parent)
+                      for path in Path(self.directory.name, table).glob('*/*.csv.gz'))
+
+    def rows(self, table):
+        rows = []
+        for path in Path(self.directory.name, table).glob('*/*.csv.gz'):
+            with gzip.open(path, 'rt', newline='') as file:
+                rows.extend(csv.DictReader(file))
+        return rows
+
+    def test_runs_append_only_new_visits_partitioned_by_date(self):
+        self.assertEqual(self.export(), {'visit': 3, 'unregistered_visit': 1, 'business': 1})
+        self.assertEqual(self.parts('visit'), ['date=2021-03-01', 'date=2021-03-02'])
+        self.assertEqual(self.rows('unregistered_visit')[0]['numVisitors'], '2')
+        self.assertNotIn('phone_num', self.rows('unregistered_visit')[0])
+
+        self.assertEqual(self.export(), {'visit': 0, 'unregistered_visit': 0, 'business': 1})
+        Visit.objects.create(dateTime="2021-03-02 11:00:00", customer=self.customer, business=self.business,
+                             numVisitors=3)
+        self.assertEqual(self.export()['visit'], 1)
+
+        self.assertEqual(self.parts('visit'), ['date=2021-03-01', 'date=2021-03-02', 'date=2021-03-02'])
+        self.assertEqual(sorted(int(row['id']) for row in self.rows('visit')),
+                         sorted(Visit.objects.values_list('pk', flat=True)))
+        self.assertEqual(len(self.rows('business')), 3)
+        self.assertEqual(audit_log.flush(), 3)
+        self.assertEqual(set(AuditEvent.objects.values_list('action', flat=True)), {AuditEvent.EXPORT})
+
+    def test_visits_moved_by_rebalancing_are_not_taken_for_new_ones(self):
+        self.export()
+        path = str(Path(self.directory.name, 'retired.sqlite3'))
+        connections.databases['retired1'] = dict(connections.databases['default'], NAME=path)
+        self.addCleanup(connections.databases.pop, 'retired1')
+        call_command('migrate', database='retired1', verbosity=0)
+        Visit.objects.using('retired1').create(dateTime="2021-03-03 10:00:00", customer=self.customer,
+                                               business=self.business, numVisitors=1)
+        connections['retired1'].close()
+
+        call_command('rebalance_visit_shards', retired=[path], stdout=io.StringIO())
+        self.assertEqual(Visit.objects.count(), 4)
+        self.assertEqual(ShardMove.objects.get().source, 'retired1')
+        self.assertEqual(self.export()['visit'], 0)
+
+    def test_failed_run_leaves_no_files_and_keeps_the_watermark(self):
+        with mock.patch.object(SnapshotExport, 'export_businesses', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.export()
+        self.assertEqual(self.parts('visit'), [])
+        self.assertFalse(Path(self.directory.name, 'watermarks.json').exists())
+
+        out = io.StringIO()
+        call_command('export_snapshot', directory=self.directory.name, stdout=out)
+        self.assertIn('Exported 3 visits, 1 unregistered visits and 1 businesses', out.getvalue())
+        self.assertEqual(audit_log.flush(), 1)
+        self.assertEqual(AuditEvent.objects.get().detail['rows'],
+                         {'visit': 3, 'unregistered_visit': 1, 'business': 1})
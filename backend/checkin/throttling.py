@@ -0,0 +1,89 @@
+"""Token-bucket throttles applied per route in checkin.urls."""
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+from .qr import InvalidCheckinToken, verify_checkin_token
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """Turn a rate such as '30/min' into tokens per second."""
+    count, period = rate.split('/')
+    return int(count) / DURATIONS[period[0]]
+
+
+def body_field(request, name):
+    """A field of the request body, or None when the body isn't an object; throttles run before validation."""
+    data = request.data
+    return data.get(name) if hasattr(data, 'get') else None
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Admit a request while the caller's bucket holds a token, refilling continuously at rate.
+
+    Each bucket is a single cache entry, so a check is one get and one set. The lock makes that atomic
+    within a process; with a cache shared between processes, concurrent requests may overdraw slightly.
+    """
+
+    scope = None
+    rate = None
+    burst = None
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.tokens_per_second = parse_rate(self.rate)
+        self.capacity = self.burst or max(int(self.tokens_per_second * 60), 1)
+        self.cache = caches[settings.THROTTLE_CACHE]
+        self.deficit = 0.0
+
+    def get_ident_for_scope(self, request, view):
+        if self.scope == 'ip':
+            return self.get_ident(request)
+        if self.scope == 'user':
+            if request.user and request.user.is_authenticated:
+                return str(request.user.pk)
+            # Logins are throttled per attempted account to slow credential stuffing
+            return str(body_field(request, 'email') or '').strip().lower() or None
+        if self.scope == 'business':
+            # Only the venue's own account or a token signed for it spends the venue's bucket; a business id in
+            # the body isn't validated yet, so keying on it would let anyone drain another venue's bucket
+            if request.user and request.user.is_authenticated and not request.user.is_customer:
+                return request.user.pk.hex
+            token = body_field(request, 'token')
+            if token:
+                try:
+                    return verify_checkin_token(token).hex
+                except InvalidCheckinToken:
+                    return None
+            return None
+        raise ValueError('Unknown throttle scope ' + str(self.scope))
+
+    def allow_request(self, request, view):
+        ident = self.get_ident_for_scope(request, view)
+        if ident is None:
+            return True
+        key = 'throttle:%s:%s:%s' % (view.__class__.__name__, self.scope, ident)
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.cache.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.tokens_per_second)
+            if tokens < 1:
+                self.deficit = 1 - tokens
+                return False
+            self.cache.set(key, (tokens - 1, now), int(self.capacity / self.tokens_per_second) + 1)
+        return True
+
+    def wait(self):
+        return self.deficit / self.tokens_per_second
+
+
+def bucket(scope, rate, burst=None):
+    """Build a throttle class for one route, e.g. bucket('ip', '60/min', burst=20)."""
+    return type('%sTokenBucketThrottle' % scope.title(), (TokenBucketThrottle,),
+                {'scope': scope, 'rate': rate, 'burst': burst})
@@ -1,24 +1,45 @@
 from django.urls import path
-from rest_framework_simplejwt import views as jwt_views
 from . import views
+from .throttling import bucket
+
+# Each login hashes a password, so attempts are limited per account and per client address
+token_throttles = [bucket('user', '10/min', burst=10), bucket('ip', '120/min', burst=120)]
+# Check-ins are limited per customer, per venue and per client address so one looping kiosk can't starve the rest
+visit_throttles = [bucket('user', '30/min', burst=30), bucket('business', '600/min', burst=200),
+                   bucket('ip', '300/min', burst=300)]
+# Typeahead fires on every keystroke but must not let anyone page through all customers
+search_throttles = [bucket('user', '60/min', burst=30), bucket('ip', '120/min', burst=60)]
 
 urlpatterns = [
-    path('api/token/', views.CustomTokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('api/token/refresh/', jwt_views.TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/token/', views.CustomTokenObtainPairView.as_view(throttle_classes=token_throttles),
+         name='token_obtain_pair'),
+    path('api/token/refresh/', views.CustomTokenRefreshView.as_view(), name='token_refresh'),
 
     path('checkin/customer/', views.CustomerList.as_view()),
     path('checkin/customer/create_account/', views.CustomerCreate.as_view()),
+    path('checkin/customer/import_accounts/', views.AccountImport.as_view(kind='customer')),
+    path('checkin/customer/batch/', views.ProfileBatch.as_view(kind='customer')),
+    path('checkin/customer/search/', views.CustomerSearch.as_view(throttle_classes=search_throttles)),
     path('checkin/customer/<user__id>/', views.CustomerDetail.as_view()),
+    path('checkin/customer/<user__id>/visit_summary/', views.CustomerVisitSummary.as_view()),
 
     path('checkin/business/', views.BusinessList.as_view()),
     path('checkin/business/create_account/', views.BusinessCreate.as_view()),
+    path('checkin/business/import_accounts/', views.AccountImport.as_view(kind='business')),
+    path('checkin/business/batch/', views.ProfileBatch.as_view(kind='business')),
     path('checkin/business/<user__id>/', views.BusinessDetail.as_view()),
+    path('checkin/business/<user__id>/checkin_token/', views.BusinessCheckinToken.as_view()),
+    path('checkin/business/<user__id>/visitors/', views.BusinessVisitorLog.as_view()),
 
     path('checkin/change_password/<id>/', views.ChangePassword.as_view()),
     path('checkin/change_email/<id>/', views.ChangeEmail.as_view()),
 
     path('checkin/visit/', views.VisitList.as_view()),
-    path('checkin/visit/create_visit/', views.VisitCreate.as_view()),
-    path('checkin/visit/business_create_visit/', views.BusinessAddedVisitCreate.as_view()),
-    path('checkin/visit/business_create_unregistered_visit/', views.BusinessAddUnregisteredVisitCreate.as_view()),
+    path('checkin/visit/create_visit/', views.VisitCreate.as_view(throttle_classes=visit_throttles)),
+    path('checkin/visit/business_create_visit/',
+         views.BusinessAddedVisitCreate.as_view(throttle_classes=visit_throttles)),
+    path('checkin/visit/business_create_unregistered_visit/',
+         views.BusinessAddUnregisteredVisitCreate.as_view(throttle_classes=visit_throttles)),
+
+    path('checkin/slow_queries/', views.SlowQueryList.as_view()),
 ]
@@ -1,59 +1,117 @@
+from datetime import datetime, time, timedelta
+
 from django.contrib.auth import update_session_auth_hash
+from django.http import HttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
 from rest_framework import mixins, generics, status
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.views import TokenObtainPairView
-
-from .models import Customer, User, Business, Visit
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+
+from . import profiles, provisioning, search, visitor_log
+from .audit import audit_log
+from .jobs import enqueue
+from .models import AccountExists, AuditEvent, Customer, User, Business, Visit, VisitSummary
+from .qr import make_checkin_token, render_qr_code
+from .revocation import revocations
+from .routers import ReplicaReadMixin
 from .serializers import CustomerSerializer, UserSerializer, BusinessSerializer, ChangePasswordSerializer, \
     VisitSerializer, CustomTokenObtainPairSerializer, ChangeEmailSerializer, BusinessAddedVisitSerializer, \
-    BusinessAddedUnregisteredVisitSerializer, DeactivateUserSerializer
+    BusinessAddedUnregisteredVisitSerializer, DeactivateUserSerializer, CustomTokenRefreshSerializer
+from .slowqueries import slow_queries
 
 
 class CustomTokenObtainPairView(TokenObtainPairView):
     serializer_class = CustomTokenObtainPairSerializer
 
 
+class CustomTokenRefreshView(TokenRefreshView):
+    serializer_class = CustomTokenRefreshSerializer
+
+
 class CustomerCreate(mixins.CreateModelMixin,
                      APIView):
     permission_classes = (AllowAny,)
 
     def post(self, request, *args, **kwargs):
         serializer = CustomerSerializer(data=request.data)
-        if serializer.is_valid():
-            serializer.create(validated_data=request.data)
-            return Response(status=status.HTTP_201_CREATED)
-        try:
-            if 'user with this email address already exists' in serializer.errors['user']['email'][0] and len(serializer.errors) == 1:
-                user = User.objects.get(email=serializer.data['user']['email'])
-                if user.is_active:
-                    return Response(serializer.error_messages, status=status.HTTP_403_FORBIDDEN)
-                else:
-                    user.is_active = True
-                    user.set_password(serializer.data.get("user").get("password"))
-                    customer = Customer.objects.get(user=user)
-                    customer.first_name = serializer.data.get("first_name")
-                    customer.last_name = serializer.data.get("last_name")
-                    customer.phone_num = serializer.data.get("phone_num")
-                    customer.contact_pref = serializer.data.get("contact_pref")
-                    user.is_customer = True
-                    user.save()
-                    customer.save()
-                    return Response(status=status.HTTP_201_CREATED)
-        except TypeError:
+        if not serializer.is_valid():
             return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
-        return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            customer = serializer.save()
+        except AccountExists:
+            return Response(serializer.error_messages, status=status.HTTP_403_FORBIDDEN)
+        enqueue('link_unregistered_visits', customer_id=str(customer.pk))
+        return Response(status=status.HTTP_201_CREATED)
+
+
+def retrieve_profile(kind, user_id):
+    """One profile from the shared profile cache, as the detail views return it."""
+    ids = profiles.parse_ids([user_id])
+    profile = profiles.get_many(kind, ids).get(ids[0]) if ids else None
+    if profile is None:
+        return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(profile, status=status.HTTP_200_OK)
+
 
+class ProfileBatch(APIView):
+    """Up to PROFILE_CACHE['MAX_IDS'] profiles of one kind for ?ids=, given comma separated or repeated.
 
-class CustomerList(mixins.ListModelMixin,
+    Profiles come back in the order asked for, in the detail view's shape; ids without a profile are left out.
+    """
+    permission_classes = (IsAuthenticated,)
+    kind = None
+
+    def get(self, request, *args, **kwargs):
+        ids = profiles.parse_ids(request.query_params.getlist('ids'))
+        if len(ids) > profiles.profile_setting('MAX_IDS'):
+            return Response({'detail': 'At most %d ids can be looked up at once.' % profiles.profile_setting('MAX_IDS')},
+                            status=status.HTTP_400_BAD_REQUEST)
+        found = profiles.get_many(self.kind, ids)
+        results = [found[pk] for pk in ids if pk in found]
+        others = [pk for pk in found if pk != str(request.user.pk)]
+        if self.kind == 'customer' and others:
+            audit_log.record(AuditEvent.CUSTOMER_LIST, request.user, others, path=request.path)
+        return Response(results, status=status.HTTP_200_OK)
+
+
+class CustomerSearch(APIView):
+    """Customers whose email or phone number starts with ?q=, for businesses adding a visit by hand.
+
+    Only businesses may search, prefixes must be at least CUSTOMER_SEARCH['MIN_PREFIX'] characters, results are
+    capped at MAX_RESULTS and requests are throttled, so walking through every account is slow and audited.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        if not Business.objects.filter(pk=request.user.pk).exists():
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        try:
+            limit = int(request.query_params.get('limit', 0))
+        except ValueError:
+            limit = 0
+        customers = search.search(request.query_params.get('q', ''), limit)
+        if customers:
+            audit_log.record(AuditEvent.CUSTOMER_LIST, request.user, [str(customer.pk) for customer in customers],
+                             path=request.path)
+        return Response([{'id': customer.pk, 'email': customer.user.email, 'first_name': customer.first_name,
+                          'last_name': customer.last_name} for customer in customers], status=status.HTTP_200_OK)
+
+
+class CustomerList(ReplicaReadMixin,
+                   mixins.ListModelMixin,
                    generics.GenericAPIView):
     permission_classes = (IsAuthenticated,)
-    queryset = Customer.objects.all()
+    queryset = Customer.objects.select_related('user')
     serializer_class = CustomerSerializer
 
     def get(self, request, *args, **kwargs):
-        return self.list(request, *args, **kwargs)
+        response = self.list(request, *args, **kwargs)
+        audit_log.record(AuditEvent.CUSTOMER_LIST, request.user,
+                         [customer['user']['id'] for customer in response.data], path=request.path)
+        return response
 
 
 class CustomerDetail(mixins.RetrieveModelMixin,
@@ -61,12 +119,15 @@ class CustomerDetail(mixins.RetrieveModelMixin,
                      mixins.DestroyModelMixin,
                      generics.GenericAPIView):
     permission_classes = (IsAuthenticated,)
-    queryset = Customer.objects.all()
+    queryset = Customer.objects.select_related('user')
     serializer_class = CustomerSerializer
     lookup_field = 'user__id'
 
     def get(self, request, *args, **kwargs):
-        return self.retrieve(request, *args, **kwargs)
+        response = retrieve_profile('customer', kwargs['user__id'])
+        if str(request.user.pk) != kwargs['user__id']:
+            audit_log.record(AuditEvent.CUSTOMER_DETAIL, request.user, [kwargs['user__id']], path=request.path)
+        return response
 
     def put(self, request, *args, **kwargs):
         return self.partial_update(request, *args, **kwargs)
@@ -79,48 +140,127 @@ class CustomerDetail(mixins.RetrieveModelMixin,
                 return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
             user.is_active = False
             user.save()
+            revocations.revoke(user)
             return Response(status=status.HTTP_200_OK)
         return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
 
 
+class CustomerVisitSummary(APIView):
+    """A customer's total visits, last visit and number of venues visited, for their own home screen."""
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, user__id, *args, **kwargs):
+        if str(request.user.id) != user__id:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        summary = VisitSummary.objects.for_customer(request.user.id)
+        return Response({
+            'total_visits': summary.total_visits if summary else 0,
+            'last_visit': summary.last_visit if summary else None,
+            'venues_visited': summary.venues_visited if summary else 0,
+        }, status=status.HTTP_200_OK)
+
+
 class BusinessCreate(mixins.CreateModelMixin,
                      APIView):
     permission_classes = (AllowAny,)
 
     def post(self, request, *args, **kwargs):
         serializer = BusinessSerializer(data=request.data)
-        if serializer.is_valid():
-            serializer.create(validated_data=request.data)
-            return Response(status=status.HTTP_201_CREATED)
-        try:
-            if 'user with this email address already exists' in serializer.errors['user']['email'][0] and len(serializer.errors) == 1:
-                user = User.objects.get(email=serializer.data['user']['email'])
-                if user.is_active:
-                    return Response(serializer.error_messages, status=status.HTTP_403_FORBIDDEN)
-                else:
-                    user.is_active = True
-                    user.set_password(serializer.data.get("user").get("password"))
-                    business = Business.objects.get(user=user)
-                    business.name = serializer.data.get("name")
-                    business.phone_num = serializer.data.get("phone_num")
-                    business.street_address = serializer.data.get("street_address")
-                    business.city = serializer.data.get("city")
-                    business.postal_code = serializer.data.get("postal_code")
-                    business.province = serializer.data.get("province")
-                    business.capacity = serializer.data.get("capacity")
-                    business.contact_pref = serializer.data.get("contact_pref")
-                    user.save()
-                    business.save()
-                    return Response(status=status.HTTP_201_CREATED)
-        except TypeError:
+        if not serializer.is_valid():
             return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
-        return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            serializer.save()
+        except AccountExists:
+            return Response(serializer.error_messages, status=status.HTTP_403_FORBIDDEN)
+        return Response(status=status.HTTP_201_CREATED)
+
 
+class AccountImport(APIView):
+    """Create many business or customer accounts from a JSON list, JSON lines or CSV with a header row.
+
+    Each row has the create_account fields, with email and password either nested under user or as columns of
+    their own. Rows that fail are listed by line number; the others are created regardless.
+    """
+    permission_classes = (IsAdminUser,)
+    parser_classes = (JSONParser, provisioning.JSONLinesParser, provisioning.CSVParser)
+    kind = None
+
+    def post(self, request, *args, **kwargs):
+        rows = request.data
+        if isinstance(rows, dict):
+            rows = [rows] if rows else []
+        if isinstance(rows, list):
+            rows = ((line, row if isinstance(row, dict) else None) for line, row in enumerate(rows, 1))
+        # A web worker hashes in its own process: forking a pool per request would claim every core for one
+        # upload and copy the worker's threads and connections into the children
+        return Response(provisioning.AccountImport(self.kind, hash_workers=0).run(rows), status=status.HTTP_200_OK)
+
+
+class BusinessCheckinToken(APIView):
+    permission_classes = (IsAuthenticated,)
 
-class BusinessList(mixins.ListModelMixin,
+    def get(self, request, user__id, *args, **kwargs):
+        if str(request.user.id) != user__id:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        token = make_checkin_token(user__id)
+        if request.query_params.get('image') == 'svg':
+            return HttpResponse(render_qr_code(token), content_type='image/svg+xml')
+        return Response({'token': token}, status=status.HTTP_200_OK)
+
+
+def parse_range(params):
+    """The [start, end) window from a day or start/end query parameter, either end open when missing."""
+    if 'day' in params:
+        day = parse_date(params['day'])
+        if day is None:
+            raise ValueError('day must be YYYY-MM-DD')
+        start = datetime.combine(day, time.min)
+        return start, start + timedelta(days=1)
+    bounds = []
+    for name in ('start', 'end'):
+        value = parse_datetime(params[name]) if name in params else None
+        if name in params and value is None:
+            raise ValueError(name + ' must be an ISO 8601 datetime')
+        bounds.append(value)
+    return bounds
+
+
+class BusinessVisitorLog(ReplicaReadMixin, APIView):
+    """A business's registered and unregistered visits in dateTime order, one keyset page at a time.
+
+    Filter with day=YYYY-MM-DD or start/end datetimes and pass the returned next cursor as after= for the
+    following page. Screens that watch for new arrivals poll with since= set to the returned tail cursor.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, user__id, *args, **kwargs):
+        if str(request.user.id) != user__id:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        params = request.query_params
+        try:
+            limit = max(min(int(params.get('limit', 50)), 500), 1)
+            if 'since' in params:
+                results, tail = visitor_log.tail(user__id, visitor_log.decode_tail(params['since']), limit)
+                next_cursor = None
+            else:
+                start, end = parse_range(params)
+                after = visitor_log.decode_cursor(params['after']) if 'after' in params else None
+                results, next_cursor = visitor_log.page(user__id, start, end, after, limit)
+                tail = visitor_log.latest_tail(user__id)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        visits = visitor_log.represent(results)
+        audit_log.record(AuditEvent.VISITOR_LOG, request.user,
+                         {visit['customer'] for visit in visits if visit['customer'] is not None}, path=request.path)
+        return Response({'results': visits, 'next': next_cursor, 'tail': tail}, status=status.HTTP_200_OK)
+
+
+class BusinessList(ReplicaReadMixin,
+                   mixins.ListModelMixin,
                    generics.GenericAPIView):
     permission_classes = (IsAuthenticated,)
-    queryset = Business.objects.all()
+    queryset = Business.objects.select_related('user')
     serializer_class = BusinessSerializer
 
     def get(self, request, *args, **kwargs):
@@ -132,12 +272,12 @@ class BusinessDetail(mixins.RetrieveModelMixin,
                      mixins.DestroyModelMixin,
                      generics.GenericAPIView):
     permission_classes = (IsAuthenticated,)
-    queryset = Business.objects.all()
+    queryset = Business.objects.select_related('user')
     serializer_class = BusinessSerializer
     lookup_field = 'user__id'
 
     def get(self, request, *args, **kwargs):
-        return self.retrieve(request, *args, **kwargs)
+        return retrieve_profile('business', kwargs['user__id'])
 
     def put(self, request, *args, **kwargs):
         return self.partial_update(request, *args, **kwargs,)
@@ -150,6 +290,7 @@ class BusinessDetail(mixins.RetrieveModelMixin,
                 return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
             user.is_active = False
             user.save()
+            revocations.revoke(user)
             return Response(status=status.HTTP_200_OK)
         return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
 
@@ -170,6 +311,7 @@ class ChangePassword(mixins.UpdateModelMixin, generics.GenericAPIView):
             # set_password also hashes the password that the user will get
             user.set_password(serializer.data.get("new_password"))
             user.save()
+            revocations.revoke(user)
             return Response(status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -197,9 +339,14 @@ class VisitCreate(mixins.CreateModelMixin, APIView):
     def post(self, request, *args, **kwargs):
         serializer = VisitSerializer(data=request.data)
         if serializer.is_valid():
-            if serializer.validated_data['customer'].user.is_active and serializer.validated_data['business'].user.is_active:
-                serializer.create(validated_data=request.data)
-                return Response(serializer.data, status=status.HTTP_201_CREATED)
+            business = serializer.validated_data.get('business')
+            if serializer.validated_data['customer'].user.is_active and (business is None or business.user.is_active):
+                visit = serializer.save()
+                if serializer.created:
+                    enqueue('add_contacts', business_id=str(visit.business_id), visit_id=visit.pk)
+                # A repeat of a recent check-in is merged into it rather than created
+                return Response(serializer.data,
+                                status=status.HTTP_201_CREATED if serializer.created else status.HTTP_200_OK)
         return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -209,8 +356,11 @@ class BusinessAddedVisitCreate(mixins.CreateModelMixin, APIView):
     def post(self, request, *args, **kwargs):
         serializer = BusinessAddedVisitSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.create(validated_data=request.data)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            visit = serializer.create(validated_data=request.data)
+            if serializer.created:
+                enqueue('add_contacts', business_id=str(visit.business_id), visit_id=visit.pk)
+            return Response(serializer.data,
+                            status=status.HTTP_201_CREATED if serializer.created else status.HTTP_200_OK)
         return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -225,13 +375,13 @@ class BusinessAddUnregisteredVisitCreate(mixins.CreateModelMixin, APIView):
         return Response(serializer.error_messages, status=status.HTTP_400_BAD_REQUEST)
 
 
-class VisitList(generics.ListAPIView):
+class VisitList(ReplicaReadMixin, generics.ListAPIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = VisitSerializer
 
     def get_queryset(self):
         user = self.request.user.id
-        return Visit.objects.filter(customer=user)
+        return Visit.objects.filter(customer=user).across_shards()
 
     def get(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
@@ -242,9 +392,11 @@ class VisitList(generics.ListAPIView):
             return self.get_paginated_response(serializer.data)
 
         serializer = self.get_serializer(queryset, many=True)
+        # Businesses live on the primary while visits are spread over shards, so they are fetched in one query
+        businesses = Business.objects.in_bulk({serializerVisit['business'] for serializerVisit in serializer.data})
         visits = []
         for serializerVisit in serializer.data:
-            business = Business.objects.get(user__id=serializerVisit['business'])
+            business = businesses[serializerVisit['business']]
             responseVisit = {"dateTime": serializerVisit['dateTime'], "customer": serializerVisit['customer'], 
                              "business_name": business.name, "business_street_address": business.street_address, 
                              "business_city": business.city, "business_postal_code": business.postal_code, 
@@ -252,3 +404,15 @@ class VisitList(generics.ListAPIView):
                              "numVisitors": serializerVisit["numVisitors"]}
             visits.append(responseVisit)
         return Response(visits, status=status.HTTP_200_OK)
+
+
+class SlowQueryList(APIView):
+    """Slow queries seen by this worker process, with the most total time first."""
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(slow_queries.report(), status=status.HTTP_200_OK)
+
+    def delete(self, request, *args, **kwargs):
+        slow_queries.clear()
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,126 @@
+"""A business's visitor log: registered and unregistered visits from its shard merged into one ordered stream."""
+
+import base64
+import heapq
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .models import Customer, UnregisteredVisit, Visit
+
+# Visits come before unregistered visits with the same dateTime
+REGISTERED, UNREGISTERED = 0, 1
+SOURCES = ((REGISTERED, Visit), (UNREGISTERED, UnregisteredVisit))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(entry):
+    return base64.urlsafe_b64encode(('%s|%d|%d' % entry['key']).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        date_time, kind, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        # parse_datetime returns None for a string that isn't shaped like a date, and raises for impossible dates
+        parsed = parse_datetime(date_time)
+        if parsed is None:
+            raise ValueError(date_time)
+        return parsed, int(kind), int(pk)
+    except (ValueError, UnicodeError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def encode_tail(last_ids):
+    return '%d.%d' % last_ids
+
+
+def decode_tail(tail):
+    try:
+        visit_id, unregistered_id = tail.split('.')
+        return int(visit_id), int(unregistered_id)
+    except ValueError:
+        raise InvalidCursor('Invalid tail cursor')
+
+
+def after_key(kind, key):
+    """Rows of one source that sort after key = (dateTime, kind, id)."""
+    date_time, after_kind, pk = key
+    later = Q(dateTime__gt=date_time)
+    if kind > after_kind:
+        return later | Q(dateTime=date_time)
+    if kind == after_kind:
+        return later | Q(dateTime=date_time, pk__gt=pk)
+    return later
+
+
+def entries(kind, rows):
+    for row in rows:
+        yield {'key': (row.dateTime.isoformat(), kind, row.pk), 'row': row}
+
+
+def page(business_id, start=None, end=None, after=None, limit=50):
+    """Up to limit entries in (dateTime, kind, id) order, and the cursor for the next page if there is one.
+
+    Each source reads at most limit + 1 rows with the (business, dateTime) index, so a page costs the same
+    however long the day is.
+    """
+    streams = []
+    for kind, model in SOURCES:
+        rows = model.objects.for_business(business_id)
+        if start is not None:
+            rows = rows.filter(dateTime__gte=start)
+        if end is not None:
+            rows = rows.filter(dateTime__lt=end)
+        if after is not None:
+            rows = rows.filter(after_key(kind, after))
+        streams.append(entries(kind, rows.order_by('dateTime', 'pk')[:limit + 1]))
+    merged = list(heapq.merge(*streams, key=lambda entry: entry['key']))
+    results = merged[:limit]
+    return results, encode_cursor(results[-1]) if len(merged) > limit else None
+
+
+def tail(business_id, since, limit=500):
+    """Entries stored after the tail cursor since, in insertion order per source, and the cursor to poll with next.
+
+    Follows ids rather than dateTime so backdated visits still show up on the next poll.
+    """
+    last_ids = list(since)
+    results = []
+    for kind, model in SOURCES:
+        rows = list(model.objects.for_business(business_id).filter(pk__gt=since[kind]).order_by('pk')[:limit])
+        if rows:
+            last_ids[kind] = rows[-1].pk
+        results.extend(entries(kind, rows))
+    results.sort(key=lambda entry: entry['key'])
+    return results, encode_tail(tuple(last_ids))
+
+
+def latest_tail(business_id):
+    """The tail cursor for a screen that starts watching now."""
+    return encode_tail(tuple(
+        model.objects.for_business(business_id).order_by('-pk').values_list('pk', flat=True).first() or 0
+        for kind, model in SOURCES))
+
+
+def represent(results):
+    """Entries as response dicts, with registered visitors' names looked up in one query."""
+    customers = Customer.objects.in_bulk({entry['row'].customer_id for entry in results
+                                          if entry['key'][1] == REGISTERED})
+    represented = []
+    for entry in results:
+        row, kind = entry['row'], entry['key'][1]
+        person = row if kind == UNREGISTERED else customers.get(row.customer_id)
+        represented.append({
+            'id': row.pk,
+            'registered': kind == REGISTERED,
+            'dateTime': row.dateTime,
+            'customer': row.customer_id,
+            'first_name': getattr(person, 'first_name', ''),
+            'last_name': getattr(person, 'last_name', ''),
+            'phone_num': getattr(person, 'phone_num', ''),
+            'numVisitors': row.numVisitors,
+        })
+    return represented
@@ -0,0 +1,61 @@
+"""Gunicorn settings for serving the backend in production.
+
+Run from the repository root with "gunicorn -c backend/gunicorn.conf.py". The app is imported once in the
+master before workers are forked, so Django and its imports are shared copy-on-write. Workers are
+recycled after CHECKIN_MAX_REQUESTS requests. Send HUP for a graceful restart of all workers, or USR2
+then TERM to the old master to pick up new code.
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+
+CONFIG_LOADED = time.monotonic()
+
+logger = logging.getLogger('gunicorn.error')
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = os.environ.get('CHECKIN_BIND', '0.0.0.0:8000')
+
+# "sync" and "gthread" serve backend.wsgi; "uvicorn" serves backend.asgi from an event loop per worker
+worker_type = os.environ.get('CHECKIN_WORKER_CLASS', 'sync')
+if worker_type == 'uvicorn':
+    worker_class = 'uvicorn.workers.UvicornH11Worker'
+    wsgi_app = 'backend.asgi:application'
+else:
+    worker_class = worker_type
+    wsgi_app = 'backend.wsgi:application'
+
+workers = int(os.environ.get('CHECKIN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('CHECKIN_THREADS', 1))
+preload_app = True
+max_requests = int(os.environ.get('CHECKIN_MAX_REQUESTS', 1000))
+# Spread restarts out so workers don't all recycle at once
+max_requests_jitter = int(os.environ.get('CHECKIN_MAX_REQUESTS_JITTER', 100))
+timeout = int(os.environ.get('CHECKIN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('CHECKIN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+
+def on_starting(server):
+    logger.info('Preloaded %s in %.0f ms', wsgi_app, (time.monotonic() - CONFIG_LOADED) * 1000)
+
+
+def pre_fork(server, worker):
+    # SQLite connections opened while preloading must not be shared with the children
+    from django.db import connections
+    connections.close_all()
+    worker.fork_started = time.monotonic()
+
+
+def post_worker_init(worker):
+    from checkin.revocation import revocations
+    revocations.rebuild()
+    logger.info('Worker %s ready in %.0f ms', worker.pid, (time.monotonic() - worker.fork_started) * 1000)
+
+
+def worker_exit(server, worker):
+    # Write audit events still buffered in memory before the worker goes away
+    from checkin.audit import audit_log
+    audit_log.flush()
@@ -7,6 +7,8 @@ import sys
 def main():
     """Run administrative tasks."""
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    # Sets SETUPTOOLS_USE_DISTUTILS before Django is imported
+    import backend  # noqa: F401
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc: